@@ -1,22 +1,59 @@
-from flask import Flask, request, render_template_string, send_file, flash, redirect, url_for, jsonify
+from flask import Flask, request, render_template_string, send_file, flash, redirect, url_for, jsonify, Response
 import requests
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.table import Table, TableStyleInfo
-import io
+import json
+import math
 import os
+import queue
+import sqlite3
+import atexit
 import re
-from datetime import datetime
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import logging
 from werkzeug.utils import secure_filename
 import concurrent.futures
-from threading import Lock
+import threading
+from threading import Lock, Condition, Event, Thread
 import time
 from functools import lru_cache
 import random
+import asyncio
+import collections
+import contextvars
+import heapq
+import hashlib
+import hmac
+import mmap
+import shutil
+import struct
+from array import array
+from urllib.parse import urlsplit
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+
+try:
+    import aiohttp  # Only needed for LOOKUP_ENGINE=asyncio
+except ImportError:
+    aiohttp = None
+
+try:
+    import fcntl  # Elects one worker to rebuild the cache snapshot (POSIX only)
+except ImportError:
+    fcntl = None
+
+try:
+    import httpx  # Only needed for UPSTREAM_TRANSPORT=http2, together with h2
+    import h2
+except ImportError:
+    httpx = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -27,205 +64,3622 @@ app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 
 # Configuration - Optimized for reliability
 API_KEY = os.environ.get('API_KEY', "WtxD2p9I4bewyfBWFU1BF7Eh8xj9M6QDqaZ6erLqvxyj2JEnB64K7HTONcc8")
+API_KEYS = [key.strip() for key in os.environ.get('API_KEYS', API_KEY).split(',') if key.strip()]  # Comma-separated key pool
 API_URL = "https://bdcourier.com/api/pro/courier-check"
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 ALLOWED_EXTENSIONS = {'txt'}
 
 # Optimized settings for better success rate
-MAX_WORKERS = 8        # Reduced from 20 to avoid rate limiting
-BATCH_SIZE = 30        # Smaller batches for better control
-API_TIMEOUT = 20       # Increased timeout
-BASE_DELAY = 0.3       # Base delay between requests
+MAX_WORKERS = 8        # Starting upstream concurrency; tuned at runtime by the AIMD controller
+PROGRESS_LOG_INTERVAL = 30  # Log progress every this many finished numbers
+API_TIMEOUT = 20       # Longest an upstream request may take
+CONNECT_TIMEOUT = float(os.environ.get('CONNECT_TIMEOUT', 3.05))  # TCP connect to the upstream
+BASE_DELAY = 0.3       # Shortest delay before a retry
 MAX_RETRIES = 3        # Maximum retry attempts
-BACKOFF_FACTOR = 2     # Exponential backoff multiplier
+BACKOFF_FACTOR = 3     # Decorrelated jitter: next delay is drawn from [BASE_DELAY, previous delay x this]
+RETRY_MAX_DELAY = 10.0 # Longest delay before a retry
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}  # Other 4xx answers are permanent
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.1))  # Retries allowed per first attempt...
+RETRY_BUDGET_MIN = int(os.environ.get('RETRY_BUDGET_MIN', 10))         # ...plus this many, so small jobs can still retry
+SWEEP_FAILURES = os.environ.get('SWEEP_FAILURES', '1') == '1'  # Retry transient failures once more at the end of a job
+
+# Upstream calls in flight across every job in this process (the starting point when AIMD is on)
+GLOBAL_MAX_CONCURRENCY = int(os.environ.get('GLOBAL_MAX_CONCURRENCY', MAX_WORKERS))
+
+# Adaptive (AIMD) concurrency: grow the global limit by one per round of fast successes,
+# halve it on 429s, timeouts or latency spikes
+AIMD_ENABLED = os.environ.get('AIMD_ENABLED', '1') == '1'
+AIMD_MIN_CONCURRENCY = int(os.environ.get('AIMD_MIN_CONCURRENCY', 2))
+AIMD_MAX_CONCURRENCY = int(os.environ.get('AIMD_MAX_CONCURRENCY', GLOBAL_MAX_CONCURRENCY * 4 if AIMD_ENABLED else GLOBAL_MAX_CONCURRENCY))
+AIMD_DECREASE_FACTOR = 0.5      # Multiply the limit by this on congestion
+AIMD_LATENCY_FACTOR = 2.5       # A response slower than this times the baseline is a spike
+AIMD_COOLDOWN_SECONDS = 2.0     # At most one decrease per congestion event
+AIMD_BASELINE_WINDOW = 200      # Baseline latency is the median of this many recent responses...
+AIMD_BASELINE_MIN_SAMPLES = 20  # ...and spikes are only judged once it has this many
+
+# Circuit breaker: stop calling an upstream that keeps timing out or answering 5xx
+BREAKER_ENABLED = os.environ.get('BREAKER_ENABLED', '1') == '1'
+BREAKER_WINDOW = 20             # Judge the error rate over this many recent calls...
+BREAKER_MIN_CALLS = 10          # ...once at least this many have been made
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))  # Open at this share of failures
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 30))  # Stay open this long before probing
+BREAKER_PROBES = 3              # Probe calls allowed while half-open; all must succeed to close
+BREAKER_MODE = os.environ.get('BREAKER_MODE', 'fail')  # While open: 'fail' lookups fast or 'park' them until it closes
+
+# Request hedging: when a lookup is slower than the recent p95, race a second copy of it
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '0') == '1'
+HEDGE_PERCENTILE = 95           # Hedge after this percentile of recent successful latencies
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', 0.05))  # Hedges allowed per primary request
+HEDGE_MIN_SAMPLES = 20          # Latencies needed before hedging starts
+LATENCY_WINDOW = 500            # Recent latencies kept for percentiles
+
+HEDGE_POOL_SIZE = AIMD_MAX_CONCURRENCY * 2  # Threads racing primaries and hedges (threads engine)
+
+# Adaptive timeouts: the read timeout is the p99 of recent latencies x TIMEOUT_MULTIPLIER, clamped to
+# [TIMEOUT_FLOOR, API_TIMEOUT]; the connect timeout is the p99 of recent connection setups (TCP + TLS)
+# x the same multiplier, clamped to [CONNECT_TIMEOUT_FLOOR, CONNECT_TIMEOUT]. Both double on every retry
+ADAPTIVE_TIMEOUTS = os.environ.get('ADAPTIVE_TIMEOUTS', '1') == '1'
+TIMEOUT_PERCENTILE = 99
+TIMEOUT_MULTIPLIER = 3.0
+TIMEOUT_FLOOR = float(os.environ.get('TIMEOUT_FLOOR', 2.0))
+TIMEOUT_MIN_SAMPLES = 50        # Latencies needed before the read timeout adapts
+# Just over the 1s initial SYN retransmission timeout, so one lost SYN is retransmitted, not timed out
+CONNECT_TIMEOUT_FLOOR = float(os.environ.get('CONNECT_TIMEOUT_FLOOR', 1.05))
+CONNECT_WINDOW = 100            # Recent connection setup times kept (connections are reused, so few)
+CONNECT_MIN_SAMPLES = 10        # Setups needed before the connect timeout adapts
+
+# Upstream connections, per worker process (created after fork)
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', AIMD_MAX_CONCURRENCY * 2 if HEDGE_ENABLED else AIMD_MAX_CONCURRENCY))
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', min(GLOBAL_MAX_CONCURRENCY, 4)))  # Opened at startup
+CONNECTION_IDLE_SECONDS = 30    # Close pooled connections left unused this long
+
+# Upstream transport: 'http1' (requests, or aiohttp on the asyncio engine) or 'http2' (httpx, which
+# multiplexes lookups as streams over a few connections and speaks HTTP/1.1 to hosts without h2)
+UPSTREAM_TRANSPORT = os.environ.get('UPSTREAM_TRANSPORT', 'http1')
+HTTP2_PRIOR_KNOWLEDGE = os.environ.get('HTTP2_PRIOR_KNOWLEDGE', '0') == '1'  # h2 over plain http:// (no ALPN)
+
+if UPSTREAM_TRANSPORT == 'http2' and httpx is None:
+    logger.warning("⚠️ UPSTREAM_TRANSPORT=http2 needs httpx and h2; falling back to http1")
+    UPSTREAM_TRANSPORT = 'http1'
+
+PER_JOB_MAX_CONCURRENCY = int(os.environ.get('PER_JOB_MAX_CONCURRENCY', AIMD_MAX_CONCURRENCY))  # Most one job may hold
+PIPELINE_WINDOW = int(os.environ.get('PIPELINE_WINDOW', PER_JOB_MAX_CONCURRENCY))  # Lookups in flight per job
+
+# Lookup engine: 'threads' (requests on LOOKUP_POOL_SIZE threads) or 'asyncio' (aiohttp on one event loop)
+LOOKUP_ENGINE = os.environ.get('LOOKUP_ENGINE', 'threads')
+ASYNC_PIPELINE_WINDOW = int(os.environ.get('ASYNC_PIPELINE_WINDOW', 2000))  # Lookups in flight per job on asyncio
+
+if LOOKUP_ENGINE == 'asyncio' and aiohttp is None:
+    logger.warning("⚠️ LOOKUP_ENGINE=asyncio needs aiohttp; falling back to threads")
+    LOOKUP_ENGINE = 'threads'
+
+# Upstream request rate per API key, shared by every gunicorn worker (0 disables pacing)
+UPSTREAM_RATE_LIMIT = float(os.environ.get('UPSTREAM_RATE_LIMIT', 5))    # Requests per second
+UPSTREAM_BURST = float(os.environ.get('UPSTREAM_BURST', 10))             # Requests allowed back to back
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'sqlite')      # 'memory', 'sqlite' or 'http'
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', os.path.join(tempfile.gettempdir(), 'bd_courier_ratelimit.db'))
+RATE_LIMIT_SERVICE_URL = os.environ.get('RATE_LIMIT_SERVICE_URL')       # Base URL of a shared /ratelimit service
+RATE_LIMIT_SERVICE_ENABLED = os.environ.get('RATE_LIMIT_SERVICE_ENABLED') == '1'  # Serve /ratelimit for other hosts
+SERVICE_TOKEN = os.environ.get('SERVICE_TOKEN')  # Shared secret instances send as X-Service-Token to each other's endpoints
+# Processes sharing each bucket; while the backend is down each paces itself at 1/this of the rate
+RATE_LIMIT_INSTANCES = max(int(os.environ.get('RATE_LIMIT_INSTANCES', os.environ.get('WEB_CONCURRENCY', 1))), 1)
+PACER_MIN_RATE = 0.2            # Never slow below this many requests per second
+PACER_DECREASE_FACTOR = 0.5     # Multiply the rate by this on a 429
+PACER_COOLDOWN_SECONDS = 2.0    # At most one rate cut per burst of 429s
+PACER_RECOVERY_SECONDS = 60     # Time for a throttled rate to climb back to UPSTREAM_RATE_LIMIT
+PACER_DEFAULT_PAUSE = 1.0       # Pause after a 429 that has no Retry-After
+PACER_MAX_PAUSE = 300           # Ignore Retry-After/reset values beyond this
+PACER_MAX_RESERVATION = 1.0     # Hand out tokens at most this far ahead; later callers ask again
+KEY_REJECTED_STATUS_CODES = {401, 403}  # Upstream answers meaning the key, not the number, was refused
+KEY_REJECTED_COOLDOWN = float(os.environ.get('KEY_REJECTED_COOLDOWN', 300))  # Seconds a refused key sits out
 
-# Thread-safe counters and cache
-cache_lock = Lock()
-phone_cache = {}
+# Background job settings
+JOB_WORKERS = 2                 # Uploads processed concurrently per process
+LOOKUP_POOL_SIZE = int(os.environ.get('LOOKUP_POOL_SIZE', max(AIMD_MAX_CONCURRENCY, PIPELINE_WINDOW * JOB_WORKERS)))  # Shared lookup threads
+JOB_RETENTION_SECONDS = 3600    # Keep finished jobs and their reports for 1 hour
+REPORT_DIR = os.environ.get('REPORT_DIR', os.path.join(tempfile.gettempdir(), 'bd_courier_reports'))
+CHECKPOINT_DB = os.environ.get('CHECKPOINT_DB', os.path.join(tempfile.gettempdir(), 'bd_courier_checkpoints.db'))
+CHECKPOINT_BATCH_SIZE = 50      # Commit checkpointed results in groups of this size...
+CHECKPOINT_FLUSH_SECONDS = 1.0  # ...or at least this often
+RESUME_JOBS_ON_STARTUP = os.environ.get('RESUME_JOBS_ON_STARTUP', '1') == '1'  # Pick up jobs left unfinished by a dead worker
+JOB_HEARTBEAT_SECONDS = 10      # How often a worker marks the jobs it runs as alive...
+JOB_HEARTBEAT_TIMEOUT = 60      # ...and how long without a mark before another worker may take one over
+JOB_CANCEL_POLL_SECONDS = 1     # How often a worker checks for cancels of its jobs sent to other workers
+CANCEL_POLL_SECONDS = 0.5       # How often a running job checks for cancellation
+JOB_DEFAULT_DEADLINE = float(os.environ.get('JOB_DEFAULT_DEADLINE', 0))  # Seconds a job may run (0 = no limit)
+JOB_MAX_DEADLINE = 6 * 3600     # Longest deadline a caller may ask for
+DEADLINE_REPORT_RESERVE = 2.0   # Seconds kept back at the end to write the report
+NOT_CHECKED_DEADLINE = "Not checked (deadline)"
+DEADLINE_GAVE_UP = " (deadline)"              # Appended to the error of a lookup its job's deadline cut short...
+BUDGET_GAVE_UP = " (retry budget exhausted)"  # ...or its job's retry budget
+SSE_HEARTBEAT_SECONDS = 15     # Comment line sent on idle progress streams
+SSE_MIN_INTERVAL = 0.25         # Coalesce progress events to at most 4 per second
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 4))  # Open streams per worker; each holds a thread
+SSE_POLL_SECONDS = 1            # How often a stream of a job held by another worker re-reads the checkpoint store
+
+# Lookup result cache, per process (see PhoneCache); small, as the shared cache below backs it
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))  # JSON size of cached results (0 = no cap)
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', 24 * 3600))  # Courier histories go stale after this
+CACHE_STALE_SECONDS = float(os.environ.get('CACHE_STALE_SECONDS', 0))  # Serve expired histories this much longer while they refresh (0 = never)
+REVALIDATE_WORKERS = int(os.environ.get('REVALIDATE_WORKERS', 2))  # Threads per process refreshing stale entries
+REVALIDATE_QUEUE_SIZE = 10000   # Stale numbers waiting for a refresh; more are dropped until there is room
+REVALIDATE_MAX_ATTEMPTS = 2     # A refresh gives up sooner than a job's lookup; the next stale hit queues it again
+CACHE_SWEEP_SECONDS = 60        # How often expired entries are swept out...
+CACHE_SWEEP_BATCH = 1000        # ...at most this many per hold of the cache lock
+
+# Shared result cache on local disk, used by every worker on this host (see SharedResultCache)
+SHARED_CACHE_ENABLED = os.environ.get('SHARED_CACHE_ENABLED', '1') == '1'
+SHARED_CACHE_DB = os.environ.get('SHARED_CACHE_DB', os.path.join(tempfile.gettempdir(), 'bd_courier_cache.db'))
+SHARED_CACHE_MAX_ENTRIES = int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', 1000000))
+SHARED_CACHE_BATCH_SIZE = 100       # Commit cached results in groups of this size...
+SHARED_CACHE_FLUSH_SECONDS = 1.0    # ...or at least this often
+SHARED_CACHE_PRUNE_SECONDS = 300    # How often expired and excess rows are deleted
+SHARED_CACHE_CHUNK = 500            # Numbers per bulk IN (...) read
+
+# Memory-mapped snapshot of the shared cache, read by every worker (see SnapshotCache)
+SNAPSHOT_ENABLED = os.environ.get('SNAPSHOT_ENABLED', '1') == '1'
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'bd_courier_cache.snap'))
+SNAPSHOT_REBUILD_SECONDS = int(os.environ.get('SNAPSHOT_REBUILD_SECONDS', 600))  # Rebuild from the shared cache this often
+SNAPSHOT_CHECK_SECONDS = 5          # How often workers look for a newer snapshot file
+SNAPSHOT_SERVICE_ENABLED = os.environ.get('SNAPSHOT_SERVICE_ENABLED') == '1'  # Serve GET /cache/snapshot to other instances
+SNAPSHOT_IMPORT_URL = os.environ.get('SNAPSHOT_IMPORT_URL')  # Another instance's /cache/snapshot (or a file) to start from
+
+# Thread-safe counters (processing_stats is cumulative for this process)
 stats_lock = Lock()
 processing_stats = {
     'total': 0,
     'success': 0,
     'failed': 0,
-    'retries': 0
+    'retries': 0,
+    'retries_denied': 0,
+    'coalesced': 0,
+    'not_checked': 0,
+    'stale': 0,
+    'cache_hits': 0
 }
 
-def create_robust_session():
-    """Create a session with retry strategy and larger connection pool"""
-    session = requests.Session()
+# Background jobs, keyed by job ID
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+jobs_lock = Lock()
+jobs = {}
+job_executor = None
+job_executor_pid = None
+
+class PhoneCache:
+    """Bounded LRU cache of successful lookups, each entry expiring after a TTL
     
-    # Configure retry strategy
-    retry_strategy = Retry(
-        total=MAX_RETRIES,
-        status_forcelist=[429, 500, 502, 503, 504],  # Retry on these status codes
-        backoff_factor=BACKOFF_FACTOR,
-        raise_on_status=False
-    )
+    Holds at most CACHE_MAX_ENTRIES results and roughly CACHE_MAX_BYTES of their JSON,
+    evicting the least recently used first. get() treats expired entries as misses,
+    but they are kept for another `stale` seconds for get_stale(); a sweeper thread
+    removes them after that in batches of CACHE_SWEEP_BATCH so a big expiry never
+    holds the lock for long.
+    """
     
-    # Configure adapter with larger connection pool
-    adapter = HTTPAdapter(
-        max_retries=retry_strategy,
-        pool_connections=MAX_WORKERS * 2,  # Larger connection pool
-        pool_maxsize=MAX_WORKERS * 4,
-        pool_block=False
-    )
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_SECONDS, stale=CACHE_STALE_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale = stale
+        self.lock = Lock()
+        self.entries = collections.OrderedDict()  # phone -> (result, expires_at, size), least recently used first
+        self.expiry = collections.OrderedDict()   # phone -> when it is removed (expires_at + stale), in the order they were stored
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.sweeper_pid = None
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, phone):
+        """Whether phone has a live entry; unlike get() this neither counts nor refreshes it"""
+        with self.lock:
+            entry = self.entries.get(phone)
+            return entry is not None and entry[1] > time.time()
+    
+    def get(self, phone):
+        """The cached result for phone, or None"""
+        with self.lock:
+            entry = self.entries.get(phone)
+            if entry is not None and entry[1] <= time.time():
+                if self.expiry[phone] <= time.time():
+                    self.remove(phone)
+                    self.expired += 1
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(phone)
+            self.hits += 1
+            return entry[0]
+    
+    def get_stale(self, phone):
+        """The result for phone if it expired less than `stale` seconds ago, or None"""
+        with self.lock:
+            entry = self.entries.get(phone)
+            if entry is None or entry[1] > time.time() or self.expiry[phone] <= time.time():
+                return None
+            
+            self.entries.move_to_end(phone)
+            self.stale_hits += 1
+            return entry[0]
+    
+    def set(self, phone, result, ttl=None):
+        """Store a result for ttl seconds (default CACHE_TTL_SECONDS), evicting to stay under the caps"""
+        size = len(json.dumps(result, default=str))
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        
+        with self.lock:
+            if phone in self.entries:
+                self.remove(phone)
+            self.entries[phone] = (result, expires_at, size)
+            self.expiry[phone] = expires_at + self.stale
+            self.bytes += size
+            
+            while len(self.entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+        
+        if self.sweeper_pid != os.getpid():
+            self.start_sweeper()
+    
+    def remove(self, phone):
+        # Caller holds self.lock
+        _, _, size = self.entries.pop(phone)
+        del self.expiry[phone]
+        self.bytes -= size
+    
+    def sweep(self, limit=CACHE_SWEEP_BATCH):
+        """Remove up to limit expired entries, oldest first; returns how many went
+        
+        Stops at the first live entry: an entry stored with a shorter TTL than those
+        before it waits for them, but reads never return it once expired.
+        """
+        now = time.time()
+        removed = 0
+        with self.lock:
+            while self.expiry and removed < limit:
+                phone, removed_at = next(iter(self.expiry.items()))
+                if removed_at > now:
+                    break
+                self.remove(phone)
+                removed += 1
+            self.expired += removed
+        return removed
+    
+    def start_sweeper(self):
+        with self.lock:
+            if self.sweeper_pid == os.getpid():
+                return
+            self.sweeper_pid = os.getpid()
+        Thread(target=self.sweep_loop, name="cache-sweeper", daemon=True).start()
+    
+    def sweep_loop(self):
+        while True:
+            time.sleep(CACHE_SWEEP_SECONDS)
+            # Release the lock between batches so lookups are never held up for long
+            while self.sweep() == CACHE_SWEEP_BATCH:
+                time.sleep(0)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'stale_seconds': self.stale,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'expired': self.expired,
+                'evictions': self.evictions
+            }
+
+phone_cache = PhoneCache()
+
+class SharedResultCache:
+    """Successful lookups in a SQLite (WAL) file shared by every worker on this host
+    
+    The tier under phone_cache: it survives restarts and deploys, and a number one
+    worker looked up is a hit for the others. Writes are queued to a writer thread
+    and committed in batches, as in CheckpointStore; reads use a connection per
+    thread. Rows expire with phone_cache's TTL but are still read for another
+    CACHE_STALE_SECONDS; the writer deletes them after that, and the
+    soonest-expiring rows beyond SHARED_CACHE_MAX_ENTRIES. The cache is best
+    effort: a failed read is a miss and a failed write is dropped.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.local = threading.local()
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.pruned = 0
+        self.errors = 0
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        conn = self.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (phone TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at)")
+    
+    def connection(self):
+        """Per-thread connection, reopened after a fork"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+    
+    def read(self, sql, params):
+        """{phone: ((data, None), expires_at)} for the rows a query returns"""
+        try:
+            rows = self.connection().execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            self.count('errors')
+            logger.warning(f"⚠️ Shared cache read failed: {str(e)}")
+            return {}
+        return {phone: ((json.loads(data), None), expires_at) for phone, data, expires_at in rows}
+    
+    def get(self, phone):
+        """(result, expires_at) if phone has a live or stale entry, else None"""
+        found = self.read(
+            "SELECT phone, data, expires_at FROM results WHERE phone = ? AND expires_at > ?",
+            (phone, time.time() - CACHE_STALE_SECONDS)
+        )
+        self.count('hits' if found else 'misses')
+        return found.get(phone)
+    
+    def get_many(self, phones):
+        """{phone: (result, expires_at)} for every phone with a live or stale entry, read in bulk
+        
+        Every query asks for exactly SHARED_CACHE_CHUNK numbers (the last chunk is padded
+        with repeats), so sqlite3 prepares the statement once and reuses it.
+        """
+        sql = (
+            f"SELECT phone, data, expires_at FROM results "
+            f"WHERE phone IN ({', '.join(['?'] * SHARED_CACHE_CHUNK)}) AND expires_at > ?"
+        )
+        now = time.time() - CACHE_STALE_SECONDS
+        found = {}
+        for start in range(0, len(phones), SHARED_CACHE_CHUNK):
+            chunk = list(phones[start:start + SHARED_CACHE_CHUNK])
+            chunk += chunk[-1:] * (SHARED_CACHE_CHUNK - len(chunk))
+            found.update(self.read(sql, chunk + [now]))
+        
+        self.count('hits', len(found))
+        self.count('misses', len(set(phones)) - len(found))
+        return found
+    
+    def live_rows(self):
+        """(phone, data, expires_at) of every live or stale row, data decoded"""
+        cursor = self.connection().execute(
+            "SELECT phone, data, expires_at FROM results WHERE expires_at > ?", (time.time() - CACHE_STALE_SECONDS,)
+        )
+        for phone, data, expires_at in cursor:
+            yield phone, json.loads(data), expires_at
+    
+    def put(self, phone, result, ttl=CACHE_TTL_SECONDS):
+        """Queue a successful result for the next batched commit"""
+        data, _ = result
+        self.ensure_writer().put(('put', (phone, json.dumps(data), time.time() + ttl)))
+    
+    def flush(self, timeout=10):
+        """Block until everything queued so far has been committed"""
+        with self.lock:
+            if self.writer is None or self.writer_pid != os.getpid() or not self.writer.is_alive():
+                return
+            pending_queue = self.queue
+        
+        done = Event()
+        pending_queue.put(('flush', done))
+        done.wait(timeout)
+    
+    def ensure_writer(self):
+        """Start the writer thread in this process if needed and return its queue"""
+        with self.lock:
+            if self.writer is None or self.writer_pid != os.getpid() or not self.writer.is_alive():
+                self.queue = queue.Queue()
+                self.writer_pid = os.getpid()
+                self.writer = Thread(target=self.write_loop, args=(self.queue,), name="shared-cache-writer", daemon=True)
+                self.writer.start()
+            return self.queue
+    
+    def write_loop(self, pending_queue):
+        """Drain the queue, committing rows in batches and pruning now and then"""
+        conn = self.connection()
+        rows = []
+        deadline = None
+        next_prune = time.monotonic()
+        
+        while True:
+            timeout = max(deadline - time.monotonic(), 0) if rows else None
+            try:
+                kind, item = pending_queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, item = None, None
+            
+            if kind == 'put':
+                if not rows:
+                    deadline = time.monotonic() + SHARED_CACHE_FLUSH_SECONDS
+                rows.append(item)
+            
+            if rows and (kind != 'put' or len(rows) >= SHARED_CACHE_BATCH_SIZE or time.monotonic() >= deadline):
+                try:
+                    conn.execute("BEGIN")
+                    conn.executemany("INSERT OR REPLACE INTO results (phone, data, expires_at) VALUES (?, ?, ?)", rows)
+                    conn.execute("COMMIT")
+                    self.count('writes', len(rows))
+                except sqlite3.Error as e:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    self.count('errors')
+                    logger.error(f"❌ Shared cache write of {len(rows)} results failed: {str(e)}")
+                rows = []
+                
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + SHARED_CACHE_PRUNE_SECONDS
+                    self.prune(conn)
+            
+            if kind == 'flush':
+                item.set()
+    
+    def prune(self, conn):
+        """Delete rows too old to serve even stale, then the soonest-expiring ones beyond SHARED_CACHE_MAX_ENTRIES"""
+        try:
+            pruned = conn.execute("DELETE FROM results WHERE expires_at <= ?", (time.time() - CACHE_STALE_SECONDS,)).rowcount
+            excess = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - SHARED_CACHE_MAX_ENTRIES
+            if excess > 0:
+                pruned += conn.execute(
+                    "DELETE FROM results WHERE phone IN (SELECT phone FROM results ORDER BY expires_at LIMIT ?)",
+                    (excess,)
+                ).rowcount
+            self.count('pruned', pruned)
+        except sqlite3.Error as e:
+            self.count('errors')
+            logger.warning(f"⚠️ Shared cache prune failed: {str(e)}")
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'path': self.path,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'writes': self.writes,
+                'pruned': self.pruned,
+                'errors': self.errors
+            }
+
+def create_shared_cache():
+    """The shared L2 cache, or None if it is disabled or its database can't be opened"""
+    if not SHARED_CACHE_ENABLED:
+        return None
+    try:
+        return SharedResultCache(SHARED_CACHE_DB)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"⚠️ Shared cache at {SHARED_CACHE_DB} unavailable, running without it: {str(e)}")
+        return None
+
+shared_cache = create_shared_cache()
+if shared_cache is not None:
+    atexit.register(shared_cache.flush)
+
+SNAPSHOT_MAGIC = b'BDCSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sIIIId')  # Magic, courier name bytes, slots, records, numbers, created_at
+SNAPSHOT_SLOT = struct.Struct('<QIIHH')      # Phone as an integer (0 = empty), expires_at, first record, records, unused
+SNAPSHOT_RECORD = struct.Struct('<HIII')     # Courier index, total, success and cancelled parcels
+SNAPSHOT_HASH = 0x9E3779B97F4A7C15           # Fibonacci hashing of phone keys into slots
+
+def snapshot_slot(key, bits):
+    """Home slot of a phone key in a table of 2**bits slots"""
+    return ((key * SNAPSHOT_HASH) & 0xFFFFFFFFFFFFFFFF) >> (64 - bits)
+
+def pack_courier_counts(data):
+    """[(courier, total, success, cancelled)] from a lookup result, or None if it does not fit a snapshot"""
+    couriers = data.get('courierData') if isinstance(data, dict) else None
+    if not isinstance(couriers, dict):
+        return None
+    
+    packed = []
+    for name, stats in couriers.items():
+        if not isinstance(stats, dict) or '\n' in name:
+            return None
+        counts = [stats.get(field, 0) for field in ('total_parcel', 'success_parcel', 'cancelled_parcel')]
+        if not all(isinstance(count, int) and 0 <= count < 2 ** 32 for count in counts):
+            return None
+        packed.append((name, *counts))
+    return packed
+
+def write_snapshot(path, rows):
+    """Pack (phone, data, expires_at) rows into a snapshot file, replacing path atomically; returns the numbers packed
+    
+    Results that are not plain per-courier counts are left out; lookups of those
+    numbers fall through to shared_cache.
+    """
+    couriers = {}
+    keys, expiries, firsts, counts = array('Q'), array('I'), array('I'), array('H')
+    records = bytearray()
+    
+    for phone, data, expires_at in rows:
+        packed = pack_courier_counts(data)
+        if packed is None or not phone.isdigit():
+            continue
+        keys.append(int(phone))
+        expiries.append(int(expires_at))
+        firsts.append(len(records) // SNAPSHOT_RECORD.size)
+        counts.append(len(packed))
+        for name, total, success, cancelled in packed:
+            records += SNAPSHOT_RECORD.pack(couriers.setdefault(name, len(couriers)), total, success, cancelled)
+    
+    # Open addressing with linear probing, kept at most half full
+    slots = 16
+    while slots < 2 * len(keys):
+        slots *= 2
+    bits = slots.bit_length() - 1
+    table = bytearray(slots * SNAPSHOT_SLOT.size)
+    owners = [None] * slots
+    for entry, key in enumerate(keys):
+        index = snapshot_slot(key, bits)
+        while owners[index] is not None and owners[index] != key:
+            index = (index + 1) & (slots - 1)
+        owners[index] = key
+        SNAPSHOT_SLOT.pack_into(table, index * SNAPSHOT_SLOT.size, key, expiries[entry], firsts[entry], counts[entry], 0)
+    
+    names = '\n'.join(couriers).encode()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(names), slots, len(records) // SNAPSHOT_RECORD.size, len(keys), time.time()))
+        f.write(names.ljust((len(names) + 7) // 8 * 8, b'\0'))
+        f.write(table)
+        f.write(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(keys)
+
+class CacheSnapshot:
+    """One snapshot file, memory-mapped read-only
+    
+    Layout (little-endian): SNAPSHOT_HEADER; the courier names, newline-separated
+    and padded to 8 bytes; a hash table of SNAPSHOT_SLOT entries keyed by the phone
+    number as an integer; then the SNAPSHOT_RECORD counts the slots point at. Every
+    worker maps the same file, so the page cache holds one copy for all of them, and
+    a hit unpacks a few integers instead of parsing JSON.
+    """
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, names_size, self.slots, self.records, self.numbers, self.created_at = SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC or self.slots < 16 or self.slots & (self.slots - 1):
+            raise ValueError("not a cache snapshot")
+        
+        names = self.map[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + names_size].decode()
+        self.couriers = names.split('\n') if names else []
+        self.bits = self.slots.bit_length() - 1
+        self.slots_at = SNAPSHOT_HEADER.size + (names_size + 7) // 8 * 8
+        self.records_at = self.slots_at + self.slots * SNAPSHOT_SLOT.size
+        if len(self.map) != self.records_at + self.records * SNAPSHOT_RECORD.size:
+            raise ValueError("truncated cache snapshot")
+    
+    def validate(self):
+        """Check every slot and record, so lookups on a file from elsewhere can neither loop nor fail
+        
+        write_snapshot() output is valid by construction; this is for imported files.
+        """
+        with memoryview(self.map) as view:
+            empty = numbers = 0
+            for key, _, first, count, _ in SNAPSHOT_SLOT.iter_unpack(view[self.slots_at:self.records_at]):
+                if key == 0:
+                    empty += 1
+                elif first + count > self.records:
+                    raise ValueError(f"slot points past the {self.records} records")
+                else:
+                    numbers += 1
+            if empty == 0:
+                raise ValueError("hash table has no empty slot")
+            if numbers != self.numbers:
+                raise ValueError(f"header says {self.numbers} numbers, table holds {numbers}")
+            
+            for courier, _, _, _ in SNAPSHOT_RECORD.iter_unpack(view[self.records_at:]):
+                if courier >= len(self.couriers):
+                    raise ValueError(f"courier index {courier} out of range")
+    
+    def get(self, phone):
+        """(result, expires_at) for phone, expired or not, or None"""
+        if not phone.isdigit():
+            return None
+        
+        key = int(phone)
+        index = snapshot_slot(key, self.bits)
+        while True:
+            slot_key, expires_at, first, count, _ = SNAPSHOT_SLOT.unpack_from(self.map, self.slots_at + index * SNAPSHOT_SLOT.size)
+            if slot_key == key:
+                return self.result(first, count), expires_at
+            if slot_key == 0:
+                return None
+            index = (index + 1) & (self.slots - 1)
+    
+    def result(self, first, count):
+        couriers = {}
+        for record in range(first, first + count):
+            courier, total, success, cancelled = SNAPSHOT_RECORD.unpack_from(self.map, self.records_at + record * SNAPSHOT_RECORD.size)
+            couriers[self.couriers[courier]] = {'total_parcel': total, 'success_parcel': success, 'cancelled_parcel': cancelled}
+        return {'courierData': couriers}, None
+    
+    def items(self):
+        """(phone, result, expires_at) of every number in the snapshot"""
+        for index in range(self.slots):
+            key, expires_at, first, count, _ = SNAPSHOT_SLOT.unpack_from(self.map, self.slots_at + index * SNAPSHOT_SLOT.size)
+            if key:
+                yield f"{key:011d}", self.result(first, count), expires_at
+
+class SnapshotCache:
+    """The cache snapshot this worker reads, swapped for a newer file as soon as one appears
+    
+    Whichever worker holds the lock file rebuilds the snapshot from shared_cache every
+    SNAPSHOT_REBUILD_SECONDS, writing a new file and renaming it over the old one;
+    every worker maps the new file within SNAPSHOT_CHECK_SECONDS. Lookups still using
+    the old mapping keep it alive until they finish. A new host with no snapshot yet
+    can start from another instance's (SNAPSHOT_IMPORT_URL), which also fills its
+    shared cache.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.current = None
+        self.signature = None
+        self.checked_at = 0.0
+        self.builder_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.imports = 0
+        self.swaps = 0
+        self.errors = 0
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+    
+    def snapshot(self):
+        """The current CacheSnapshot, or None"""
+        if time.monotonic() - self.checked_at >= SNAPSHOT_CHECK_SECONDS:
+            self.refresh()
+        return self.current
+    
+    def refresh(self):
+        """Map the snapshot file if it changed since the last look (and start the builder here if needed)"""
+        with self.lock:
+            self.checked_at = time.monotonic()
+            if self.builder_pid != os.getpid():
+                self.builder_pid = os.getpid()
+                Thread(target=self.build_loop, name="snapshot-builder", daemon=True).start()
+            
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.current = self.signature = None
+                return
+            
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if signature == self.signature:
+                return
+            
+            # Remember a bad file too, so it is not reopened on every check
+            self.signature = signature
+            try:
+                self.current = CacheSnapshot(self.path)
+                self.swaps += 1
+            except (OSError, ValueError, struct.error) as e:
+                self.errors += 1
+                logger.warning(f"⚠️ Could not map cache snapshot {self.path}: {str(e)}")
+                return
+        
+        logger.info(f"🗺️ Mapped cache snapshot of {self.current.numbers} numbers in process {os.getpid()}")
+    
+    def get(self, phone):
+        """(result, expires_at) if the snapshot holds a live or stale entry for phone, else None"""
+        snapshot = self.snapshot()
+        entry = snapshot.get(phone) if snapshot is not None else None
+        if entry is not None and entry[1] <= time.time() - CACHE_STALE_SECONDS:
+            entry = None
+        self.count('hits' if entry is not None else 'misses')
+        return entry
+    
+    def __contains__(self, phone):
+        """Whether the snapshot holds a live entry for phone; not counted as a hit or miss"""
+        snapshot = self.snapshot()
+        entry = snapshot.get(phone) if snapshot is not None else None
+        return entry is not None and entry[1] > time.time()
+    
+    def build_loop(self):
+        while True:
+            try:
+                self.maybe_rebuild()
+            except Exception as e:
+                self.count('errors')
+                logger.error(f"❌ Cache snapshot rebuild failed: {str(e)}")
+            time.sleep(min(SNAPSHOT_REBUILD_SECONDS, 60))
+    
+    def maybe_rebuild(self):
+        """Rebuild the snapshot (or import one, on a new host) if it is missing or stale and no other worker is on it"""
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+            
+            try:
+                age = time.time() - os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                age = None
+            
+            if age is None and SNAPSHOT_IMPORT_URL:
+                try:
+                    self.import_snapshot(SNAPSHOT_IMPORT_URL)
+                    return
+                except Exception as e:
+                    self.count('errors')
+                    logger.warning(f"⚠️ Could not import cache snapshot from {SNAPSHOT_IMPORT_URL}: {str(e)}")
+            
+            if age is None or age >= SNAPSHOT_REBUILD_SECONDS:
+                self.rebuild()
+    
+    def rebuild(self):
+        """Write a fresh snapshot of shared_cache and map it"""
+        start_time = time.time()
+        numbers = write_snapshot(self.path, shared_cache.live_rows())
+        self.count('builds')
+        logger.info(f"🗺️ Rebuilt cache snapshot: {numbers} numbers in {time.time() - start_time:.1f}s")
+        self.refresh()
+    
+    def import_snapshot(self, source):
+        """Install a snapshot exported by another instance (a URL or a file path) and copy it into shared_cache"""
+        temp_path = f"{self.path}.{os.getpid()}.import"
+        try:
+            if source.startswith(('http://', 'https://')):
+                headers = {'X-Service-Token': SERVICE_TOKEN} if SERVICE_TOKEN else {}
+                with requests.get(source, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, API_TIMEOUT)) as response:
+                    response.raise_for_status()
+                    with open(temp_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=1024 * 1024):
+                            f.write(chunk)
+            else:
+                shutil.copyfile(source, temp_path)
+            
+            # Check the whole file before it replaces anything
+            snapshot = CacheSnapshot(temp_path)
+            snapshot.validate()
+            now = time.time()
+            for phone, result, expires_at in snapshot.items():
+                if expires_at > now - CACHE_STALE_SECONDS:
+                    shared_cache.put(phone, result, ttl=expires_at - now)
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        self.count('imports')
+        logger.info(f"📥 Imported cache snapshot of {snapshot.numbers} numbers from {source}")
+        self.refresh()
+    
+    def stats(self):
+        snapshot = self.current
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'path': self.path,
+                'numbers': snapshot.numbers if snapshot is not None else 0,
+                'bytes': len(snapshot.map) if snapshot is not None else 0,
+                'age_seconds': round(time.time() - snapshot.created_at, 1) if snapshot is not None else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'builds': self.builds,
+                'imports': self.imports,
+                'swaps': self.swaps,
+                'errors': self.errors
+            }
+
+# The export holds every cached number and its history, so it is never served without a token
+if SNAPSHOT_SERVICE_ENABLED and not SERVICE_TOKEN:
+    raise ValueError("SNAPSHOT_SERVICE_ENABLED=1 needs SERVICE_TOKEN, or anyone could download every cached number")
+
+# The snapshot is built from the shared cache, so it needs one
+cache_snapshot = SnapshotCache(SNAPSHOT_PATH) if SNAPSHOT_ENABLED and shared_cache is not None else None
+
+def is_cached(phone):
+    """Whether a lookup of phone would be answered by phone_cache or the snapshot"""
+    return phone in phone_cache or (cache_snapshot is not None and phone in cache_snapshot)
+
+class RetryBudget:
+    """Caps retries at RETRY_BUDGET_MIN + RETRY_BUDGET_RATIO x first attempts
+    
+    During an upstream incident every lookup starts failing; the budget stops each of
+    them from multiplying our load by MAX_RETRIES.
+    """
+    
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN):
+        self.lock = Lock()
+        self.ratio = ratio
+        self.minimum = minimum
+        self.first_attempts = 0
+        self.retries = 0
+        self.denied = 0
+    
+    def record_first_attempt(self):
+        with self.lock:
+            self.first_attempts += 1
+    
+    def try_spend(self):
+        """Take one retry from the budget; False once it is used up"""
+        with self.lock:
+            if self.retries >= self.minimum + self.ratio * self.first_attempts:
+                self.denied += 1
+                return False
+            self.retries += 1
+            return True
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'first_attempts': self.first_attempts,
+                'retries': self.retries,
+                'denied': self.denied,
+                'allowed': int(self.minimum + self.ratio * self.first_attempts)
+            }
+
+# Budget for lookups made outside a job
+default_retry_budget = RetryBudget()
+
+class Job:
+    """A background report job: its input numbers, progress counters and finished report"""
+    
+    def __init__(self, numbers, invalid_numbers, job_id=None, created_at=None, deadline=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.numbers = numbers
+        self.invalid_numbers = invalid_numbers
+        self.status = 'queued'
+        self.error = None
+        self.created_at = created_at or time.time()
+        self.deadline = deadline or None
+        self.deadline_at = self.created_at + deadline if deadline else None  # Counts from submission; see restart_deadline()
+        self.deadline_hit = False
+        self.started_at = None
+        self.finished_at = None
+        self.report_path = None
+        self.filename = None
+        self.processed_count = 0
+        self.reset_run()
+        
+        # Bumped on every progress change; progress streams wait on it
+        self.version = 0
+        self.changed = Condition()
+        
+        # Set by the cancel endpoint; checked by every wait and retry loop
+        self.cancel_event = Event()
+    
+    def reset_run(self):
+        """Zero the counters of a run, before the first one or a resume (run_job restores checkpointed ones)"""
+        self.completed = 0
+        self.stats = {
+            'total': len(self.numbers),
+            'success': 0,
+            'failed': 0,
+            'retries': 0,
+            'retries_denied': 0,
+            'coalesced': 0,
+            'not_checked': 0,
+            'stale': 0,
+            'cache_hits': 0
+        }
+        self.retry_budget = RetryBudget()
+        self.sweepable = set()  # Numbers that failed transiently, retried once more at the end
+        self.prefetched = None  # Bulk read of shared_cache: phone -> (result, expires_at)
+    
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+    
+    def cancel(self):
+        """Ask the job to stop; queued and in-flight lookups give up promptly"""
+        self.cancel_event.set()
+        self.notify()
+    
+    def time_left(self):
+        """Seconds until the job's deadline, or None if it has none"""
+        if self.deadline_at is None:
+            return None
+        return self.deadline_at - time.time()
+    
+    def restart_deadline(self):
+        """Give a resumed job its full time limit again, counted from now
+        
+        Otherwise a job resumed after a restart would already be past a deadline
+        counted from created_at, and report every number as not checked.
+        """
+        if self.deadline:
+            self.deadline_at = time.time() + self.deadline
+        self.deadline_hit = False
+    
+    def expire(self):
+        """Stop lookups at the deadline; unlike cancel() the job still reports what it has"""
+        self.deadline_hit = True
+        self.cancel()
+    
+    def notify(self):
+        """Wake up progress streams after a status or counter change"""
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+    
+    def set_status(self, status, error=None):
+        """Move the job to a new status and publish it"""
+        self.status = status
+        if error is not None:
+            self.error = error
+        self.notify()
+    
+    def record_result(self, phone, data, error, count=True):
+        """Count and checkpoint one finished lookup; called from the fetch completion path"""
+        checkpoint_store.append_result(self.id, phone, data, error)
+        
+        if count:
+            with stats_lock:
+                self.completed += 1
+        self.notify()
+    
+    def progress(self):
+        """Completed/failed/retry counts with throughput (numbers/sec) and ETA"""
+        with stats_lock:
+            stats = dict(self.stats)
+            completed = self.completed
+        
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        throughput = completed / elapsed if elapsed > 0 else 0
+        remaining = max(stats['total'] - completed, 0)
+        
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'total': stats['total'],
+            'completed': completed,
+            'success': stats['success'],
+            'failed': stats['failed'],
+            'retries': stats['retries'],
+            'retries_denied': stats['retries_denied'],
+            'stale': stats['stale'],
+            'elapsed': round(elapsed, 2),
+            'throughput': round(throughput, 2),
+            'eta_seconds': round(remaining / throughput, 1) if throughput > 0 else None,
+            'deadline_seconds': round(max(self.time_left(), 0), 1) if self.deadline_at else None,
+            'upstream': circuit_breaker.state
+        }
+    
+    def to_dict(self):
+        """Status snapshot suitable for the JSON status endpoint"""
+        with stats_lock:
+            stats = dict(self.stats)
+        
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'completed': self.completed,
+            'stats': stats,
+            'retry_budget': self.retry_budget.stats(),
+            'invalid': len(self.invalid_numbers),
+            'created_at': self.created_at,
+            'deadline_at': self.deadline_at,
+            'deadline_hit': self.deadline_hit,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'filename': self.filename
+        }
+
+def interruptible_sleep(seconds, job=None):
+    """Sleep, waking early if the job is cancelled; returns True if it was"""
+    if job is None:
+        time.sleep(seconds)
+        return False
+    return job.cancel_event.wait(seconds)
+
+async def interruptible_sleep_async(seconds, job=None):
+    """interruptible_sleep() for coroutines"""
+    deadline = time.monotonic() + seconds
+    while True:
+        if job is not None and job.cancelled:
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(remaining, CANCEL_POLL_SECONDS))
+
+def record_stat(job, key, amount=1):
+    """Increment a processing counter for this process and, if given, for the job
+    
+    Lookups still in flight when a job hits its deadline no longer count toward
+    it: run_job recounts the job from the rows of its report.
+    """
+    if job is not None and job.deadline_hit:
+        job = None
+    
+    with stats_lock:
+        processing_stats[key] += amount
+        if job is not None:
+            job.stats[key] += amount
+    
+    if job is not None:
+        job.notify()
+
+class CheckpointStore:
+    """SQLite (WAL) log of jobs and their finished lookups, so interrupted jobs can resume
+    
+    Results are queued to a single writer thread and committed in batches of
+    CHECKPOINT_BATCH_SIZE or every CHECKPOINT_FLUSH_SECONDS, whichever comes first.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        conn = self.connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    numbers TEXT NOT NULL,
+                    invalid_numbers TEXT NOT NULL,
+                    owner_pid INTEGER,
+                    heartbeat REAL,
+                    error TEXT,
+                    report_path TEXT,
+                    filename TEXT,
+                    finished_at REAL,
+                    deadline REAL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS results (
+                    job_id TEXT NOT NULL,
+                    phone TEXT NOT NULL,
+                    data TEXT,
+                    error TEXT,
+                    PRIMARY KEY (job_id, phone)
+                );
+            """)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if 'deadline' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN deadline REAL")
+            if 'heartbeat' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            if 'cancel_requested' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def connect(self):
+        """Open a connection; each thread uses its own"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def execute(self, sql, params=()):
+        """Run a single write statement in its own transaction and return the row count"""
+        conn = self.connect()
+        try:
+            with conn:
+                return conn.execute(sql, params).rowcount
+        finally:
+            conn.close()
+    
+    def query(self, sql, params=()):
+        """Run a read query and return all rows"""
+        conn = self.connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+    
+    def save_job(self, job):
+        """Record a new job with its input so it can be rebuilt after a crash"""
+        self.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, created_at, status, numbers, invalid_numbers, owner_pid, heartbeat, deadline) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, job.created_at, job.status, json.dumps(job.numbers), json.dumps(job.invalid_numbers), os.getpid(), time.time(), job.deadline)
+        )
+    
+    def update_job(self, job):
+        """Persist a job's status and report location"""
+        self.execute(
+            "UPDATE jobs SET status = ?, error = ?, report_path = ?, filename = ?, finished_at = ? WHERE job_id = ?",
+            (job.status, job.error, job.report_path, job.filename, job.finished_at, job.id)
+        )
+    
+    def load_job(self, job_id):
+        """Rebuild a Job from its checkpoint record, or None if there is none"""
+        rows = self.query(
+            "SELECT job_id, created_at, status, numbers, invalid_numbers, error, report_path, filename, finished_at, deadline "
+            "FROM jobs WHERE job_id = ?",
+            (job_id,)
+        )
+        if not rows:
+            return None
+        
+        job_id, created_at, status, numbers, invalid_numbers, error, report_path, filename, finished_at, deadline = rows[0]
+        job = Job(json.loads(numbers), json.loads(invalid_numbers), job_id=job_id, created_at=created_at, deadline=deadline)
+        job.status = status
+        job.error = error
+        job.report_path = report_path
+        job.filename = filename
+        job.finished_at = finished_at
+        return job
+    
+    def claim_job(self, job_id, previous_heartbeat):
+        """Atomically take over a job from a dead owner; False if another worker won"""
+        return self.execute(
+            "UPDATE jobs SET owner_pid = ?, heartbeat = ? WHERE job_id = ? AND heartbeat IS ?",
+            (os.getpid(), time.time(), job_id, previous_heartbeat)
+        ) == 1
+    
+    def heartbeat(self, job_ids):
+        """Mark jobs this process is running as alive"""
+        if job_ids:
+            self.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE owner_pid = ? AND job_id IN ({', '.join(['?'] * len(job_ids))})",
+                (time.time(), os.getpid(), *job_ids)
+            )
+    
+    def request_cancel(self, job_id):
+        """Ask whichever worker owns a queued or running job to cancel it; False if it is not active"""
+        return self.execute(
+            "UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status IN ('queued', 'running')",
+            (job_id,)
+        ) == 1
+    
+    def cancel_orphan(self, job_id, previous_heartbeat):
+        """Mark a job whose owner died as cancelled, unless another worker claimed it meanwhile"""
+        return self.execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND heartbeat IS ? AND status IN ('queued', 'running')",
+            (time.time(), job_id, previous_heartbeat)
+        ) == 1
+    
+    def clear_cancel(self, job_id):
+        """Forget a cancel request, for a job being resumed"""
+        self.execute("UPDATE jobs SET cancel_requested = 0 WHERE job_id = ?", (job_id,))
+    
+    def cancel_requests(self, job_ids):
+        """Which of these jobs have been asked to cancel"""
+        if not job_ids:
+            return []
+        rows = self.query(
+            f"SELECT job_id FROM jobs WHERE cancel_requested = 1 AND job_id IN ({', '.join(['?'] * len(job_ids))})",
+            tuple(job_ids)
+        )
+        return [job_id for job_id, in rows]
+    
+    def progress(self, job_id):
+        """(status, error, checked, successful) of a job as far as it has been checkpointed, or None"""
+        self.flush()
+        rows = self.query(
+            "SELECT status, error, "
+            "(SELECT COUNT(*) FROM results WHERE results.job_id = jobs.job_id), "
+            "(SELECT COUNT(data) FROM results WHERE results.job_id = jobs.job_id) "
+            "FROM jobs WHERE job_id = ?",
+            (job_id,)
+        )
+        return rows[0] if rows else None
+    
+    def incomplete_jobs(self):
+        """(job_id, heartbeat) of every job that never reached done/failed"""
+        return self.query("SELECT job_id, heartbeat FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+    
+    def delete_job(self, job_id):
+        """Forget a job and its checkpointed results"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        finally:
+            conn.close()
+    
+    def load_results(self, job_id):
+        """Checkpointed {phone: (data, error)} for a job"""
+        self.flush()
+        rows = self.query("SELECT phone, data, error FROM results WHERE job_id = ?", (job_id,))
+        return {phone: (json.loads(data) if data is not None else None, error) for phone, data, error in rows}
+    
+    def append_result(self, job_id, phone, data, error):
+        """Queue one finished lookup for the next batched commit"""
+        row = (job_id, phone, json.dumps(data) if data is not None else None, error)
+        self.ensure_writer().put(('result', row))
+    
+    def flush(self, timeout=10):
+        """Block until everything queued so far has been committed"""
+        with self.lock:
+            if self.writer is None or self.writer_pid != os.getpid() or not self.writer.is_alive():
+                return
+            pending_queue = self.queue
+        
+        done = Event()
+        pending_queue.put(('flush', done))
+        done.wait(timeout)
+    
+    def ensure_writer(self):
+        """Start the writer thread in this process if needed and return its queue"""
+        with self.lock:
+            if self.writer is None or self.writer_pid != os.getpid() or not self.writer.is_alive():
+                self.queue = queue.Queue()
+                self.writer_pid = os.getpid()
+                self.writer = Thread(target=self.write_loop, args=(self.queue,), name="checkpoint-writer", daemon=True)
+                self.writer.start()
+            return self.queue
+    
+    def write_loop(self, pending_queue):
+        """Drain the queue, committing rows in batches"""
+        conn = self.connect()
+        rows = []
+        deadline = None
+        
+        while True:
+            timeout = max(deadline - time.monotonic(), 0) if rows else None
+            try:
+                kind, item = pending_queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, item = None, None
+            
+            if kind == 'result':
+                if not rows:
+                    deadline = time.monotonic() + CHECKPOINT_FLUSH_SECONDS
+                rows.append(item)
+            
+            if rows and (kind != 'result' or len(rows) >= CHECKPOINT_BATCH_SIZE or time.monotonic() >= deadline):
+                try:
+                    with conn:
+                        conn.executemany("INSERT OR REPLACE INTO results (job_id, phone, data, error) VALUES (?, ?, ?, ?)", rows)
+                except sqlite3.Error as e:
+                    logger.error(f"❌ Checkpoint write of {len(rows)} results failed: {str(e)}")
+                rows = []
+            
+            if kind == 'flush':
+                item.set()
+
+checkpoint_store = CheckpointStore(CHECKPOINT_DB)
+atexit.register(checkpoint_store.flush)
+
+class ConcurrencyGovernor:
+    """Process-wide pool of upstream call slots shared fairly by all running jobs
+    
+    At most `limit` calls are in flight at once. Each job competing for slots
+    may hold an equal share of them (capped at `per_job_limit`), so a lone job
+    can use the whole pool while concurrent uploads split it.
+    """
+    
+    def __init__(self, limit, per_job_limit):
+        self.limit = limit
+        self.per_job_limit = per_job_limit
+        self.cond = Condition()
+        self.in_flight = 0
+        self.held = {}
+        self.waiting = {}
+        self.async_waiters = []
+    
+    def share(self):
+        """Slots each competing job may hold right now"""
+        competing = len(set(self.held) | set(self.waiting))
+        return min(self.per_job_limit, max(1, math.ceil(self.limit / max(competing, 1))))
+    
+    def acquire(self, job=None):
+        """Wait for a slot; returns False if the job is cancelled first"""
+        key = job.id if job is not None else None
+        
+        with self.cond:
+            self.waiting[key] = self.waiting.get(key, 0) + 1
+            try:
+                while self.in_flight >= self.limit or self.held.get(key, 0) >= self.share():
+                    if job is not None and job.cancelled:
+                        return False
+                    self.cond.wait(timeout=CANCEL_POLL_SECONDS)
+                
+                self.in_flight += 1
+                self.held[key] = self.held.get(key, 0) + 1
+                return True
+            finally:
+                self.waiting[key] -= 1
+                if not self.waiting[key]:
+                    del self.waiting[key]
+    
+    async def acquire_async(self, job=None):
+        """acquire() for coroutines: waits on the event loop instead of blocking it"""
+        key = job.id if job is not None else None
+        loop = asyncio.get_running_loop()
+        
+        waiter = (loop, asyncio.Event())
+        
+        with self.cond:
+            self.waiting[key] = self.waiting.get(key, 0) + 1
+            self.async_waiters.append(waiter)
+        
+        try:
+            while True:
+                with self.cond:
+                    # Cleared before the check, so a wake-up after it is never lost
+                    waiter[1].clear()
+                    if self.in_flight < self.limit and self.held.get(key, 0) < self.share():
+                        self.in_flight += 1
+                        self.held[key] = self.held.get(key, 0) + 1
+                        return True
+                
+                if job is not None and job.cancelled:
+                    return False
+                
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout=CANCEL_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.cond:
+                self.async_waiters.remove(waiter)
+                self.waiting[key] -= 1
+                if not self.waiting[key]:
+                    del self.waiting[key]
+    
+    def release(self, job=None):
+        """Return a slot taken by acquire() or acquire_async()"""
+        key = job.id if job is not None else None
+        
+        with self.cond:
+            self.in_flight -= 1
+            self.held[key] -= 1
+            if not self.held[key]:
+                del self.held[key]
+        
+        self.wake_waiters()
+    
+    def set_limit(self, limit):
+        """Change the global ceiling (used by the AIMD controller); waiters re-check at once"""
+        with self.cond:
+            self.limit = limit
+        
+        self.wake_waiters()
+    
+    def wake_waiters(self):
+        """Wake blocked threads and coroutines so they re-check for a free slot"""
+        with self.cond:
+            self.cond.notify_all()
+            async_waiters = list(self.async_waiters)
+        
+        for loop, woken in async_waiters:
+            loop.call_soon_threadsafe(woken.set)
+    
+    def stats(self):
+        with self.cond:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'waiting': sum(self.waiting.values()),
+                'jobs': len(set(self.held) | set(self.waiting)),
+                'per_job_share': self.share()
+            }
+
+outbound_governor = ConcurrencyGovernor(GLOBAL_MAX_CONCURRENCY, PER_JOB_MAX_CONCURRENCY)
+
+class LatencyTracker:
+    """Recent successful upstream latencies, for percentile estimates"""
+    
+    def __init__(self, size=LATENCY_WINDOW):
+        self.lock = Lock()
+        self.samples = collections.deque(maxlen=size)
+    
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+    
+    def percentile(self, p, min_samples=1):
+        """The p-th percentile in seconds, or None with fewer than min_samples samples"""
+        with self.lock:
+            if len(self.samples) < max(min_samples, 1):
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class AimdController:
+    """Additive-increase/multiplicative-decrease tuning of the governor's global limit
+    
+    Each response is fed in with its latency. After a full round of fast successes
+    (as many as the current limit) the limit grows by one; a 429, a timeout or a
+    response slower than AIMD_LATENCY_FACTOR times the baseline latency cuts it by
+    AIMD_DECREASE_FACTOR, at most once per AIMD_COOLDOWN_SECONDS. The baseline is
+    the median of the last AIMD_BASELINE_WINDOW responses, spikes included, so it
+    follows a lasting change in upstream speed instead of pinning the limit low.
+    """
+    
+    def __init__(self, governor, min_limit, max_limit):
+        self.governor = governor
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.lock = Lock()
+        self.limit = min(max(governor.limit, min_limit), max_limit)
+        self.successes = 0
+        self.latencies = LatencyTracker(AIMD_BASELINE_WINDOW)
+        self.last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+    
+    def on_success(self, latency):
+        baseline = self.latencies.percentile(50, min_samples=AIMD_BASELINE_MIN_SAMPLES)
+        self.latencies.record(latency)
+        
+        with self.lock:
+            if baseline is not None and latency > baseline * AIMD_LATENCY_FACTOR:
+                self.decrease_locked(f"latency spike {latency:.2f}s (baseline {baseline:.2f}s)")
+                return
+            
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_limit:
+                self.successes = 0
+                self.limit += 1
+                self.increases += 1
+                self.governor.set_limit(self.limit)
+    
+    def on_congestion(self, reason):
+        with self.lock:
+            self.decrease_locked(reason)
+    
+    def decrease_locked(self, reason):
+        now = time.monotonic()
+        self.successes = 0
+        if now - self.last_decrease < AIMD_COOLDOWN_SECONDS:
+            return
+        
+        new_limit = max(self.min_limit, int(self.limit * AIMD_DECREASE_FACTOR))
+        self.last_decrease = now
+        if new_limit < self.limit:
+            logger.warning(f"📉 Upstream concurrency {self.limit} -> {new_limit}: {reason}")
+            self.limit = new_limit
+            self.decreases += 1
+            self.governor.set_limit(self.limit)
+    
+    def stats(self):
+        baseline = self.latencies.percentile(50, min_samples=AIMD_BASELINE_MIN_SAMPLES)
+        with self.lock:
+            return {
+                'enabled': AIMD_ENABLED,
+                'limit': self.limit,
+                'min': self.min_limit,
+                'max': self.max_limit,
+                'baseline_latency_ms': round(baseline * 1000, 1) if baseline is not None else None,
+                'increases': self.increases,
+                'decreases': self.decreases
+            }
+
+concurrency_controller = AimdController(outbound_governor, AIMD_MIN_CONCURRENCY, AIMD_MAX_CONCURRENCY)
+
+upstream_latency = LatencyTracker()
+connect_latency = LatencyTracker(CONNECT_WINDOW)
+
+def adaptive_timeout(tracker, min_samples, floor, ceiling, attempt):
+    """p99 of `tracker` x TIMEOUT_MULTIPLIER within [floor, ceiling], or the ceiling until it has enough samples"""
+    p99 = tracker.percentile(TIMEOUT_PERCENTILE, min_samples) if ADAPTIVE_TIMEOUTS else None
+    if p99 is None:
+        return ceiling
+    
+    # A retry waits longer, so a slow-but-working upstream still gets through
+    return min(max(floor, p99 * TIMEOUT_MULTIPLIER) * (2 ** attempt), ceiling)
+
+def request_timeouts(attempt=0):
+    """(connect, read) timeouts for an upstream request, derived from recent connection setups and latencies"""
+    connect = adaptive_timeout(connect_latency, CONNECT_MIN_SAMPLES, CONNECT_TIMEOUT_FLOOR, CONNECT_TIMEOUT, attempt)
+    read = adaptive_timeout(upstream_latency, TIMEOUT_MIN_SAMPLES, TIMEOUT_FLOOR, API_TIMEOUT, attempt)
+    return connect, read
+
+def timeout_stats():
+    connect, read = request_timeouts()
+    p50 = upstream_latency.percentile(50)
+    p99 = upstream_latency.percentile(TIMEOUT_PERCENTILE)
+    connect_p99 = connect_latency.percentile(TIMEOUT_PERCENTILE)
+    return {
+        'adaptive': ADAPTIVE_TIMEOUTS,
+        'connect': round(connect, 2),
+        'read': round(read, 2),
+        'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 1) if p99 is not None else None,
+        'connect_p99_ms': round(connect_p99 * 1000, 1) if connect_p99 is not None else None
+    }
+
+def observe_upstream(status_code=None, latency=None, timed_out=False):
+    """Feed one upstream outcome to the latency tracker and the AIMD controller"""
+    if status_code == 200:
+        upstream_latency.record(latency)
+    
+    if not AIMD_ENABLED:
+        return
+    
+    if timed_out:
+        concurrency_controller.on_congestion("request timeout")
+    elif status_code == 429:
+        concurrency_controller.on_congestion("429 from upstream")
+    elif status_code == 200:
+        concurrency_controller.on_success(latency)
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker around the upstream
+    
+    Closed: calls flow and their outcomes fill a window of BREAKER_WINDOW results; it
+    opens when the failure share reaches BREAKER_ERROR_RATE. Open: calls are refused
+    for BREAKER_OPEN_SECONDS. Half-open: up to BREAKER_PROBES probe calls go through;
+    a failed probe reopens it, and BREAKER_PROBES successful ones close it.
+    """
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.state = 'closed'
+        self.outcomes = []
+        self.opened_at = 0.0
+        self.probes_inflight = 0
+        self.probe_successes = 0
+        self.trips = 0
+        self.rejected = 0
+    
+    def admit(self, peek=False):
+        """Ask to make a call: returns (allowed, is_probe, seconds until it may be allowed)
+        
+        With peek=True only an open circuit refuses, and nothing is counted; callers
+        use it to avoid queueing for a token or slot they could not use.
+        """
+        if not BREAKER_ENABLED:
+            return True, False, 0
+        
+        with self.lock:
+            if self.state == 'open':
+                remaining = self.opened_at + BREAKER_OPEN_SECONDS - time.monotonic()
+                if remaining > 0:
+                    if not peek:
+                        self.rejected += 1
+                    return False, False, remaining
+                
+                if peek:
+                    return True, False, 0
+                
+                self.state = 'half_open'
+                self.probes_inflight = 0
+                self.probe_successes = 0
+                logger.info("🔌 Circuit half-open: probing upstream")
+            
+            if peek:
+                return True, False, 0
+            
+            if self.state == 'half_open':
+                if self.probes_inflight + self.probe_successes >= BREAKER_PROBES:
+                    self.rejected += 1
+                    return False, False, 1.0
+                self.probes_inflight += 1
+                return True, True, 0
+            
+            return True, False, 0
+    
+    def record(self, success, probe=False):
+        """Feed back the outcome of an admitted call"""
+        if not BREAKER_ENABLED:
+            return
+        
+        with self.lock:
+            if probe:
+                self.probes_inflight = max(self.probes_inflight - 1, 0)
+                if self.state != 'half_open':
+                    return
+                
+                if not success:
+                    self.open_locked("probe failed")
+                    return
+                
+                self.probe_successes += 1
+                if self.probe_successes >= BREAKER_PROBES:
+                    self.state = 'closed'
+                    self.outcomes = []
+                    logger.info("🔌 Circuit closed: upstream recovered")
+                return
+            
+            if self.state != 'closed':
+                return
+            
+            self.outcomes.append(success)
+            if len(self.outcomes) > BREAKER_WINDOW:
+                del self.outcomes[0]
+            
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= BREAKER_MIN_CALLS and failures >= BREAKER_ERROR_RATE * len(self.outcomes):
+                self.open_locked(f"{failures}/{len(self.outcomes)} recent calls failed")
+    
+    def release(self, probe):
+        """Give back an admitted call that ended without a verdict on the upstream"""
+        if probe:
+            with self.lock:
+                self.probes_inflight = max(self.probes_inflight - 1, 0)
+    
+    def open_locked(self, reason):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.outcomes = []
+        self.trips += 1
+        logger.warning(f"🔌 Circuit open for {BREAKER_OPEN_SECONDS:.0f}s: {reason}")
+    
+    @property
+    def is_open(self):
+        return self.state == 'open'
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': BREAKER_ENABLED,
+                'mode': BREAKER_MODE,
+                'state': self.state,
+                'recent_calls': len(self.outcomes),
+                'recent_failures': self.outcomes.count(False),
+                'open_remaining': round(max(self.opened_at + BREAKER_OPEN_SECONDS - time.monotonic(), 0), 1) if self.state == 'open' else 0,
+                'trips': self.trips,
+                'rejected': self.rejected
+            }
+
+circuit_breaker = CircuitBreaker()
+
+def bucket_refill(state, now, max_rate, burst):
+    """Advance a (tokens, updated, rate) bucket to `now`
+    
+    Tokens refill at the current rate, and a throttled rate climbs back towards
+    max_rate over PACER_RECOVERY_SECONDS. While the bucket is paused `updated`
+    lies in the future and nothing refills.
+    """
+    tokens, updated, rate = state
+    if now > updated:
+        elapsed = now - updated
+        tokens = min(burst, tokens + elapsed * rate)
+        rate = min(max_rate, rate + elapsed * max_rate / PACER_RECOVERY_SECONDS)
+        updated = now
+    return tokens, updated, rate
+
+def bucket_reserve(state, now, max_rate, burst):
+    """Take one token, going into debt by at most PACER_MAX_RESERVATION seconds
+    
+    Returns (new_state, wait, granted). When granted, wait is how long the caller
+    must sleep before its token is actually available (including any pause in
+    force). When the bucket is too far in debt nothing is taken and wait is when
+    to ask again, so later pauses and rate cuts still apply to that caller.
+    """
+    tokens, updated, rate = bucket_refill(state, now, max_rate, burst)
+    wait = max(updated - now, 0.0) + max(1.0 - tokens, 0.0) / rate
+    
+    if wait > PACER_MAX_RESERVATION:
+        # Spread the callers coming back so they do not all retry at once
+        retry_in = wait - PACER_MAX_RESERVATION + random.uniform(0, PACER_MAX_RESERVATION)
+        return (tokens, updated, rate), retry_in, False
+    
+    return (tokens - 1, updated, rate), wait, True
+
+def bucket_adjust(state, now, max_rate, burst, rate=None, factor=None, pause=None):
+    """Scale or set the bucket's rate and/or pause it for `pause` seconds"""
+    tokens, updated, current = bucket_refill(state, now, max_rate, burst)
+    if factor is not None:
+        current *= factor
+    if rate is not None:
+        current = rate
+    current = min(max(current, PACER_MIN_RATE), max_rate)
+    
+    if pause:
+        tokens = min(tokens, 0.0)
+        updated = max(updated, now + pause)
+    return tokens, updated, current
+
+class MemoryRateLimitBackend:
+    """Token buckets held in this process only"""
+    
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.burst = burst
+        self.lock = Lock()
+        self.buckets = {}
+    
+    def reserve(self, name):
+        """Try to take a token; returns (wait, granted, current_rate)"""
+        with self.lock:
+            now = time.time()
+            state = self.buckets.get(name, (self.burst, now, self.max_rate))
+            state, wait, granted = bucket_reserve(state, now, self.max_rate, self.burst)
+            self.buckets[name] = state
+            return wait, granted, state[2]
+    
+    def adjust(self, name, **changes):
+        """Apply bucket_adjust(); returns the new rate"""
+        with self.lock:
+            now = time.time()
+            state = self.buckets.get(name, (self.burst, now, self.max_rate))
+            state = bucket_adjust(state, now, self.max_rate, self.burst, **changes)
+            self.buckets[name] = state
+            return state[2]
+
+class SqliteRateLimitBackend:
+    """Token buckets stored in a SQLite file, shared by every worker process on this host"""
+    
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.max_rate = rate
+        self.burst = burst
+        self.local = threading.local()
+        
+        conn = self.connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(buckets)")]
+        if 'rate' not in columns:
+            conn.execute("ALTER TABLE buckets ADD COLUMN rate REAL")
+    
+    def connection(self):
+        """Per-thread connection, reopened after a fork"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+    
+    def update(self, name, change):
+        """Read-modify-write one bucket under an exclusive lock; change(state, now) -> (state, result)"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated, rate FROM buckets WHERE name = ?", (name,)).fetchone()
+            now = time.time()
+            state = (row[0], row[1], row[2] or self.max_rate) if row else (self.burst, now, self.max_rate)
+            state, result = change(state, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated, rate) VALUES (?, ?, ?, ?)",
+                (name,) + tuple(state)
+            )
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def reserve(self, name):
+        """Try to take a token; returns (wait, granted, current_rate)"""
+        def take(state, now):
+            state, wait, granted = bucket_reserve(state, now, self.max_rate, self.burst)
+            return state, (wait, granted, state[2])
+        return self.update(name, take)
+    
+    def adjust(self, name, **changes):
+        """Apply bucket_adjust(); returns the new rate"""
+        def apply(state, now):
+            state = bucket_adjust(state, now, self.max_rate, self.burst, **changes)
+            return state, state[2]
+        return self.update(name, apply)
+
+class HttpRateLimitBackend:
+    """Token buckets held by a shared /ratelimit service (e.g. one instance of this app)"""
+    
+    def __init__(self, base_url, token):
+        self.base_url = base_url.rstrip('/')
+        self.http = requests.Session()
+        self.http.headers['X-Service-Token'] = token
+    
+    def reserve(self, name):
+        """Try to take a token; returns (wait, granted, current_rate)"""
+        response = self.http.post(f"{self.base_url}/reserve", params={'name': name}, timeout=2)
+        response.raise_for_status()
+        body = response.json()
+        return float(body['wait']), bool(body['granted']), float(body['rate'])
+    
+    def adjust(self, name, **changes):
+        """Apply bucket_adjust() on the service; returns the new rate"""
+        params = {key: value for key, value in changes.items() if value is not None}
+        params['name'] = name
+        response = self.http.post(f"{self.base_url}/adjust", params=params, timeout=2)
+        response.raise_for_status()
+        return float(response.json()['rate'])
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), PACER_MAX_PAUSE)
+
+def parse_rate_limit_headers(headers):
+    """(remaining, seconds_until_reset) from X-RateLimit-* / RateLimit-* headers, or (None, None)"""
+    remaining = headers.get('X-RateLimit-Remaining') or headers.get('RateLimit-Remaining')
+    reset = headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset')
+    if remaining is None or reset is None:
+        return None, None
+    
+    try:
+        remaining = float(remaining)
+        reset = float(reset)
+    except ValueError:
+        return None, None
+    
+    # Reset is either an epoch timestamp or seconds from now
+    if reset > 1e9:
+        reset -= time.time()
+    return remaining, min(max(reset, 0.0), PACER_MAX_PAUSE)
+
+class RateLimiter:
+    """Token-bucket pacer for one API key; every request sent with the key acquires from it
+    
+    The bucket's rate starts at UPSTREAM_RATE_LIMIT and follows the upstream: a 429
+    pauses it for Retry-After (or PACER_DEFAULT_PAUSE) and cuts the rate by
+    PACER_DECREASE_FACTOR, X-RateLimit-Remaining/Reset spread the remaining quota
+    evenly until the reset, and the rate recovers linearly afterwards. If the
+    backend fails (e.g. the shared service is unreachable) it falls back to a
+    per-process bucket at 1/RATE_LIMIT_INSTANCES of the rate, so lookups keep
+    flowing without every process spending the whole shared rate.
+    """
+    
+    def __init__(self, name, rate, burst, backend):
+        self.name = name
+        self.max_rate = rate
+        self.backend = backend
+        self.fallback = (
+            MemoryRateLimitBackend(rate / RATE_LIMIT_INSTANCES, max(burst / RATE_LIMIT_INSTANCES, 1.0))
+            if rate > 0 else None
+        )
+        self.using_fallback = False
+        self.lock = Lock()
+        self.current_rate = rate
+        self.last_decrease = 0.0
+        self.granted = 0
+        self.total_wait = 0.0
+        self.throttles = 0
+        self.backend_errors = 0
+        self.fallback_calls = 0
+    
+    @property
+    def enabled(self):
+        return self.max_rate > 0
+    
+    def call_backend(self, method, *args, **kwargs):
+        """Run a backend operation, falling back to the local bucket on failure"""
+        try:
+            result = getattr(self.backend, method)(self.name, *args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                self.backend_errors += 1
+                self.fallback_calls += 1
+                switched, self.using_fallback = not self.using_fallback, True
+            if switched:
+                logger.warning(
+                    f"⚠️ Rate limit backend failed, pacing {self.name} locally at "
+                    f"1/{RATE_LIMIT_INSTANCES} of the rate: {str(e)}"
+                )
+            return getattr(self.fallback, method)(self.name, *args, **kwargs)
+        
+        with self.lock:
+            recovered, self.using_fallback = self.using_fallback, False
+        if recovered:
+            logger.info(f"✅ Rate limit backend is back for {self.name}")
+        return result
+    
+    def reserve(self):
+        """Try to take a token; returns (wait, granted) as described in bucket_reserve()"""
+        if not self.enabled:
+            return 0.0, True
+        
+        wait, granted, rate = self.call_backend('reserve')
+        
+        with self.lock:
+            self.current_rate = rate
+            self.total_wait += wait
+            if granted:
+                self.granted += 1
+        return wait, granted
+    
+    def acquire(self, job=None):
+        """Block until the caller may send one request; returns False if the job is cancelled first"""
+        while True:
+            wait, granted = self.reserve()
+            if wait > 0 and interruptible_sleep(wait, job):
+                return False
+            if granted:
+                return True
+    
+    async def acquire_async(self, job=None):
+        """acquire() for coroutines; the backend call runs off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            wait, granted = await loop.run_in_executor(None, self.reserve)
+            if wait > 0 and await interruptible_sleep_async(wait, job):
+                return False
+            if granted:
+                return True
+    
+    def on_throttle(self, headers):
+        """A 429: pause for Retry-After and slow down (once per PACER_COOLDOWN_SECONDS)"""
+        if not self.enabled:
+            return
+        
+        pause = parse_retry_after(headers.get('Retry-After'))
+        if pause is None:
+            pause = PACER_DEFAULT_PAUSE
+        
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            decrease = now - self.last_decrease >= PACER_COOLDOWN_SECONDS
+            if decrease:
+                self.last_decrease = now
+        
+        rate = self.call_backend('adjust', factor=PACER_DECREASE_FACTOR if decrease else None, pause=pause)
+        with self.lock:
+            self.current_rate = rate
+        
+        if decrease:
+            logger.warning(f"🐢 Upstream throttled us: pausing {pause:.1f}s, rate now {rate:.2f}/s")
+    
+    def on_response(self, headers):
+        """Follow X-RateLimit-* headers: pause when the quota is spent, else spread what is left"""
+        if not self.enabled:
+            return
+        
+        remaining, reset_seconds = parse_rate_limit_headers(headers)
+        if remaining is None:
+            return
+        
+        if remaining <= 0:
+            rate = self.call_backend('adjust', pause=reset_seconds)
+        elif reset_seconds > 0 and remaining / reset_seconds < self.current_rate * 0.9:
+            rate = self.call_backend('adjust', rate=remaining / reset_seconds)
+        else:
+            return
+        
+        with self.lock:
+            self.current_rate = rate
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'max_rate': self.max_rate,
+                'rate': round(self.current_rate, 3),
+                'granted': self.granted,
+                'avg_wait': round(self.total_wait / max(self.granted, 1), 3),
+                'throttles': self.throttles,
+                'backend_errors': self.backend_errors,
+                'using_fallback': self.using_fallback,
+                'fallback_rate': round(self.max_rate / RATE_LIMIT_INSTANCES, 3),
+                'fallback_calls': self.fallback_calls
+            }
+
+def create_rate_limit_backend():
+    """Build the token bucket store from RATE_LIMIT_BACKEND"""
+    if RATE_LIMIT_BACKEND == 'http':
+        # Without a URL or token every call would fail over to RateLimiter's reduced local bucket
+        if not RATE_LIMIT_SERVICE_URL or not SERVICE_TOKEN:
+            raise ValueError("RATE_LIMIT_BACKEND=http needs RATE_LIMIT_SERVICE_URL and SERVICE_TOKEN")
+        return HttpRateLimitBackend(RATE_LIMIT_SERVICE_URL, SERVICE_TOKEN)
+    if RATE_LIMIT_BACKEND == 'sqlite':
+        return SqliteRateLimitBackend(RATE_LIMIT_DB, UPSTREAM_RATE_LIMIT, UPSTREAM_BURST)
+    if RATE_LIMIT_BACKEND == 'memory':
+        return MemoryRateLimitBackend(UPSTREAM_RATE_LIMIT, UPSTREAM_BURST)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND!r} (use 'memory', 'sqlite' or 'http')")
+
+class ApiKey:
+    """One upstream API key with its own rate limiter and health state"""
+    
+    def __init__(self, token, backend, bucket=None):
+        self.token = token
+        # Metrics, logs and shared bucket names use a fingerprint, never the token itself
+        self.fingerprint = hashlib.sha256(token.encode()).hexdigest()[:8]
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.limiter = RateLimiter(bucket or f"bdcourier:{self.fingerprint}", UPSTREAM_RATE_LIMIT, UPSTREAM_BURST, backend)
+        self.cooling_until = 0.0
+        self.rejections = 0
+    
+    def cooling_down(self, now=None):
+        return self.cooling_until > (now if now is not None else time.monotonic())
+
+class ApiKeyPool:
+    """Spreads upstream requests over every key in API_KEYS
+    
+    Each key paces itself with its own token bucket (UPSTREAM_RATE_LIMIT per key, so
+    throughput grows with the number of keys). A lookup takes the next key in turn
+    whose bucket has a token, skipping keys that are cooling down: a 429 pauses that
+    key's bucket for Retry-After, and a key the upstream refuses outright (401/403)
+    sits out for KEY_REJECTED_COOLDOWN unless it is the last one left.
+    """
+    
+    def __init__(self, tokens, backend):
+        # A lone key keeps the original bucket name so existing shared buckets still apply
+        if len(tokens) == 1:
+            self.keys = [ApiKey(tokens[0], backend, bucket="bdcourier")]
+        else:
+            self.keys = [ApiKey(token, backend) for token in tokens]
+        self.lock = Lock()
+        self.next_index = 0
+    
+    @property
+    def enabled(self):
+        return UPSTREAM_RATE_LIMIT > 0
+    
+    def reserve(self):
+        """Pick a key with capacity; returns (key, wait), or (None, seconds until one may have some)"""
+        with self.lock:
+            start = self.next_index
+            self.next_index = (self.next_index + 1) % len(self.keys)
+        
+        now = time.monotonic()
+        retry_in = None
+        for offset in range(len(self.keys)):
+            key = self.keys[(start + offset) % len(self.keys)]
+            if key.cooling_down(now):
+                wait = key.cooling_until - now
+            else:
+                wait, granted = key.limiter.reserve()
+                if granted:
+                    return key, wait
+            retry_in = wait if retry_in is None else min(retry_in, wait)
+        
+        return None, retry_in
+    
+    def acquire(self, job=None):
+        """Block until some key may send one request; returns the key, or None if the job is cancelled first"""
+        while True:
+            key, wait = self.reserve()
+            if wait > 0 and interruptible_sleep(wait, job):
+                return None
+            if key is not None:
+                return key
+    
+    async def acquire_async(self, job=None):
+        """acquire() for coroutines; the backend calls run off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            key, wait = await loop.run_in_executor(None, self.reserve)
+            if wait > 0 and await interruptible_sleep_async(wait, job):
+                return None
+            if key is not None:
+                return key
+    
+    def reject(self, key):
+        """The upstream refused this key: bench it for KEY_REJECTED_COOLDOWN
+        
+        Returns True if another key can take over the request. The last usable key is
+        never benched, so a bad configuration fails lookups instead of stalling them.
+        """
+        with self.lock:
+            key.rejections += 1
+            now = time.monotonic()
+            if key.cooling_down(now):
+                return True
+            if not any(not other.cooling_down(now) for other in self.keys if other is not key):
+                return False
+            key.cooling_until = now + KEY_REJECTED_COOLDOWN
+        
+        logger.warning(f"🔑 API key {key.fingerprint} was refused by the upstream; cooling down for {KEY_REJECTED_COOLDOWN:.0f}s")
+        return True
+    
+    def stats(self):
+        now = time.monotonic()
+        keys = []
+        for key in self.keys:
+            entry = {'key': key.fingerprint, 'healthy': not key.cooling_down(now), 'rejections': key.rejections}
+            if key.cooling_down(now):
+                entry['cooldown_seconds'] = round(key.cooling_until - now, 1)
+            entry.update(key.limiter.stats())
+            keys.append(entry)
+        
+        return {
+            'keys': len(self.keys),
+            'healthy': sum(entry['healthy'] for entry in keys),
+            'rate': round(sum(entry['rate'] for entry in keys if entry['healthy']), 3),
+            'using_fallback': any(entry['using_fallback'] for entry in keys),
+            'per_key': keys
+        }
+
+api_keys = ApiKeyPool(API_KEYS, create_rate_limit_backend())
+
+# The bucket this instance hands out when acting as the shared /ratelimit service
+if RATE_LIMIT_SERVICE_ENABLED and not SERVICE_TOKEN:
+    raise ValueError("RATE_LIMIT_SERVICE_ENABLED=1 needs SERVICE_TOKEN, or anyone could drain or pause the shared bucket")
+service_limit_backend = (
+    SqliteRateLimitBackend(RATE_LIMIT_DB, UPSTREAM_RATE_LIMIT, UPSTREAM_BURST)
+    if RATE_LIMIT_SERVICE_ENABLED else None
+)
+
+# The Authorization header is added per request by the key the lookup was given
+API_HEADERS = {
+    "Content-Type": "application/json",
+    "User-Agent": "BD-Courier-Checker/1.0"
+}
+
+class UpstreamPoolMixin:
+    """urllib3 pool that reports checkouts and waits to upstream_connections"""
+    
+    def _get_conn(self, timeout=None):
+        # Every connection is out when the queue is empty, so this checkout will wait
+        start = time.monotonic() if self.pool is not None and self.pool.empty() else None
+        conn = super()._get_conn(timeout)
+        upstream_connections.record_checkout(waited=time.monotonic() - start if start is not None else 0.0)
+        return conn
+    
+    def warm(self, count):
+        """Open up to `count` connections (TCP + TLS) and park them in the pool"""
+        conns = [self._get_conn() for _ in range(count)]
+        try:
+            for conn in conns:
+                conn.connect()
+        finally:
+            for conn in conns:
+                self._put_conn(conn)
+        return len(conns)
+
+class UpstreamConnectionMixin:
+    """urllib3 connection that reports every setup (TCP + TLS) and how long it took
+    
+    Counted here rather than when the pool creates the object: a pooled connection
+    whose socket was dropped reconnects on the same object.
+    """
+    
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        connect_latency.record(time.monotonic() - start)
+        upstream_connections.count('new_connections')
+
+class UpstreamHTTPConnection(UpstreamConnectionMixin, HTTPConnection):
+    pass
+
+class UpstreamHTTPSConnection(UpstreamConnectionMixin, HTTPSConnection):
+    pass
+
+class UpstreamHTTPConnectionPool(UpstreamPoolMixin, HTTPConnectionPool):
+    ConnectionCls = UpstreamHTTPConnection
+
+class UpstreamHTTPSConnectionPool(UpstreamPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = UpstreamHTTPSConnection
+
+# When the HTTP/2 client started its current connect; trace events of one request run in one task
+http2_connect_started = contextvars.ContextVar('http2_connect_started', default=None)
+HTTP2_CONNECT_DONE = 'connection.start_tls.complete' if API_URL.startswith('https') else 'connection.connect_tcp.complete'
+
+class UpstreamConnections:
+    """This process's HTTP connections to the upstream, shared by per-thread sessions
+    
+    Created lazily and re-created after a fork (the PID is checked on every use).
+    One HTTPAdapter, whose urllib3 pool is thread-safe and sized for the governor's
+    ceiling, is mounted on a requests.Session per thread; a reaper thread closes the
+    pool's connections once they have sat idle for CONNECTION_IDLE_SECONDS. With
+    UPSTREAM_TRANSPORT=http2 none of this is used: see async_engine.http2.
+    """
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.local = threading.local()
+        self.adapter = None
+        self.pid = None
+        self.http2_streams = 0
+        self.last_used = time.monotonic()
+        self.sessions = 0
+        self.checkouts = 0
+        self.new_connections = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.warmed = 0
+        self.reaped = 0
+    
+    def get_adapter(self):
+        """This process's shared adapter, creating it (and the reaper) if needed"""
+        with self.lock:
+            if self.adapter is None or self.pid != os.getpid():
+                self.adapter = create_upstream_adapter()
+                self.pid = os.getpid()
+                Thread(target=self.reap_loop, args=(self.adapter,), name="connection-reaper", daemon=True).start()
+            return self.adapter
+    
+    def session(self):
+        """The calling thread's session"""
+        adapter = self.get_adapter()
+        session = getattr(self.local, 'session', None)
+        if session is None or getattr(self.local, 'adapter', None) is not adapter:
+            session = create_robust_session(adapter)
+            self.local.session = session
+            self.local.adapter = adapter
+            self.count('sessions')
+        return session
+    
+    async def trace_http2(self, event, info):
+        """httpcore trace hook: count connections the HTTP/2 client opens, and time their setup"""
+        if event == 'connection.connect_tcp.started':
+            http2_connect_started.set(time.monotonic())
+        elif event == 'connection.connect_tcp.complete':
+            self.count('new_connections')
+        
+        # Setup ends after the TLS handshake, or with the TCP connect on plain http://
+        if event == HTTP2_CONNECT_DONE and http2_connect_started.get() is not None:
+            connect_latency.record(time.monotonic() - http2_connect_started.get())
+            http2_connect_started.set(None)
+    
+    def record_response(self, response):
+        """Count an httpx answer as a checkout, and as a stream if it came over HTTP/2"""
+        self.record_checkout()
+        if response.http_version == 'HTTP/2':
+            self.count('http2_streams')
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+    
+    def record_checkout(self, waited=0.0):
+        """Count one connection handed to a request, and how long it waited for a free one"""
+        with self.lock:
+            self.checkouts += 1
+            self.last_used = time.monotonic()
+            if waited > 0:
+                self.waits += 1
+                self.wait_seconds += waited
+    
+    def warm_up(self, count=WARMUP_CONNECTIONS):
+        """Open connections to the upstream ahead of the first job"""
+        if count <= 0:
+            return
+        
+        try:
+            adapter = self.get_adapter()
+            pool = adapter.poolmanager.connection_from_url(API_URL)
+            adapter.cert_verify(pool, API_URL, True, None)  # Same TLS settings requests will use
+            warmed = pool.warm(min(count, UPSTREAM_POOL_SIZE))
+            self.count('warmed', warmed)
+            logger.info(f"🔥 Warmed {warmed} upstream connections in process {os.getpid()}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not warm upstream connections: {str(e)}")
+    
+    def reap_loop(self, adapter):
+        while adapter is self.adapter:
+            time.sleep(CONNECTION_IDLE_SECONDS / 2)
+            with self.lock:
+                idle = time.monotonic() - self.last_used >= CONNECTION_IDLE_SECONDS
+            if idle and adapter.poolmanager.pools:
+                adapter.poolmanager.clear()
+                self.count('reaped')
+                logger.info(f"🧹 Closed idle upstream connections in process {os.getpid()}")
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'transport': UPSTREAM_TRANSPORT,
+                'pool_size': UPSTREAM_POOL_SIZE,
+                'sessions': self.sessions,
+                'checkouts': self.checkouts,
+                'hits': max(self.checkouts - self.new_connections, 0),
+                'new_connections': self.new_connections,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'warmed': self.warmed,
+                'reaped': self.reaped,
+                'http2_streams': self.http2_streams
+            }
+
+upstream_connections = UpstreamConnections()
+
+def upstream_origin():
+    """Scheme, host and port of API_URL, for requests that only open connections"""
+    parts = urlsplit(API_URL)
+    return f"{parts.scheme}://{parts.netloc}/"
+
+def create_http2_client():
+    """The httpx.AsyncClient behind UPSTREAM_TRANSPORT=http2
+    
+    HTTP/2 is negotiated over TLS (ALPN) and lookups share a connection as streams;
+    an upstream that only offers HTTP/1.1 gets up to UPSTREAM_POOL_SIZE connections,
+    as with the requests adapter. Idle connections close after CONNECTION_IDLE_SECONDS.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        http1=not HTTP2_PRIOR_KNOWLEDGE,
+        headers=API_HEADERS,
+        timeout=httpx.Timeout(API_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_POOL_SIZE,
+            max_keepalive_connections=UPSTREAM_POOL_SIZE,
+            keepalive_expiry=CONNECTION_IDLE_SECONDS
+        )
+    )
+
+def http2_timeout(timeout):
+    """requests-style (connect, read) timeouts as an httpx.Timeout"""
+    connect, read = timeout
+    return httpx.Timeout(read, connect=connect, pool=API_TIMEOUT)
+
+# What each transport raises for an upstream timeout, and for any other failed request
+UPSTREAM_TIMEOUT_ERRORS = (requests.exceptions.Timeout, asyncio.TimeoutError) + ((httpx.TimeoutException,) if httpx else ())
+UPSTREAM_REQUEST_ERRORS = (
+    (requests.exceptions.RequestException,)
+    + ((aiohttp.ClientError,) if aiohttp else ())
+    + ((httpx.TransportError,) if httpx else ())
+)
+
+def create_upstream_adapter():
+    """HTTPAdapter with one thread-safe pool sized for the governor and no transport-level retries"""
+    # No retries in urllib3: LookupAttempts owns the whole retry policy
+    retry_strategy = Retry(total=0, raise_on_status=False)
+    
+    adapter = HTTPAdapter(
+        max_retries=retry_strategy,
+        pool_connections=2,                 # Pools kept per host; the upstream is one host
+        pool_maxsize=UPSTREAM_POOL_SIZE,    # Connections per pool: every call the governor may allow
+        pool_block=True                     # Wait for a free connection rather than open extras
+    )
+    adapter.poolmanager.pool_classes_by_scheme = {'http': UpstreamHTTPConnectionPool, 'https': UpstreamHTTPSConnectionPool}
+    return adapter
+
+def create_robust_session(adapter=None):
+    """Create a session on the shared upstream adapter (or a fresh one)"""
+    session = requests.Session()
+    adapter = adapter or create_upstream_adapter()
+    
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    
+    session.headers.update(API_HEADERS)
+    
+    return session
+
+def allowed_file(filename):
+    """Check if file extension is allowed"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+@lru_cache(maxsize=1000)
+def validate_phone_number(phone):
+    """Validate Bangladesh phone number format with caching"""
+    phone_clean = re.sub(r'\D', '', phone)
+    
+    if len(phone_clean) == 11 and phone_clean.startswith('01'):
+        return phone_clean
+    elif len(phone_clean) == 13 and phone_clean.startswith('880'):
+        return phone_clean[2:]
+    return None
+
+def get_cached_result(phone, job=None, allow_stale=True):
+    """Cached (data, error) for a phone, or None
+    
+    Looks in phone_cache, then in the snapshot, then in the job's bulk read of
+    shared_cache (or, without one, in shared_cache itself); a hit below phone_cache
+    is copied into it, expired or not. With CACHE_STALE_SECONDS set, an entry that
+    expired less than that long ago is still returned, with 'stale' set in its data
+    for the report, and queued for revalidator to refresh.
+    """
+    result = phone_cache.get(phone)
+    if result is None:
+        entry = cache_snapshot.get(phone) if cache_snapshot is not None else None
+        
+        # The snapshot lags the shared cache, which may hold a fresher entry
+        if entry is None or entry[1] <= time.time():
+            if job is not None and job.prefetched is not None:
+                entry = job.prefetched.pop(phone, None) or entry
+            elif shared_cache is not None:
+                entry = shared_cache.get(phone) or entry
+        
+        if entry is not None:
+            result, expires_at = entry
+            phone_cache.set(phone, result, ttl=expires_at - time.time())
+            if expires_at <= time.time():
+                result = None
+    
+    if result is None and allow_stale and CACHE_STALE_SECONDS:
+        result = phone_cache.get_stale(phone)
+        if result is not None:
+            revalidator.submit(phone)
+            record_stat(job, 'stale')
+            record_stat(job, 'cache_hits')
+            logger.info(f"🕰️ Stale cache hit for phone: {phone}, refreshing in the background")
+            data, error = result
+            return dict(data, stale=True), error
+    
+    if result is not None:
+        # A refresh (allow_stale=False) checking for a newer entry is not a lookup served from cache
+        if allow_stale:
+            record_stat(job, 'cache_hits')
+        logger.info(f"Cache hit for phone: {phone}")
+    return result
+
+def record_lookup_success(phone, data, job, elapsed, attempt, counted=True):
+    """Cache and count a successful lookup; returns its (data, None) result"""
+    result = (data, None)
+    
+    # Cache successful result, here and for the other workers
+    phone_cache.set(phone, result)
+    if shared_cache is not None:
+        shared_cache.put(phone, result)
+    
+    if counted:
+        record_stat(job, 'success')
+    
+    logger.info(f"✅ API success for {phone} took {elapsed:.2f}s (attempt {attempt + 1})")
+    return result
+
+def record_lookup_failure(phone, job, last_error, counted=True):
+    """Count a lookup whose attempts all failed; returns its (None, error) result"""
+    if counted:
+        record_stat(job, 'failed')
+    
+    logger.error(f"❌ All attempts failed for {phone}: {last_error}")
+    return None, last_error
+
+def retry_delay(previous):
+    """Decorrelated jitter: a random delay between BASE_DELAY and BACKOFF_FACTOR x the previous one"""
+    return min(RETRY_MAX_DELAY, random.uniform(BASE_DELAY, max(previous, BASE_DELAY) * BACKOFF_FACTOR))
+
+class LookupAttempts:
+    """Retry policy for one phone lookup, shared by the thread and asyncio engines
+    
+    The engines only send requests and report what came back; this decides whether
+    the lookup succeeded, failed for good or should be retried, and after how long.
+    A refresh of a stale cache entry is counted by revalidator, not processing_stats.
+    """
+    
+    def __init__(self, phone, job=None, max_attempts=MAX_RETRIES, refresh=False):
+        self.phone = phone
+        self.job = job
+        self.max_attempts = max_attempts
+        self.refresh = refresh
+        self.budget = job.retry_budget if job is not None else default_retry_budget
+        self.attempt = 0
+        self.delay = 0.0
+        self.last_error = None
+        self.retryable = False
+        self.throttled = False
+        self.probe = False
+        self.key = None
+        self.reserved = None  # Key whose token was taken ahead of time (threads engine)
+        self.result = None
+        self.budget.record_first_attempt()
+    
+    def check_circuit(self, peek=False):
+        """0 if the circuit breaker admits the next attempt, seconds to park, or None to fail fast"""
+        allowed, probe, wait = circuit_breaker.admit(peek)
+        if allowed:
+            if not peek:
+                self.probe = probe
+            return 0
+        
+        if BREAKER_MODE == 'park':
+            return wait
+        
+        self.last_error = "Upstream unavailable (circuit open)"
+        self.retryable = True
+        return None
+    
+    def on_response(self, status_code, headers, elapsed, data=None, text=''):
+        """Handle an upstream answer; sets self.result on success"""
+        observe_upstream(status_code, elapsed)
+        circuit_breaker.record(status_code < 500 and status_code != 408, self.probe)
+        
+        if status_code == 200:
+            self.key.limiter.on_response(headers)
+            self.result = record_lookup_success(self.phone, data, self.job, elapsed, self.attempt, counted=not self.refresh)
+            return
+        
+        self.retryable = retryable_status(status_code)
+        self.throttled = status_code == 429
+        
+        if self.throttled:
+            self.last_error = "Rate limit exceeded"
+            logger.warning(f"⚠️ Rate limit hit for {self.phone} on key {self.key.fingerprint} (attempt {self.attempt + 1})")
+            
+            # Pause and slow this key's pacer instead of sleeping here; other keys carry on
+            self.key.limiter.on_throttle(headers)
+        elif status_code in KEY_REJECTED_STATUS_CODES:
+            self.last_error = f"API key refused ({status_code})"
+            logger.warning(f"⚠️ API key {self.key.fingerprint} refused for {self.phone} (attempt {self.attempt + 1})")
+            
+            # Worth another attempt only if a different key can send it
+            self.retryable = api_keys.reject(self.key)
+        else:
+            self.last_error = f"API Error {status_code}: {text[:100]}"
+            logger.warning(f"⚠️ API error {status_code} for {self.phone} (attempt {self.attempt + 1})")
+    
+    def on_timeout(self):
+        self.last_error = "Request timeout"
+        self.retryable = True
+        self.throttled = False
+        observe_upstream(timed_out=True)
+        circuit_breaker.record(False, self.probe)
+        logger.warning(f"⚠️ Timeout for phone {self.phone} (attempt {self.attempt + 1})")
+    
+    def on_request_error(self, e):
+        self.last_error = f"Request failed: {str(e)}"
+        self.retryable = True
+        self.throttled = False
+        circuit_breaker.record(False, self.probe)
+        logger.warning(f"⚠️ Request exception for phone {self.phone} (attempt {self.attempt + 1}): {str(e)}")
+    
+    def on_bad_response(self, e):
+        # The upstream answered 200 with a body that is not JSON; asking again would not help
+        self.last_error = f"Invalid response: {str(e)}"
+        self.retryable = False
+        self.throttled = False
+        circuit_breaker.release(self.probe)
+        logger.error(f"❌ Invalid JSON for phone {self.phone} (attempt {self.attempt + 1}): {str(e)}")
+    
+    def on_unexpected_error(self, e):
+        self.last_error = f"Unexpected error: {str(e)}"
+        self.retryable = False  # Don't retry on unexpected errors
+        circuit_breaker.release(self.probe)
+        logger.error(f"❌ Unexpected error for phone {self.phone} (attempt {self.attempt + 1}): {str(e)}")
+    
+    def next_retry(self):
+        """After a failed attempt: seconds to wait before retrying, or None to give up"""
+        if not self.retryable or self.attempt >= self.max_attempts:
+            return None
+        
+        if BREAKER_MODE == 'fail' and circuit_breaker.is_open:
+            self.last_error = f"{self.last_error} (circuit open)"
+            return None
+        
+        time_left = self.job.time_left() if self.job is not None else None
+        if time_left is not None and time_left < DEADLINE_REPORT_RESERVE + BASE_DELAY:
+            self.last_error = f"{self.last_error}{DEADLINE_GAVE_UP}"
+            self.retryable = False
+            return None
+        
+        if not self.budget.try_spend():
+            if not self.refresh:
+                record_stat(self.job, 'retries_denied')
+            self.last_error = f"{self.last_error}{BUDGET_GAVE_UP}"
+            return None
+        
+        self.attempt += 1
+        if not self.refresh:
+            record_stat(self.job, 'retries')
+        
+        # After a 429 the key's pacer has already paused for Retry-After, so getting a key is the wait:
+        # lookup_attempt parks the lookup in retry_scheduler for it rather than sleeping on a thread
+        if self.throttled and api_keys.enabled:
+            return 0
+        
+        self.delay = retry_delay(self.delay)
+        if time_left is not None:
+            self.delay = min(self.delay, time_left - DEADLINE_REPORT_RESERVE)
+        logger.info(f"Retry {self.attempt} for {self.phone} after {self.delay:.2f}s delay")
+        return self.delay
+    
+    def fail(self):
+        # Transient failures get another chance in the job's final sweep
+        if self.retryable and self.job is not None:
+            self.job.sweepable.add(self.phone)
+        return record_lookup_failure(self.phone, self.job, self.last_error, counted=not self.refresh)
+
+class Hedger:
+    """Races a second copy of lookups slower than the recent p95 (see HEDGE_*)
+    
+    Hedges are capped by their own budget (HEDGE_MAX_RATIO of primary requests) and
+    still wait for a rate limiter token, but ride on the primary's governor slot: a
+    stuck primary is exactly when no slot is free. The first answer wins and the
+    other request is abandoned.
+    """
+    
+    def __init__(self):
+        self.budget = RetryBudget(HEDGE_MAX_RATIO, minimum=1)
+        self.lock = Lock()
+        self.sent = 0
+        self.skipped = 0
+        self.wins = 0
+    
+    def delay(self):
+        """Seconds to wait for the primary before hedging, or None to send it unhedged"""
+        if not HEDGE_ENABLED:
+            return None
+        return upstream_latency.percentile(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+    
+    def stats(self):
+        delay = self.delay()
+        budget = self.budget.stats()
+        with self.lock:
+            return {
+                'enabled': HEDGE_ENABLED,
+                'delay_ms': round(delay * 1000, 1) if delay is not None else None,
+                'primaries': budget['first_attempts'],
+                'hedges_sent': self.sent,
+                'hedges_skipped': self.skipped,
+                'hedge_wins': self.wins,
+                'budget_denied': budget['denied']
+            }
+
+hedger = Hedger()
+
+def post_lookup(phone, timeout, key):
+    """One upstream request with (connect, read) timeouts; returns (response, elapsed, key)"""
+    start_time = time.time()
+    
+    if UPSTREAM_TRANSPORT == 'http2':
+        # httpx's HTTP/2 connections are not safe to share between threads, so hop onto the event loop
+        response = async_engine.run(post_http2(phone, timeout, key))
+    else:
+        response = upstream_connections.session().post(
+            API_URL,
+            params={"phone": phone},
+            headers=key.headers,
+            timeout=timeout
+        )
+    
+    return response, time.time() - start_time, key
+
+def post_hedge(phone, job, primary, timeout):
+    """The hedge copy of a lookup, on whichever key has capacity; returns None if it was not sent"""
+    key = api_keys.acquire(job)
+    if key is None or primary.done():
+        hedger.count('skipped')
+        return None
+    
+    hedger.count('sent')
+    return post_lookup(phone, timeout, key)
+
+def retryable_status(status_code):
+    """Whether an upstream status is worth another attempt (see RETRYABLE_STATUS_CODES)"""
+    return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+
+def post_lookup_hedged(phone, timeout, key, job=None):
+    """post_lookup(), raced against a hedge request once it is slower than the recent p95"""
+    delay = hedger.delay()
+    if delay is None:
+        return post_lookup(phone, timeout, key)
+    
+    hedger.budget.record_first_attempt()
+    pool = get_hedge_executor()
+    primary = pool.submit(post_lookup, phone, timeout, key)
+    
+    try:
+        return primary.result(timeout=delay)
+    except concurrent.futures.TimeoutError:
+        pass
+    
+    if not hedger.budget.try_spend():
+        return primary.result()
+    
+    hedge = pool.submit(post_hedge, phone, job, primary, timeout)
+    pending = {primary, hedge}
+    fallback = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        answered = [future for future in done if future.exception() is None and future.result() is not None]
+        
+        # A 5xx/429 only wins once the other request has nothing better
+        good = [future for future in answered if not retryable_status(future.result()[0].status_code)]
+        if good or (answered and not pending):
+            winner = (good or answered)[0]
+            if winner is hedge:
+                hedger.count('wins')
+            return winner.result()
+        fallback = fallback or (answered[0] if answered else None)
+    
+    # Neither answered well: surface a retryable answer, else the primary's error
+    return (fallback or primary).result()
+
+async def post_http2(phone, timeout, key):
+    """One upstream request on the HTTP/2 client; returns the httpx response"""
+    response = await async_engine.http2.post(
+        API_URL,
+        params={"phone": phone},
+        headers=key.headers,
+        timeout=http2_timeout(timeout),
+        extensions={'trace': upstream_connections.trace_http2}
+    )
+    upstream_connections.record_response(response)
+    return response
+
+async def post_lookup_async(phone, timeout, key):
+    """One upstream request on the asyncio engine; returns (status_code, headers, data, text, elapsed, key)"""
+    start_time = time.time()
+    data, text = None, ''
+    
+    if async_engine.http2 is not None:
+        response = await post_http2(phone, timeout, key)
+        if response.status_code == 200:
+            data = response.json()
+        else:
+            text = response.text
+        return response.status_code, response.headers, data, text, time.time() - start_time, key
+    
+    connect, read = timeout
+    client_timeout = aiohttp.ClientTimeout(total=API_TIMEOUT, sock_connect=connect, sock_read=read)
+    
+    async with async_engine.http.post(API_URL, params={"phone": phone}, headers=key.headers, timeout=client_timeout) as response:
+        status_code = response.status
+        headers = response.headers
+        if status_code == 200:
+            data = await response.json(content_type=None)
+        else:
+            text = await response.text()
+    
+    return status_code, headers, data, text, time.time() - start_time, key
+
+async def post_hedge_async(phone, job, primary, timeout):
+    """post_hedge() for the asyncio engine"""
+    key = await api_keys.acquire_async(job)
+    if key is None or primary.done():
+        hedger.count('skipped')
+        return None
+    
+    hedger.count('sent')
+    return await post_lookup_async(phone, timeout, key)
+
+async def post_lookup_hedged_async(phone, timeout, key, job=None):
+    """post_lookup_hedged() for the asyncio engine; the losing request is cancelled"""
+    delay = hedger.delay()
+    if delay is None:
+        return await post_lookup_async(phone, timeout, key)
+    
+    hedger.budget.record_first_attempt()
+    primary = asyncio.ensure_future(post_lookup_async(phone, timeout, key))
+    
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not hedger.budget.try_spend():
+        return await primary
+    
+    hedge = asyncio.ensure_future(post_hedge_async(phone, job, primary, timeout))
+    pending = {primary, hedge}
+    fallback = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            answered = [task for task in done if task.exception() is None and task.result() is not None]
+            
+            # A 5xx/429 only wins once the other request has nothing better
+            good = [task for task in answered if not retryable_status(task.result()[0])]
+            if good or (answered and not pending):
+                winner = (good or answered)[0]
+                if winner is hedge:
+                    hedger.count('wins')
+                return winner.result()
+            fallback = fallback or (answered[0] if answered else None)
+        
+        # Neither answered well: surface a retryable answer, else the primary's error
+        return (fallback or primary).result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+def lookup_attempt(lookup):
+    """Make one attempt of a lookup on the threads engine
+    
+    Returns (result, None) once the lookup is finished, or (None, seconds) when it
+    should be attempted again after that long; the caller decides how to wait.
+    """
+    phone, job = lookup.phone, lookup.job
+    
+    if job is not None and job.cancelled:
+        return (None, "Cancelled"), None
+    
+    # While the circuit is open, fail fast or park until it half-opens
+    wait = lookup.check_circuit(peek=True)
+    if wait is None:
+        return lookup.fail(), None
+    if wait:
+        return None, wait
+    
+    # Take a key with room in its cross-worker request rate without blocking; if its token is not
+    # due yet (or every key is paused after a 429) the caller waits, e.g. in retry_scheduler
+    if lookup.reserved is not None:
+        lookup.key, lookup.reserved = lookup.reserved, None
+    else:
+        key, wait = api_keys.reserve()
+        if key is None or wait > 0:
+            lookup.reserved = key
+            return None, wait
+        lookup.key = key
+    
+    # Then wait for a concurrency slot
+    if not outbound_governor.acquire(job):
+        return (None, "Cancelled"), None
+    
+    # The circuit may have opened while we queued; half-open admits only a few probes
+    wait = lookup.check_circuit()
+    if wait != 0:
+        outbound_governor.release(job)
+        if wait is None:
+            return lookup.fail(), None
+        return None, wait
+    
+    try:
+        try:
+            response, elapsed, lookup.key = post_lookup_hedged(phone, request_timeouts(lookup.attempt), lookup.key, job)
+        finally:
+            outbound_governor.release(job)
+        
+        # requests' JSONDecodeError is also a RequestException, so catch it before those
+        try:
+            data = response.json() if response.status_code == 200 else None
+        except ValueError as e:
+            lookup.on_bad_response(e)
+        else:
+            lookup.on_response(response.status_code, response.headers, elapsed, data, response.text)
+        
+    except UPSTREAM_TIMEOUT_ERRORS:
+        lookup.on_timeout()
+        
+    except UPSTREAM_REQUEST_ERRORS as e:
+        lookup.on_request_error(e)
+        
+    except Exception as e:
+        lookup.on_unexpected_error(e)
+    
+    if lookup.result is not None:
+        return lookup.result, None
+    
+    delay = lookup.next_retry()
+    if delay is None:
+        return lookup.fail(), None
+    
+    return None, delay
+
+def check_courier_api_with_retry(phone, max_attempts=MAX_RETRIES, job=None):
+    """API call with intelligent retry logic and rate limiting, waiting between attempts in this thread
+    
+    Jobs on the threads engine use DeferredLookup instead, which gives the thread back while it waits.
+    """
+    
+    # Check cache first
+    cached = get_cached_result(phone, job)
+    if cached is not None:
+        return cached
+    
+    lookup = LookupAttempts(phone, job, max_attempts)
+    
+    while True:
+        result, wait = lookup_attempt(lookup)
+        if result is not None:
+            return result
+        
+        if wait and interruptible_sleep(wait, job):
+            return None, "Cancelled"
+
+class Revalidator:
+    """Refreshes cache entries that were served stale, in the background
+    
+    A stale hit queues its number (once, however many jobs hit it), and
+    REVALIDATE_WORKERS threads in each process look it up through single_flight,
+    so a job's lookup of the same number shares it, with the same key pacing,
+    governor and circuit breaker as a job's lookups; the fresh result replaces the
+    stale one in every cache tier. Numbers another worker has already refreshed are
+    skipped. Refreshes are counted here only, not in processing_stats.
+    """
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.queue = None
+        self.pending = set()
+        self.pid = None
+        self.queued = 0
+        self.refreshed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.dropped = 0
+    
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+    
+    def submit(self, phone):
+        """Queue a refresh of phone unless one is already queued"""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue(maxsize=REVALIDATE_QUEUE_SIZE)
+                self.pending = set()
+                for index in range(REVALIDATE_WORKERS):
+                    Thread(target=self.worker_loop, name=f"revalidator-{index}", daemon=True).start()
+            
+            if phone in self.pending:
+                return
+            try:
+                self.queue.put_nowait(phone)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self.pending.add(phone)
+            self.queued += 1
+    
+    def worker_loop(self):
+        refresh_queue = self.queue
+        while True:
+            phone = refresh_queue.get()
+            try:
+                self.refresh(phone)
+            except Exception as e:
+                self.count('failed')
+                logger.error(f"❌ Refreshing stale entry for {phone} failed: {str(e)}")
+            finally:
+                with self.lock:
+                    self.pending.discard(phone)
+    
+    def refresh(self, phone):
+        if get_cached_result(phone, allow_stale=False) is not None:
+            self.count('skipped')
+            return
+        
+        data, error = single_flight.submit(phone, refresh=True).result()
+        self.count('refreshed' if data is not None else 'failed')
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'stale_seconds': CACHE_STALE_SECONDS,
+                'workers': REVALIDATE_WORKERS,
+                'pending': len(self.pending),
+                'queued': self.queued,
+                'refreshed': self.refreshed,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'dropped': self.dropped
+            }
+
+revalidator = Revalidator()
+
+async def check_courier_api_async(phone, max_attempts=MAX_RETRIES, job=None, refresh=False):
+    """asyncio twin of check_courier_api_with_retry: same cache, pacing and retry policy"""
+    
+    loop = asyncio.get_running_loop()
+    
+    # Check cache first (a refresh only takes a fresh entry someone else fetched). Without
+    # the job's bulk read it may hit shared_cache, so that read runs off the event loop
+    if shared_cache is not None and (job is None or job.prefetched is None):
+        cached = await loop.run_in_executor(None, get_cached_result, phone, job, not refresh)
+    else:
+        cached = get_cached_result(phone, job, allow_stale=not refresh)
+    if cached is not None:
+        return cached
+    
+    lookup = LookupAttempts(phone, job, max_attempts, refresh=refresh)
+    
+    while True:
+        if job is not None and job.cancelled:
+            return None, "Cancelled"
+        
+        wait = lookup.check_circuit(peek=True)
+        if wait is None:
+            return lookup.fail()
+        if wait:
+            if await interruptible_sleep_async(wait, job):
+                return None, "Cancelled"
+            continue
+        
+        lookup.key = await api_keys.acquire_async(job)
+        if lookup.key is None:
+            return None, "Cancelled"
+        
+        if not await outbound_governor.acquire_async(job):
+            return None, "Cancelled"
+        
+        wait = lookup.check_circuit()
+        if wait != 0:
+            outbound_governor.release(job)
+            if wait is None:
+                return lookup.fail()
+            if await interruptible_sleep_async(wait, job):
+                return None, "Cancelled"
+            continue
+        
+        try:
+            try:
+                status_code, headers, data, text, elapsed, lookup.key = await post_lookup_hedged_async(
+                    phone, request_timeouts(lookup.attempt), lookup.key, job
+                )
+            finally:
+                outbound_governor.release(job)
+            
+            # The pacer may hit SQLite or the rate limit service, so keep it off the loop
+            await loop.run_in_executor(None, lookup.on_response, status_code, headers, elapsed, data, text)
+        
+        except UPSTREAM_TIMEOUT_ERRORS:
+            lookup.on_timeout()
+        
+        except UPSTREAM_REQUEST_ERRORS as e:
+            lookup.on_request_error(e)
+        
+        except ValueError as e:
+            lookup.on_bad_response(e)
+        
+        except Exception as e:
+            lookup.on_unexpected_error(e)
+        
+        if lookup.result is not None:
+            return lookup.result
+        
+        delay = lookup.next_retry()
+        if delay is None:
+            return lookup.fail()
+        
+        if delay and await interruptible_sleep_async(delay, job):
+            return None, "Cancelled"
+
+class AsyncLookupEngine:
+    """Event loop thread that runs lookups as coroutines over one aiohttp session
+    
+    Thousands of lookups (and their backoff timers) can wait here at once without a
+    thread each; upstream concurrency is still bounded by outbound_governor. With
+    UPSTREAM_TRANSPORT=http2 the loop also owns the httpx client, for both engines.
+    """
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self.http = None
+        self.http2 = None
+        self.submitted = 0
+    
+    def ensure_started(self):
+        """Start the loop and HTTP session in this process if needed"""
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                return self.loop
+            
+            self.loop = asyncio.new_event_loop()
+            self.pid = os.getpid()
+            self.thread = Thread(target=self.loop.run_forever, name="lookup-loop", daemon=True)
+            self.thread.start()
+            asyncio.run_coroutine_threadsafe(self.open_session(), self.loop).result()
+            logger.info(f"🧵 Started asyncio lookup engine in process {self.pid}")
+            return self.loop
+    
+    async def open_session(self):
+        # With UPSTREAM_TRANSPORT=http2 every lookup goes through httpx instead of aiohttp
+        if UPSTREAM_TRANSPORT == 'http2':
+            self.http2 = create_http2_client()
+            return
+        
+        # Report connection reuse and waits to the same counters as the threads engine
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(self.on_queued_start)
+        trace.on_connection_queued_end.append(self.on_queued_end)
+        trace.on_connection_create_start.append(self.on_connection_create_start)
+        trace.on_connection_create_end.append(self.on_connection_created)
+        trace.on_connection_reuseconn.append(self.on_connection_reused)
+        
+        self.http = aiohttp.ClientSession(
+            headers=API_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=UPSTREAM_POOL_SIZE, keepalive_timeout=CONNECTION_IDLE_SECONDS),
+            trace_configs=[trace]
+        )
+    
+    async def on_queued_start(self, session, context, params):
+        context.queued_at = time.monotonic()
+    
+    async def on_queued_end(self, session, context, params):
+        context.waited = time.monotonic() - context.queued_at
+    
+    async def on_connection_create_start(self, session, context, params):
+        context.connect_started = time.monotonic()
+    
+    async def on_connection_created(self, session, context, params):
+        connect_latency.record(time.monotonic() - context.connect_started)
+        upstream_connections.count('new_connections')
+        upstream_connections.record_checkout(waited=getattr(context, 'waited', 0.0))
+    
+    async def on_connection_reused(self, session, context, params):
+        upstream_connections.record_checkout(waited=getattr(context, 'waited', 0.0))
+    
+    def warm_up(self, count=WARMUP_CONNECTIONS):
+        """Open connections to the upstream ahead of the first job (HEAD requests to its origin)"""
+        if count <= 0:
+            return
+        
+        loop = self.ensure_started()
+        try:
+            warmed = asyncio.run_coroutine_threadsafe(self.warm_up_async(count), loop).result(timeout=API_TIMEOUT)
+            upstream_connections.count('warmed', warmed)
+            logger.info(f"🔥 Warmed {warmed} upstream connections in process {os.getpid()}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not warm upstream connections: {str(e)}")
+    
+    async def warm_up_async(self, count):
+        origin = upstream_origin()
+        
+        if self.http2 is not None:
+            # One connection carries every stream, unless the upstream turns out to be HTTP/1.1 only
+            await self.http2.head(origin, extensions={'trace': upstream_connections.trace_http2})
+            return 1
+        
+        async def open_one():
+            async with self.http.head(origin, allow_redirects=False):
+                pass
+        
+        results = await asyncio.gather(*(open_one() for _ in range(min(count, UPSTREAM_POOL_SIZE))), return_exceptions=True)
+        return sum(1 for result in results if not isinstance(result, Exception))
+    
+    def close(self):
+        """Close the HTTP session at exit so connections are released cleanly"""
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                return
+            loop, http, http2 = self.loop, self.http, self.http2
+        
+        try:
+            close = http2.aclose() if http2 is not None else http.close()
+            asyncio.run_coroutine_threadsafe(close, loop).result(timeout=5)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not close asyncio lookup session: {str(e)}")
+    
+    def run(self, coro):
+        """Run a coroutine on the loop and wait for its result in the calling thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.ensure_started()).result()
+    
+    def submit(self, phone, job=None, max_attempts=MAX_RETRIES, refresh=False):
+        """Schedule a lookup; returns a concurrent.futures.Future of (data, error)"""
+        loop = self.ensure_started()
+        with self.lock:
+            self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(check_courier_api_async(phone, max_attempts, job=job, refresh=refresh), loop)
+    
+    def stats(self):
+        if self.loop is None or self.pid != os.getpid():
+            return {'running': False}
+        
+        return {
+            'running': True,
+            'submitted': self.submitted,
+            'tasks': len(asyncio.all_tasks(self.loop))
+        }
+
+async_engine = AsyncLookupEngine()
+atexit.register(async_engine.close)
+
+def start_lookup(phone, job=None, refresh=False):
+    """Start one lookup on the configured engine; returns a concurrent.futures.Future
+    
+    refresh=True is revalidator's lookup of a stale entry: it skips stale cache hits
+    and gives up after REVALIDATE_MAX_ATTEMPTS.
+    """
+    max_attempts = REVALIDATE_MAX_ATTEMPTS if refresh else MAX_RETRIES
+    if LOOKUP_ENGINE == 'asyncio':
+        return async_engine.submit(phone, job=job, max_attempts=max_attempts, refresh=refresh)
+    return DeferredLookup(phone, job=job, max_attempts=max_attempts, refresh=refresh).start()
+
+def stopped_by_job_limits(error):
+    """Whether a failed lookup stopped because of its job (cancelled, deadline, retry budget)
+    rather than because of the upstream"""
+    if error is None:
+        return False
+    return error in ("Cancelled", NOT_CHECKED_DEADLINE) or error.endswith((DEADLINE_GAVE_UP, BUDGET_GAVE_UP))
+
+class SingleFlight:
+    """Coalesces concurrent lookups of the same phone into one upstream lookup
+    
+    The first caller (the leader) starts the lookup; later callers get their own
+    Future that is completed from the leader's, so cancelling one job never cancels
+    another's lookup. If the leader stopped because of its own job's limits
+    (cancellation, deadline, retry budget), a waiting caller starts the lookup
+    again for its own job.
+    """
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.in_flight = {}
+        self.leaders = 0
+        self.coalesced = 0
+    
+    def submit(self, phone, job=None, refresh=False):
+        with self.lock:
+            # A finished leader may still be listed until its finished() callback runs
+            leader = self.in_flight.get(phone)
+            if leader is None or leader.done():
+                leader = start_lookup(phone, job=job, refresh=refresh)
+                leader.refresh = refresh
+                self.in_flight[phone] = leader
+                self.leaders += 1
+                follower = None
+            else:
+                follower = concurrent.futures.Future()
+        
+        if follower is None:
+            leader.add_done_callback(lambda future: self.finished(phone, future))
+            return leader
+        
+        leader.add_done_callback(lambda future: self.relay(future, follower, phone, job))
+        return follower
+    
+    def finished(self, phone, future):
+        with self.lock:
+            if self.in_flight.get(phone) is future:
+                del self.in_flight[phone]
+    
+    def relay(self, leader, follower, phone, job):
+        """Complete a waiting caller's Future from the leader's result"""
+        if follower.cancelled():
+            return
+        
+        try:
+            data, error = leader.result()
+        except concurrent.futures.CancelledError:
+            data, error = None, "Cancelled"
+        except Exception:
+            self.forward(follower, leader)
+            return
+        
+        # A background refresh gives up sooner than a job would, so a job retries it itself
+        gave_up = data is None and leader.refresh and job is not None
+        if (stopped_by_job_limits(error) or gave_up) and not (job is not None and job.cancelled):
+            # The leader's job ran out of time, budget or was cancelled, or its refresh gave up;
+            # none of that applies to this job, so look the number up for it instead
+            retry = self.submit(phone, job)
+            retry.add_done_callback(lambda future: self.forward(follower, future))
+            return
+        
+        with self.lock:
+            self.coalesced += 1
+        record_stat(job, 'coalesced')
+        if job is not None:
+            with stats_lock:
+                job.stats['success' if data is not None else 'failed'] += 1
+            job.notify()
+        
+        if follower.set_running_or_notify_cancel():
+            follower.set_result((data, error))
+    
+    def forward(self, follower, source):
+        if not follower.set_running_or_notify_cancel():
+            return
+        try:
+            follower.set_result(source.result())
+        except BaseException as e:
+            follower.set_exception(e)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.in_flight),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced
+            }
+
+single_flight = SingleFlight()
+
+def submit_lookup(phone, job=None):
+    """Start a lookup, or share the one already in flight for this phone"""
+    return single_flight.submit(phone, job=job)
+
+class InstrumentedThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor that tracks queue depth, busy threads and throughput"""
     
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
+    def __init__(self, max_workers, thread_name_prefix=''):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.counter_lock = Lock()
+        self.active = 0
+        self.submitted = 0
+        self.completed = 0
     
-    session.headers.update({
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json",
-        "User-Agent": "BD-Courier-Checker/1.0"
-    })
+    def submit(self, fn, *args, **kwargs):
+        with self.counter_lock:
+            self.submitted += 1
+        return super().submit(self.run_counted, fn, *args, **kwargs)
     
-    return session
+    def run_counted(self, fn, *args, **kwargs):
+        with self.counter_lock:
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.counter_lock:
+                self.active -= 1
+                self.completed += 1
+    
+    def stats(self):
+        with self.counter_lock:
+            return {
+                'max_workers': self._max_workers,
+                'threads': len(self._threads),
+                'active': self.active,
+                'queue_depth': self._work_queue.qsize(),
+                'submitted': self.submitted,
+                'completed': self.completed
+            }
 
-# Create global session
-session = create_robust_session()
+# Process-wide lookup pool, created once per worker process (after gunicorn forks)
+executor_lock = Lock()
+lookup_executor = None
+lookup_executor_pid = None
+hedge_executor = None
+hedge_executor_pid = None
 
-def allowed_file(filename):
-    """Check if file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def get_lookup_executor():
+    """Return this process's shared lookup pool, creating it if needed"""
+    global lookup_executor, lookup_executor_pid
+    
+    with executor_lock:
+        if lookup_executor is None or lookup_executor_pid != os.getpid():
+            lookup_executor = InstrumentedThreadPoolExecutor(
+                max_workers=LOOKUP_POOL_SIZE,
+                thread_name_prefix="lookup"
+            )
+            lookup_executor_pid = os.getpid()
+            logger.info(f"🧵 Started lookup pool with {LOOKUP_POOL_SIZE} threads in process {lookup_executor_pid}")
+        return lookup_executor
 
-@lru_cache(maxsize=1000)
-def validate_phone_number(phone):
-    """Validate Bangladesh phone number format with caching"""
-    phone_clean = re.sub(r'\D', '', phone)
+def get_hedge_executor():
+    """Return this process's pool for hedged requests, creating it if needed"""
+    global hedge_executor, hedge_executor_pid
     
-    if len(phone_clean) == 11 and phone_clean.startswith('01'):
-        return phone_clean
-    elif len(phone_clean) == 13 and phone_clean.startswith('880'):
-        return phone_clean[2:]
-    return None
+    with executor_lock:
+        if hedge_executor is None or hedge_executor_pid != os.getpid():
+            hedge_executor = InstrumentedThreadPoolExecutor(
+                max_workers=HEDGE_POOL_SIZE,
+                thread_name_prefix="hedge"
+            )
+            hedge_executor_pid = os.getpid()
+        return hedge_executor
 
-def check_courier_api_with_retry(phone, max_attempts=MAX_RETRIES):
-    """API call with intelligent retry logic and rate limiting"""
+class RetryScheduler:
+    """Time-ordered queue of callbacks waiting to run (a heap served by one timer thread)
     
-    # Check cache first
-    with cache_lock:
-        if phone in phone_cache:
-            logger.info(f"Cache hit for phone: {phone}")
-            return phone_cache[phone]
+    Threads-engine lookups park here between attempts instead of sleeping on a pool
+    thread. Entries of a cancelled job are released early so they can wind down.
+    """
     
-    last_error = None
+    def __init__(self):
+        self.cond = Condition()
+        self.heap = []
+        self.sequence = 0
+        self.thread = None
+        self.pid = None
+        self.scheduled = 0
+        self.fired = 0
     
-    for attempt in range(max_attempts + 1):
-        try:
-            # Progressive delay with jitter to avoid thundering herd
-            if attempt > 0:
-                delay = BASE_DELAY * (BACKOFF_FACTOR ** attempt) + random.uniform(0.1, 0.5)
-                logger.info(f"Retry {attempt} for {phone} after {delay:.2f}s delay")
-                time.sleep(delay)
-                
-                with stats_lock:
-                    processing_stats['retries'] += 1
-            
-            start_time = time.time()
-            
-            response = session.post(
-                API_URL,
-                params={"phone": phone},
-                timeout=API_TIMEOUT
-            )
-            
-            elapsed = time.time() - start_time
-            
-            if response.status_code == 200:
-                result = (response.json(), None)
-                
-                # Cache successful result
-                with cache_lock:
-                    phone_cache[phone] = result
-                
-                with stats_lock:
-                    processing_stats['success'] += 1
-                
-                logger.info(f"✅ API success for {phone} took {elapsed:.2f}s (attempt {attempt + 1})")
-                return result
-                
-            elif response.status_code == 429:
-                last_error = "Rate limit exceeded"
-                logger.warning(f"⚠️ Rate limit hit for {phone} (attempt {attempt + 1})")
-                
-                # Longer delay for rate limits
-                if attempt < max_attempts:
-                    rate_limit_delay = BASE_DELAY * (3 ** attempt) + random.uniform(1, 3)
-                    time.sleep(rate_limit_delay)
-                continue
+    def schedule(self, delay, callback, job=None):
+        """Run callback() on the timer thread after `delay` seconds"""
+        with self.cond:
+            self.ensure_started()
+            self.sequence += 1
+            self.scheduled += 1
+            heapq.heappush(self.heap, (time.monotonic() + max(delay, 0), self.sequence, callback, job))
+            self.cond.notify()
+    
+    def ensure_started(self):
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            self.pid = os.getpid()
+            self.thread = Thread(target=self.run, name="retry-scheduler", daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
                 
-            else:
-                last_error = f"API Error {response.status_code}: {response.text[:100]}"
-                logger.warning(f"⚠️ API error {response.status_code} for {phone} (attempt {attempt + 1})")
+                # Release waiting entries of cancelled jobs straight away
+                if any(entry[3] is not None and entry[3].cancelled for entry in self.heap):
+                    due.extend(entry for entry in self.heap if entry[3] is not None and entry[3].cancelled)
+                    self.heap = [entry for entry in self.heap if entry[3] is None or not entry[3].cancelled]
+                    heapq.heapify(self.heap)
                 
-                if attempt < max_attempts:
+                if not due:
+                    timeout = self.heap[0][0] - now if self.heap else None
+                    self.cond.wait(min(timeout, CANCEL_POLL_SECONDS) if timeout is not None else None)
                     continue
                 
-        except requests.exceptions.Timeout:
-            last_error = "Request timeout"
-            logger.warning(f"⚠️ Timeout for phone {phone} (attempt {attempt + 1})")
+                self.fired += len(due)
             
-        except requests.exceptions.RequestException as e:
-            last_error = f"Request failed: {str(e)}"
-            logger.warning(f"⚠️ Request exception for phone {phone} (attempt {attempt + 1}): {str(e)}")
+            for _, _, callback, _ in due:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"❌ Deferred retry failed to start: {str(e)}")
+    
+    def stats(self):
+        with self.cond:
+            return {
+                'waiting': len(self.heap),
+                'scheduled': self.scheduled,
+                'fired': self.fired,
+                'next_due_in': round(max(self.heap[0][0] - time.monotonic(), 0), 2) if self.heap else None
+            }
+
+retry_scheduler = RetryScheduler()
+
+class DeferredLookup:
+    """A threads-engine lookup that only holds a pool thread while an attempt runs
+    
+    Each attempt is one task on the lookup pool; a retry or a parked circuit waits
+    in retry_scheduler and then resumes on whichever pool thread is free.
+    """
+    
+    def __init__(self, phone, job=None, max_attempts=MAX_RETRIES, refresh=False):
+        self.phone = phone
+        self.job = job
+        self.max_attempts = max_attempts
+        self.refresh = refresh
+        self.lookup = None
+        self.future = concurrent.futures.Future()
+    
+    def start(self):
+        """Queue the first attempt; returns a concurrent.futures.Future of (data, error)"""
+        get_lookup_executor().submit(self.step)
+        return self.future
+    
+    def step(self):
+        if self.future.cancelled():
+            return
+        
+        try:
+            if self.lookup is None:
+                cached = get_cached_result(self.phone, self.job, allow_stale=not self.refresh)
+                if cached is not None:
+                    self.finish(cached)
+                    return
+                self.lookup = LookupAttempts(self.phone, self.job, self.max_attempts, refresh=self.refresh)
             
+            result, wait = lookup_attempt(self.lookup)
         except Exception as e:
-            last_error = f"Unexpected error: {str(e)}"
-            logger.error(f"❌ Unexpected error for phone {phone} (attempt {attempt + 1}): {str(e)}")
-            break  # Don't retry on unexpected errors
+            if self.future.set_running_or_notify_cancel():
+                self.future.set_exception(e)
+            return
+        
+        if result is not None:
+            self.finish(result)
+        else:
+            retry_scheduler.schedule(wait, self.resume, self.job)
+    
+    def resume(self):
+        get_lookup_executor().submit(self.step)
+    
+    def finish(self, result):
+        if self.future.set_running_or_notify_cancel():
+            self.future.set_result(result)
+
+def lookup_fits_deadline(job, queued):
+    """Whether a lookup started behind `queued` others should finish before the job's deadline"""
+    time_left = job.time_left()
+    if time_left is None:
+        return True
     
-    # All attempts failed
     with stats_lock:
-        processing_stats['failed'] += 1
+        completed = job.completed
+    elapsed = time.time() - job.started_at if job.started_at else 0
+    throughput = completed / elapsed if elapsed > 0 else 0
     
-    logger.error(f"❌ All attempts failed for {phone}: {last_error}")
-    return None, last_error
+    latency = upstream_latency.percentile(50) or 0
+    backlog = queued / throughput if throughput > 0 else 0
+    return time_left - DEADLINE_REPORT_RESERVE > latency + backlog
 
-def process_phone_batch_robust(phone_batch, batch_num, total_batches):
-    """Process a batch of phone numbers with improved error handling"""
-    results = []
+def schedule_order(numbers, tried=(), prefetched=()):
+    """Cache hits first (they cost nothing), then fresh numbers, then ones that failed before"""
+    cached = {num for num in numbers if num in prefetched or is_cached(num)}
+    return sorted(numbers, key=lambda num: 0 if num in cached else 2 if num in tried else 1)
+
+def process_phone_pipeline(phones, job=None, recount=True):
+    """Look up numbers through a sliding window of in-flight lookups (PIPELINE_WINDOW, or
+    ASYNC_PIPELINE_WINDOW on the asyncio engine)
     
-    logger.info(f"🔄 Starting batch {batch_num}/{total_batches} with {len(phone_batch)} numbers")
+    A slot is refilled the moment any lookup finishes, so one slow number never
+    holds the others back; pacing is left to api_keys and outbound_governor.
+    A job with a deadline stops starting lookups it could not finish in time, and
+    is expired (in-flight lookups abandoned) just before the deadline.
+    """
+    results = []
+    phone_iter = iter(phones)
+    future_to_phone = {}
+    window = ASYNC_PIPELINE_WINDOW if LOOKUP_ENGINE == 'asyncio' else PIPELINE_WINDOW
     
-    # Add initial delay between batches to avoid overwhelming API
-    if batch_num > 1:
-        initial_delay = random.uniform(1, 3)
-        logger.info(f"⏳ Waiting {initial_delay:.2f}s before starting batch {batch_num}")
-        time.sleep(initial_delay)
+    def refill():
+        while len(future_to_phone) < window:
+            if job is not None and (job.cancelled or not lookup_fits_deadline(job, len(future_to_phone))):
+                return
+            phone = next(phone_iter, None)
+            if phone is None:
+                return
+            future_to_phone[submit_lookup(phone, job=job)] = phone
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all API calls with staggered start times
-        future_to_phone = {}
+    try:
+        refill()
         
-        for i, phone in enumerate(phone_batch):
-            # Stagger the submission of requests
-            if i > 0:
-                time.sleep(random.uniform(0.1, 0.3))
+        while future_to_phone:
+            if job is not None and job.cancelled:
+                break
             
-            future = executor.submit(check_courier_api_with_retry, phone)
-            future_to_phone[future] = phone
-        
-        # Collect results as they complete
-        for future in concurrent.futures.as_completed(future_to_phone):
-            phone = future_to_phone[future]
-            try:
-                data, error = future.result()
-                results.append((phone, data, error))
+            expired = job is not None and job.deadline_at and job.time_left() <= DEADLINE_REPORT_RESERVE
+            if expired:
+                logger.warning(f"⏰ Job {job.id} reached its deadline with {len(future_to_phone)} lookups in flight")
+                job.expire()
+                # Keep the answers that already landed; the rest are abandoned
+                done = [future for future in future_to_phone if future.done()]
+            else:
+                done, _ = concurrent.futures.wait(
+                    future_to_phone,
+                    timeout=CANCEL_POLL_SECONDS,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+            
+            for future in done:
+                phone = future_to_phone.pop(future)
+                try:
+                    data, error = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Exception processing phone {phone}: {str(e)}")
+                    data, error = None, f"Processing error: {str(e)}"
                 
-                # Small delay between result processing
-                time.sleep(random.uniform(0.05, 0.15))
+                results.append((phone, data, error))
+                if job is not None:
+                    job.record_result(phone, data, error, count=recount)
                 
-            except Exception as e:
-                logger.error(f"❌ Exception processing phone {phone}: {str(e)}")
-                results.append((phone, None, f"Processing error: {str(e)}"))
+                if len(results) % PROGRESS_LOG_INTERVAL == 0:
+                    logger.info(f"📈 Progress: {len(results)}/{len(phones)} numbers processed")
+            
+            if expired:
+                break
+            refill()
+    
+    finally:
+        # Drop lookups still queued (after cancellation); in-flight ones finish on their own
+        for future in future_to_phone:
+            future.cancel()
     
     success_count = sum(1 for _, data, error in results if data is not None)
-    logger.info(f"✅ Batch {batch_num} completed: {success_count}/{len(phone_batch)} successful")
+    logger.info(f"✅ Pipeline finished: {success_count}/{len(phones)} successful")
     
     return results
 
-def create_excel_report(all_results, invalid_numbers):
+def create_excel_report(all_results, invalid_numbers, stats=None):
     """Create Excel report from results with conditional formatting"""
+    if stats is None:
+        stats = processing_stats
+    
     wb = openpyxl.Workbook()
     
     # Main data sheet
@@ -238,7 +3692,7 @@ def create_excel_report(all_results, invalid_numbers):
     
     # Summary sheet
     ws_summary = wb.create_sheet("Summary")
-    summary_headers = ["Phone", "Total Parcels", "Success", "Cancelled", "Success Ratio (%)", "Failed Ratio (%)", "Status"]
+    summary_headers = ["Phone", "Total Parcels", "Success", "Cancelled", "Success Ratio (%)", "Failed Ratio (%)", "Status", "Freshness"]
     ws_summary.append(summary_headers)
     
     # Processing Stats sheet
@@ -246,12 +3700,16 @@ def create_excel_report(all_results, invalid_numbers):
     with stats_lock:
         stats_data = [
             ["Metric", "Value"],
-            ["Total Numbers", processing_stats['total']],
-            ["Successful", processing_stats['success']],
-            ["Failed", processing_stats['failed']],
-            ["Total Retries", processing_stats['retries']],
-            ["Success Rate", f"{(processing_stats['success'] / max(processing_stats['total'], 1)) * 100:.1f}%"],
-            ["Cache Hits", len(phone_cache)]
+            ["Total Numbers", stats['total']],
+            ["Successful", stats['success']],
+            ["Failed", stats['failed']],
+            ["Total Retries", stats['retries']],
+            ["Retries Denied (budget)", stats.get('retries_denied', 0)],
+            ["Shared With Other Jobs", stats.get('coalesced', 0)],
+            ["Not Checked (deadline)", stats.get('not_checked', 0)],
+            ["Served Stale (refreshing)", stats.get('stale', 0)],
+            ["Success Rate", f"{(stats['success'] / max(stats['total'], 1)) * 100:.1f}%"],
+            ["Cache Hits", stats.get('cache_hits', 0)]
         ]
     
     for row in stats_data:
@@ -290,13 +3748,13 @@ def create_excel_report(all_results, invalid_numbers):
             has_data = False
             
             # Process each courier
-            for courier_name, stats in courier_stats.items():
+            for courier_name, courier in courier_stats.items():
                 if courier_name.lower() == "summary":
                     continue
                     
-                total = stats.get("total_parcel", 0)
-                success = stats.get("success_parcel", 0)
-                cancelled = stats.get("cancelled_parcel", 0)
+                total = courier.get("total_parcel", 0)
+                success = courier.get("success_parcel", 0)
+                cancelled = courier.get("cancelled_parcel", 0)
                 
                 if total > 0:
                     has_data = True
@@ -349,17 +3807,18 @@ def create_excel_report(all_results, invalid_numbers):
                 cancelled_all, 
                 overall_success, 
                 overall_failed,
-                status
+                status,
+                "Stale" if data.get("stale") else "Fresh"
             ])
             
             # Apply conditional formatting to summary row
             if total_all == 0:  # No data found
-                for col in range(1, 8):  # Columns A-G
+                for col in range(1, 9):  # Columns A-H
                     cell = ws_summary.cell(row=summary_row_idx, column=col)
                     cell.fill = yellow_fill
                     cell.font = yellow_font
             elif overall_failed > 40:  # High failure rate
-                for col in range(1, 8):  # Columns A-G
+                for col in range(1, 9):  # Columns A-H
                     cell = ws_summary.cell(row=summary_row_idx, column=col)
                     cell.fill = red_fill
                     cell.font = red_font
@@ -371,7 +3830,7 @@ def create_excel_report(all_results, invalid_numbers):
             # Handle API errors - mark as yellow (no data)
             error_msg = error or "Unknown error"
             ws_data.append([phone, "ERROR", error_msg, "N/A", "N/A", "N/A", "N/A"])
-            ws_summary.append([phone, "N/A", "N/A", "N/A", "N/A", "N/A", f"Error: {error_msg}"])
+            ws_summary.append([phone, "N/A", "N/A", "N/A", "N/A", "N/A", f"Error: {error_msg}", "N/A"])
             
             # Apply yellow formatting for error rows
             for col in range(1, 8):  # Columns A-G
@@ -383,6 +3842,10 @@ def create_excel_report(all_results, invalid_numbers):
                 cell.fill = yellow_fill
                 cell.font = yellow_font
             
+            cell = ws_summary.cell(row=summary_row_idx, column=8)
+            cell.fill = yellow_fill
+            cell.font = yellow_font
+            
             data_row_idx += 1
             summary_row_idx += 1
     
@@ -399,6 +3862,7 @@ def create_excel_report(all_results, invalid_numbers):
         ["Notes:", ""],
         ["• Red highlighting indicates courier services with high failure rates"],
         ["• Yellow highlighting indicates missing data or API errors"],
+        ["• Freshness \"Stale\" means the cached history had expired and is being refreshed"],
         ["• Use this information to identify problematic phone numbers"],
     ]
     
@@ -691,6 +4155,35 @@ HTML_FORM = '''
             font-weight: 500;
         }
         
+        .deadline-field {
+            margin-top: 20px;
+            color: #4a5568;
+            font-size: 14px;
+        }
+        
+        .deadline-field select {
+            margin-left: 8px;
+            padding: 6px 10px;
+            border: 1px solid #cbd5e0;
+            border-radius: 8px;
+            font-size: 14px;
+        }
+        
+        .cancel-btn {
+            padding: 6px 14px;
+            background: transparent;
+            color: #c53030;
+            border: 1px solid #feb2b2;
+            border-radius: 50px;
+            cursor: pointer;
+            font-size: 13px;
+            font-weight: 600;
+        }
+        
+        .cancel-btn:hover {
+            background: #fed7d7;
+        }
+        
         .spinner {
             width: 24px;
             height: 24px;
@@ -869,12 +4362,23 @@ HTML_FORM = '''
                 <input type="file" name="file" id="file-upload" accept=".txt" required>
                 <div class="file-info" id="file-info"></div>
             </div>
+            <div class="deadline-field">
+                <label for="deadline">Time limit</label>
+                <select name="deadline" id="deadline">
+                    <option value="0">No limit</option>
+                    <option value="60">1 minute</option>
+                    <option value="300">5 minutes</option>
+                    <option value="900">15 minutes</option>
+                    <option value="3600">1 hour</option>
+                </select>
+            </div>
             <input type="submit" value="Generate Report (Robust)" class="submit-btn" id="submit-btn">
         </form>
         
         <div class="loading" id="loading">
             <div class="spinner"></div>
-            <span>Processing with retry logic...</span>
+            <span id="loading-text">Processing with retry logic...</span>
+            <button type="button" class="cancel-btn" id="cancel-btn">Cancel</button>
         </div>
         
         <div class="info-sections-container">
@@ -923,6 +4427,9 @@ HTML_FORM = '''
         const loading = document.getElementById('loading');
         const submitBtn = document.getElementById('submit-btn');
         const fileInfo = document.getElementById('file-info');
+        const loadingText = document.getElementById('loading-text');
+        const cancelBtn = document.getElementById('cancel-btn');
+        let activeJob = null;
 
         // Click to upload
         uploadBox.addEventListener('click', () => fileInput.click());
@@ -976,73 +4483,450 @@ HTML_FORM = '''
             fileInfo.style.display = 'block';
         }
 
+        // Restore the form after a job finishes or fails
+        function resetForm() {
+            activeJob = null;
+            loading.style.display = 'none';
+            submitBtn.disabled = false;
+            submitBtn.value = 'Generate Report (Robust)';
+        }
+
+        // Describe a progress event from the job stream
+        function showProgress(p) {
+            let text = `${p.completed}/${p.total} checked (${p.failed} failed`;
+            if (p.retries !== undefined) {
+                text += `, ${p.retries} retries`;
+            }
+            text += ')';
+            if (p.throughput > 0) {
+                text += ` • ${p.throughput.toFixed(1)}/s`;
+            }
+            if (p.eta_seconds !== null && p.eta_seconds !== undefined) {
+                text += ` • ETA ${Math.ceil(p.eta_seconds)}s`;
+            }
+            if (p.deadline_seconds !== null && p.deadline_seconds !== undefined) {
+                text += ` • ${Math.ceil(p.deadline_seconds)}s left`;
+            }
+            if (p.upstream === 'open') {
+                text += ' • upstream unavailable';
+            }
+            loadingText.textContent = text;
+        }
+
+        // Follow the job's progress stream, falling back to polling without SSE
+        function streamJob(job) {
+            if (!window.EventSource) {
+                pollJob(job);
+                return;
+            }
+            
+            const events = new EventSource(job.events_url);
+            let finished = false;
+            
+            events.addEventListener('progress', (e) => showProgress(JSON.parse(e.data)));
+            
+            events.addEventListener('done', (e) => {
+                finished = true;
+                events.close();
+                const p = JSON.parse(e.data);
+                showProgress(p);
+                resetForm();
+                window.location = p.download_url;
+            });
+            
+            events.addEventListener('cancelled', () => {
+                finished = true;
+                events.close();
+                resetForm();
+            });
+            
+            events.addEventListener('failed', (e) => {
+                finished = true;
+                events.close();
+                const p = JSON.parse(e.data);
+                resetForm();
+                alert(`Job failed: ${p.error || 'unknown error'}`);
+            });
+            
+            events.onerror = () => {
+                if (!finished) {
+                    events.close();
+                    pollJob(job);
+                }
+            };
+        }
+
+        // Poll the job until the report is ready, then download it
+        function pollJob(job) {
+            fetch(job.status_url, { headers: { 'Accept': 'application/json' } })
+                .then((response) => response.json())
+                .then((status) => {
+                    const stats = status.stats || {};
+                    loadingText.textContent = `Job ${status.status}: ${stats.success || 0} successful, ${stats.failed || 0} failed of ${stats.total || 0}`;
+                    
+                    if (status.status === 'done') {
+                        resetForm();
+                        window.location = status.download_url;
+                    } else if (status.status === 'cancelled') {
+                        resetForm();
+                    } else if (status.status === 'failed' || status.error) {
+                        resetForm();
+                        alert(`Job failed: ${status.error || 'unknown error'}`);
+                    } else {
+                        setTimeout(() => pollJob(job), 2000);
+                    }
+                })
+                .catch(() => setTimeout(() => pollJob(job), 5000));
+        }
+
+        // Stop the running job so it stops using API quota
+        cancelBtn.addEventListener('click', () => {
+            if (activeJob) {
+                loadingText.textContent = 'Cancelling...';
+                fetch(activeJob.cancel_url, { method: 'POST', headers: { 'Accept': 'application/json' } });
+            }
+        });
+
+        // Closing or leaving the page cancels the job it started
+        window.addEventListener('pagehide', () => {
+            if (activeJob && navigator.sendBeacon) {
+                navigator.sendBeacon(activeJob.cancel_url);
+            }
+        });
+
         // Form submission
         form.addEventListener('submit', (e) => {
+            e.preventDefault();
+            
             if (!fileInput.files.length) {
-                e.preventDefault();
                 alert('Please select a file first.');
                 return;
             }
             
             loading.style.display = 'flex';
+            loadingText.textContent = 'Uploading...';
             submitBtn.disabled = true;
-            submitBtn.textContent = 'Processing with Retries...';
+            submitBtn.value = 'Processing with Retries...';
+            
+            fetch(form.action || window.location.href, {
+                method: 'POST',
+                body: new FormData(form),
+                headers: { 'Accept': 'application/json' }
+            })
+                .then((response) => response.json())
+                .then((job) => {
+                    if (job.error) {
+                        resetForm();
+                        alert(job.error);
+                        return;
+                    }
+                    loadingText.textContent = `Job queued: ${job.total} numbers`;
+                    activeJob = job;
+                    streamJob(job);
+                })
+                .catch((err) => {
+                    resetForm();
+                    alert(`Upload failed: ${err}`);
+                });
         });
     </script>
 </body>
 </html>
 '''
 
+def get_job_executor():
+    """Return the background job pool, creating it on first use in this process"""
+    global job_executor, job_executor_pid
+    
+    with jobs_lock:
+        if job_executor is None or job_executor_pid != os.getpid():
+            job_executor = InstrumentedThreadPoolExecutor(
+                max_workers=JOB_WORKERS,
+                thread_name_prefix="job"
+            )
+            job_executor_pid = os.getpid()
+        return job_executor
+
+def purge_expired_jobs():
+    """Forget finished jobs older than JOB_RETENTION_SECONDS and delete their reports"""
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    
+    with jobs_lock:
+        expired = [job for job in jobs.values() if job.finished_at and job.finished_at < cutoff]
+        for job in expired:
+            del jobs[job.id]
+    
+    for job in expired:
+        checkpoint_store.delete_job(job.id)
+        if job.report_path and os.path.exists(job.report_path):
+            try:
+                os.remove(job.report_path)
+            except OSError as e:
+                logger.warning(f"⚠️ Could not delete report for job {job.id}: {str(e)}")
+
+def submit_job(job, resume=False):
+    """Register a job, checkpoint it and queue it on the background pool"""
+    purge_expired_jobs()
+    
+    with jobs_lock:
+        jobs[job.id] = job
+    
+    if resume:
+        checkpoint_store.update_job(job)
+        checkpoint_store.clear_cancel(job.id)
+    else:
+        checkpoint_store.save_job(job)
+    
+    get_job_executor().submit(run_job, job)
+    logger.info(f"📥 Queued job {job.id} with {len(job.numbers)} numbers")
+    return job
+
+def get_job(job_id):
+    """Look up a job by ID, or None if it is unknown or expired"""
+    with jobs_lock:
+        return jobs.get(job_id)
+
+def find_job(job_id):
+    """Look up a job in memory, then in the checkpoint store (e.g. owned by another worker)"""
+    return get_job(job_id) or checkpoint_store.load_job(job_id)
+
+def owner_alive(heartbeat):
+    """True if the worker running a job marked it alive within JOB_HEARTBEAT_TIMEOUT
+    
+    A heartbeat rather than the owner's PID, which a new process may reuse after a restart.
+    """
+    return heartbeat is not None and time.time() - heartbeat < JOB_HEARTBEAT_TIMEOUT
+
+def job_heartbeat_loop():
+    """Keep marking the jobs this process is queued or running as alive, and cancel
+    those another worker was asked to cancel"""
+    last_heartbeat = time.monotonic()
+    while True:
+        time.sleep(JOB_CANCEL_POLL_SECONDS)
+        with jobs_lock:
+            active = {job.id: job for job in jobs.values() if job.status not in FINISHED_STATUSES}
+        try:
+            for job_id in checkpoint_store.cancel_requests(list(active)):
+                if not active[job_id].cancelled:
+                    logger.info(f"🛑 Cancellation requested for job {job_id} through another worker")
+                    active[job_id].cancel()
+            
+            if time.monotonic() - last_heartbeat >= JOB_HEARTBEAT_SECONDS:
+                checkpoint_store.heartbeat(list(active))
+                last_heartbeat = time.monotonic()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Could not record job heartbeat: {str(e)}")
+
+def resume_job(job_id, heartbeat, check_owner=True):
+    """Claim an interrupted job from the checkpoint store and queue it again; None if not possible"""
+    if get_job(job_id) is not None:
+        return None
+    
+    if check_owner and owner_alive(heartbeat):
+        return None
+    
+    job = checkpoint_store.load_job(job_id)
+    if job is None or not checkpoint_store.claim_job(job_id, heartbeat):
+        return None
+    
+    job.status = 'queued'
+    job.error = None
+    job.finished_at = None
+    job.restart_deadline()
+    logger.info(f"♻️ Resuming job {job.id}")
+    return submit_job(job, resume=True)
+
+def resume_incomplete_jobs():
+    """Resume every checkpointed job whose worker died before finishing it"""
+    try:
+        for job_id, heartbeat in checkpoint_store.incomplete_jobs():
+            resume_job(job_id, heartbeat)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Could not resume checkpointed jobs: {str(e)}")
+
+def sweep_failures(results, job):
+    """Give numbers that failed transiently one more pass at the end of the job"""
+    sweep = [phone for phone, data, error in results if data is None and phone in job.sweepable]
+    if not SWEEP_FAILURES or not sweep or job.cancelled:
+        return results
+    
+    if BREAKER_MODE == 'fail' and circuit_breaker.is_open:
+        logger.info(f"🧹 Job {job.id}: skipping final sweep of {len(sweep)} numbers, upstream unavailable")
+        return results
+    
+    logger.info(f"🧹 Job {job.id}: final sweep of {len(sweep)} failed numbers")
+    job.sweepable.clear()
+    with stats_lock:
+        outcomes = job.stats['success'] + job.stats['failed']
+    swept = {phone: (data, error) for phone, data, error in process_phone_pipeline(sweep, job=job, recount=False)}
+    
+    # A swept lookup that recorded a new success or failure replaces the failure counted
+    # before; cache hits, cancellations and deadline skips recorded nothing to replace
+    with stats_lock:
+        recorded = job.stats['success'] + job.stats['failed'] - outcomes
+        job.stats['failed'] -= recorded
+    job.notify()
+    
+    recovered = sum(1 for data, _ in swept.values() if data is not None)
+    logger.info(f"🧹 Job {job.id}: final sweep recovered {recovered}/{len(sweep)} numbers")
+    
+    return [(phone,) + swept.get(phone, (data, error)) for phone, data, error in results]
+
+def run_job(job):
+    """Fetch every number of a job and write its Excel report to REPORT_DIR"""
+    if job.cancelled:
+        job.finished_at = time.time()
+        job.set_status('cancelled')
+        checkpoint_store.update_job(job)
+        return
+    
+    job.started_at = time.time()
+    job.set_status('running')
+    checkpoint_store.update_job(job)
+    
+    try:
+        # Skip numbers already fetched successfully before an interruption
+        checkpointed = checkpoint_store.load_results(job.id)
+        finished = {
+            phone: (data, error)
+            for phone, (data, error) in checkpointed.items()
+            if data is not None
+        }
+        unique_numbers = [num for num in job.numbers if num not in finished]
+        
+        # One bulk read of the shared cache for whatever this worker has not cached itself
+        if shared_cache is not None:
+            job.prefetched = shared_cache.get_many([num for num in unique_numbers if not is_cached(num)])
+        unique_numbers = schedule_order(unique_numbers, tried=set(checkpointed) - set(finished), prefetched=job.prefetched or ())
+        
+        if finished:
+            logger.info(f"♻️ Job {job.id}: {len(finished)} numbers restored from checkpoint")
+            with stats_lock:
+                job.completed = len(finished)
+                job.stats['success'] = len(finished)
+                job.stats['stale'] = sum(1 for data, _ in finished.values() if data.get('stale'))
+            job.notify()
+        
+        logger.info(f"🎯 Job {job.id}: processing {len(unique_numbers)} unique valid phone numbers")
+        
+        all_results = process_phone_pipeline(unique_numbers, job=job)
+        all_results = sweep_failures(all_results, job)
+        
+        if job.cancelled and not job.deadline_hit:
+            logger.info(f"🛑 Job {job.id} cancelled after {job.completed}/{len(job.numbers)} numbers")
+            job.finished_at = time.time()
+            job.set_status('cancelled')
+            checkpoint_store.update_job(job)
+            return
+        
+        # Report in upload order, merging checkpointed and freshly fetched results
+        finished.update((phone, (data, error)) for phone, data, error in all_results)
+        
+        # Numbers the deadline left unchecked still get a row in the report
+        unchecked = [phone for phone in job.numbers if phone not in finished or finished[phone][1] == "Cancelled"]
+        if unchecked and job.deadline_at is not None:
+            job.deadline_hit = True
+            record_stat(None, 'not_checked', len(unchecked))
+            logger.warning(f"⏰ Job {job.id}: {len(unchecked)} numbers not checked before the deadline")
+            finished.update((phone, (None, NOT_CHECKED_DEADLINE)) for phone in unchecked)
+        
+        # Lookups abandoned at the deadline may have counted themselves; count what the report holds
+        if job.deadline_hit:
+            with stats_lock:
+                job.stats['success'] = sum(1 for data, _ in finished.values() if data is not None)
+                job.stats['failed'] = sum(1 for data, error in finished.values() if data is None and error != NOT_CHECKED_DEADLINE)
+                job.stats['not_checked'] = len(unchecked)
+            job.notify()
+        
+        all_results = [(phone,) + finished[phone] for phone in job.numbers if phone in finished]
+        
+        # Create Excel report
+        wb, processed_count = create_excel_report(all_results, job.invalid_numbers, stats=job.stats)
+        
+        # Generate filename with timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        report_path = os.path.join(REPORT_DIR, f"{job.id}.xlsx")
+        wb.save(report_path)
+        wb.close()
+        
+        job.report_path = report_path
+        job.filename = f"bd_courier_report_robust_{timestamp}.xlsx"
+        job.processed_count = processed_count
+        job.finished_at = time.time()
+        job.set_status('done')
+        checkpoint_store.update_job(job)
+        
+        total_time = time.time() - job.started_at
+        
+        # Final statistics
+        with stats_lock:
+            success_rate = (job.stats['success'] / max(job.stats['total'], 1)) * 100
+            logger.info(f"📊 Final Stats for job {job.id}: {job.stats['success']}/{job.stats['total']} successful ({success_rate:.1f}%)")
+            logger.info(f"🔄 Total retries: {job.stats['retries']}")
+            logger.info(f"⏱️ Total time: {total_time:.2f}s")
+    
+    except Exception as e:
+        logger.error(f"❌ Job {job.id} failed: {str(e)}")
+        job.finished_at = time.time()
+        job.set_status('failed', error=str(e))
+        checkpoint_store.update_job(job)
+
+def wants_json():
+    """True when the client asked for JSON rather than an HTML page"""
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json'
+
+def upload_error(message):
+    """Report an upload validation error as JSON or as a flashed message"""
+    if wants_json():
+        return jsonify({'error': message}), 400
+    
+    flash(message, 'error')
+    return redirect(request.url)
+
 @app.route("/", methods=["GET", "POST"])
 def upload_file():
     if request.method == "POST":
-        start_time = time.time()
-        
-        # Reset processing stats
-        with stats_lock:
-            processing_stats.update({
-                'total': 0,
-                'success': 0,
-                'failed': 0,
-                'retries': 0
-            })
-        
         try:
             # Check if file was uploaded
             if 'file' not in request.files:
-                flash('No file selected', 'error')
-                return redirect(request.url)
+                return upload_error('No file selected')
             
             uploaded_file = request.files['file']
             
             if uploaded_file.filename == '':
-                flash('No file selected', 'error')
-                return redirect(request.url)
+                return upload_error('No file selected')
             
             # Validate file
             if not uploaded_file or not allowed_file(uploaded_file.filename):
-                flash('Please upload a valid .txt file', 'error')
-                return redirect(request.url)
+                return upload_error('Please upload a valid .txt file')
+            
+            # Optional time limit in seconds, from the form or the query string
+            deadline = request.form.get('deadline') or request.args.get('deadline') or JOB_DEFAULT_DEADLINE
+            try:
+                deadline = float(deadline)
+            except (TypeError, ValueError):
+                return upload_error('Deadline must be a number of seconds')
+            if not math.isfinite(deadline) or deadline < 0 or deadline > JOB_MAX_DEADLINE:
+                return upload_error(f'Deadline must be between 0 and {JOB_MAX_DEADLINE} seconds')
             
             # Check file size
             file_content = uploaded_file.read()
             if len(file_content) > MAX_FILE_SIZE:
-                flash('File too large. Maximum size is 5MB', 'error')
-                return redirect(request.url)
+                return upload_error('File too large. Maximum size is 5MB')
             
             # Read and process phone numbers
             try:
                 content = file_content.decode('utf-8')
             except UnicodeDecodeError:
-                flash('Invalid file encoding. Please use UTF-8 encoded text file', 'error')
-                return redirect(request.url)
+                return upload_error('Invalid file encoding. Please use UTF-8 encoded text file')
             
             # Extract and validate phone numbers
             raw_numbers = [line.strip() for line in content.splitlines() if line.strip()]
             
             if not raw_numbers:
-                flash('No phone numbers found in the file', 'error')
-                return redirect(request.url)
+                return upload_error('No phone numbers found in the file')
             
             logger.info(f"📊 Processing {len(raw_numbers)} phone numbers")
             
@@ -1058,8 +4942,7 @@ def upload_file():
                     invalid_numbers.append(num)
             
             if not valid_numbers:
-                flash('No valid Bangladesh phone numbers found', 'error')
-                return redirect(request.url)
+                return upload_error('No valid Bangladesh phone numbers found')
             
             # Remove duplicates while preserving order
             seen = set()
@@ -1075,69 +4958,311 @@ def upload_file():
             
             # Update total count
             with stats_lock:
-                processing_stats['total'] = len(unique_numbers)
+                processing_stats['total'] += len(unique_numbers)
             
-            logger.info(f"🎯 Processing {len(unique_numbers)} unique valid phone numbers")
+            # Hand the numbers to the background pool and return immediately
+            job = submit_job(Job(unique_numbers, invalid_numbers, deadline=deadline))
             
-            # Process in batches with improved reliability
-            all_results = []
-            total_batches = (len(unique_numbers) + BATCH_SIZE - 1) // BATCH_SIZE
+            response = jsonify({
+                'job_id': job.id,
+                'status': job.status,
+                'total': len(unique_numbers),
+                'invalid': len(invalid_numbers),
+                'deadline_at': job.deadline_at,
+                'status_url': url_for('job_status', job_id=job.id),
+                'events_url': url_for('job_events', job_id=job.id),
+                'cancel_url': url_for('job_cancel', job_id=job.id),
+                'download_url': url_for('job_download', job_id=job.id)
+            })
+            response.status_code = 202
+            response.headers['Location'] = url_for('job_status', job_id=job.id)
+            return response
             
-            for i in range(0, len(unique_numbers), BATCH_SIZE):
-                batch = unique_numbers[i:i + BATCH_SIZE]
-                batch_num = i // BATCH_SIZE + 1
-                
-                batch_results = process_phone_batch_robust(batch, batch_num, total_batches)
-                all_results.extend(batch_results)
-                
-                # Progress logging
-                completed = min(i + BATCH_SIZE, len(unique_numbers))
-                logger.info(f"📈 Progress: {completed}/{len(unique_numbers)} numbers processed")
-                
-                # Longer delay between batches for rate limit compliance
-                if batch_num < total_batches:
-                    inter_batch_delay = random.uniform(2, 5)
-                    logger.info(f"⏳ Waiting {inter_batch_delay:.2f}s between batches")
-                    time.sleep(inter_batch_delay)
+        except Exception as e:
+            logger.error(f"❌ Error processing request: {str(e)}")
+            return upload_error(f'An error occurred while processing your request: {str(e)}')
+    
+    return render_template_string(HTML_FORM)
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    
+    status = job.to_dict()
+    if job.status == 'done':
+        status['download_url'] = url_for('job_download', job_id=job.id)
+    return jsonify(status)
+
+# Progress streams open in this worker (see SSE_MAX_STREAMS)
+sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-Sent Events stream of job progress, ending when the job finishes
+    
+    A job held by another worker is followed through the checkpoint store. Each open
+    stream holds one of the worker's threads for the job's whole run, so past
+    SSE_MAX_STREAMS clients get a 503 and poll the status URL instead.
+    """
+    job = get_job(job_id)
+    stored = checkpoint_store.load_job(job_id) if job is None else None
+    if job is None and stored is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    
+    if not sse_streams.acquire(blocking=False):
+        response = jsonify({
+            'error': 'Too many progress streams open; poll the status URL instead',
+            'status_url': url_for('job_status', job_id=job_id)
+        })
+        response.headers['Retry-After'] = str(SSE_HEARTBEAT_SECONDS)
+        return response, 503
+    
+    def stream():
+        seen_version = -1
+        
+        while True:
+            with job.changed:
+                if job.version == seen_version:
+                    job.changed.wait(timeout=SSE_HEARTBEAT_SECONDS)
+                current_version = job.version
             
-            # Create Excel report
-            wb, processed_count = create_excel_report(all_results, invalid_numbers)
+            if current_version == seen_version:
+                yield ": keep-alive\n\n"
+                continue
             
-            # Save to BytesIO
-            output = io.BytesIO()
-            wb.save(output)
-            wb.close()
-            output.seek(0)
+            seen_version = current_version
+            progress = job.progress()
             
-            # Generate filename with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"bd_courier_report_robust_{timestamp}.xlsx"
+            if progress['status'] in FINISHED_STATUSES:
+                if progress['status'] == 'done':
+                    progress['download_url'] = download_url
+                yield f"event: {progress['status']}\ndata: {json.dumps(progress)}\n\n"
+                return
             
-            total_time = time.time() - start_time
+            yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            time.sleep(SSE_MIN_INTERVAL)
+    
+    def stored_stream():
+        last_progress = None
+        last_sent = time.monotonic()
+        
+        while True:
+            row = checkpoint_store.progress(job_id)
+            if row is None:
+                return
             
-            # Final statistics
-            with stats_lock:
-                success_rate = (processing_stats['success'] / max(processing_stats['total'], 1)) * 100
-                logger.info(f"📊 Final Stats: {processing_stats['success']}/{processing_stats['total']} successful ({success_rate:.1f}%)")
-                logger.info(f"🔄 Total retries: {processing_stats['retries']}")
-                logger.info(f"⏱️ Total time: {total_time:.2f}s")
-            
-            return send_file(
-                output,
-                as_attachment=True,
-                download_name=filename,
-                mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            status, error, completed, success = row
+            progress = {
+                'job_id': job_id,
+                'status': status,
+                'error': error,
+                'total': len(stored.numbers),
+                'completed': completed,
+                'success': success,
+                'failed': completed - success
+            }
             
-        except Exception as e:
-            logger.error(f"❌ Error processing request: {str(e)}")
-            flash(f'An error occurred while processing your request: {str(e)}', 'error')
-            return redirect(request.url)
+            if status in FINISHED_STATUSES:
+                if status == 'done':
+                    progress['download_url'] = download_url
+                yield f"event: {status}\ndata: {json.dumps(progress)}\n\n"
+                return
+            
+            if progress != last_progress:
+                last_progress = progress
+                last_sent = time.monotonic()
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(SSE_POLL_SECONDS)
     
-    return render_template_string(HTML_FORM)
+    download_url = url_for('job_download', job_id=job_id)
+    response = Response(
+        stream() if job is not None else stored_stream(),
+        mimetype="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(sse_streams.release)
+    return response
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    """Stop a queued or running job; its checkpointed results are kept for a later resume"""
+    job = get_job(job_id)
+    
+    if job is None:
+        return cancel_stored_job(job_id)
+    
+    if job.status in FINISHED_STATUSES:
+        return jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409
+    
+    job.cancel()
+    logger.info(f"🛑 Cancellation requested for job {job.id}")
+    return jsonify(job.to_dict()), 202
+
+def cancel_stored_job(job_id):
+    """Cancel a job this worker does not hold: its owner picks the request up from the checkpoint store"""
+    stored = checkpoint_store.query("SELECT status, heartbeat FROM jobs WHERE job_id = ?", (job_id,))
+    if not stored:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    
+    status, heartbeat = stored[0]
+    if status in FINISHED_STATUSES:
+        return jsonify({'error': f'Job is {status}', 'status': status}), 409
+    
+    # Nobody is running an orphaned job, so there is no one to ask
+    if not owner_alive(heartbeat) and checkpoint_store.cancel_orphan(job_id, heartbeat):
+        logger.info(f"🛑 Cancelled orphaned job {job_id}")
+    elif checkpoint_store.request_cancel(job_id):
+        logger.info(f"🛑 Cancellation requested for job {job_id} owned by another worker")
+    
+    return jsonify(checkpoint_store.load_job(job_id).to_dict()), 202
+
+@app.route("/jobs/<job_id>/resume", methods=["POST"])
+def job_resume(job_id):
+    """Re-queue a failed or orphaned job, skipping numbers it already checkpointed"""
+    job = get_job(job_id)
+    
+    if job is not None:
+        if job.status not in ('failed', 'cancelled'):
+            return jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409
+        
+        job.status = 'queued'
+        job.error = None
+        job.finished_at = None
+        job.cancel_event.clear()
+        job.restart_deadline()
+        with stats_lock:
+            job.reset_run()
+        submit_job(job, resume=True)
+        return jsonify(job.to_dict()), 202
+    
+    stored = checkpoint_store.query("SELECT status, heartbeat FROM jobs WHERE job_id = ?", (job_id,))
+    if not stored:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    
+    status, heartbeat = stored[0]
+    if status == 'done':
+        return jsonify({'error': 'Job is done', 'status': status}), 409
+    
+    job = resume_job(job_id, heartbeat, check_owner=(status not in ('failed', 'cancelled')))
+    if job is None:
+        return jsonify({'error': 'Job is still owned by a running worker'}), 409
+    return jsonify(job.to_dict()), 202
+
+@app.route("/jobs/<job_id>/download", methods=["GET"])
+def job_download(job_id):
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    
+    if job.status != 'done':
+        return jsonify({'error': f'Report not ready (job is {job.status})', 'status': job.status}), 409
+    
+    return send_file(
+        job.report_path,
+        as_attachment=True,
+        download_name=job.filename,
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Process-level counters for pools, pacing and jobs"""
+    with stats_lock:
+        stats = dict(processing_stats)
+    with jobs_lock:
+        job_counts = {}
+        for job in jobs.values():
+            job_counts[job.status] = job_counts.get(job.status, 0) + 1
+    
+    return jsonify({
+        'pid': os.getpid(),
+        'processing': stats,
+        'jobs': job_counts,
+        'job_pool': get_job_executor().stats(),
+        'lookup_engine': LOOKUP_ENGINE,
+        'lookup_pool': get_lookup_executor().stats(),
+        'connections': upstream_connections.stats(),
+        'async_engine': async_engine.stats(),
+        'governor': outbound_governor.stats(),
+        'concurrency': concurrency_controller.stats(),
+        'api_keys': api_keys.stats(),
+        'retry_budget': default_retry_budget.stats(),
+        'circuit_breaker': circuit_breaker.stats(),
+        'hedging': hedger.stats(),
+        'timeouts': timeout_stats(),
+        'retry_scheduler': retry_scheduler.stats(),
+        'single_flight': single_flight.stats(),
+        'cache': phone_cache.stats(),
+        'shared_cache': shared_cache.stats() if shared_cache is not None else None,
+        'snapshot': cache_snapshot.stats() if cache_snapshot is not None else None,
+        'revalidation': revalidator.stats()
+    })
+
+@app.route("/cache/snapshot", methods=["GET"])
+def cache_snapshot_export():
+    """The current cache snapshot, for other instances to start from (SNAPSHOT_IMPORT_URL)"""
+    if cache_snapshot is None or not SNAPSHOT_SERVICE_ENABLED:
+        return jsonify({'error': 'Snapshot export is not enabled on this instance'}), 404
+    if not service_authorized():
+        return jsonify({'error': 'Missing or invalid service token'}), 401
+    if cache_snapshot.snapshot() is None:
+        return jsonify({'error': 'No cache snapshot has been built yet'}), 404
+    
+    return send_file(
+        cache_snapshot.path,
+        as_attachment=True,
+        download_name='bd_courier_cache.snap',
+        mimetype="application/octet-stream"
+    )
+
+def service_authorized():
+    """True if the request carries this instance's SERVICE_TOKEN"""
+    token = request.headers.get('X-Service-Token', '')
+    return bool(SERVICE_TOKEN) and hmac.compare_digest(token.encode(), SERVICE_TOKEN.encode())
+
+@app.route("/ratelimit/reserve", methods=["POST"])
+def ratelimit_reserve():
+    """Shared token bucket for other instances using RATE_LIMIT_BACKEND=http"""
+    if service_limit_backend is None:
+        return jsonify({'error': 'Rate limit service is not enabled on this instance'}), 404
+    if not service_authorized():
+        return jsonify({'error': 'Missing or invalid service token'}), 401
+    
+    name = request.args.get('name', 'bdcourier')
+    wait, granted, rate = service_limit_backend.reserve(name)
+    return jsonify({'wait': wait, 'granted': granted, 'rate': rate})
+
+@app.route("/ratelimit/adjust", methods=["POST"])
+def ratelimit_adjust():
+    """Slow down or pause the shared bucket after another instance was throttled"""
+    if service_limit_backend is None:
+        return jsonify({'error': 'Rate limit service is not enabled on this instance'}), 404
+    if not service_authorized():
+        return jsonify({'error': 'Missing or invalid service token'}), 401
+    
+    changes = {key: request.args.get(key, type=float) for key in ('rate', 'factor', 'pause')}
+    if any(value is not None and not math.isfinite(value) for value in changes.values()):
+        return jsonify({'error': 'rate, factor and pause must be finite numbers'}), 400
+    
+    # bucket_adjust() keeps rate within [PACER_MIN_RATE, UPSTREAM_RATE_LIMIT]; callers may
+    # only slow the bucket down, and pause it no longer than a Retry-After would
+    if changes['factor'] is not None:
+        changes['factor'] = min(max(changes['factor'], 0.0), 1.0)
+    if changes['pause'] is not None:
+        changes['pause'] = min(max(changes['pause'], 0.0), PACER_MAX_PAUSE)
+    rate = service_limit_backend.adjust(request.args.get('name', 'bdcourier'), **changes)
+    return jsonify({'rate': rate})
 
 @app.errorhandler(413)
 def too_large(e):
+    if wants_json():
+        return jsonify({'error': 'File too large. Maximum size is 5MB'}), 413
+    
     flash('File too large. Maximum size is 5MB', 'error')
     return redirect(url_for('upload_file'))
 
@@ -1147,7 +5272,48 @@ def internal_error(e):
     flash('An internal server error occurred. Please try again.', 'error')
     return redirect(url_for('upload_file'))
 
+worker_lock = Lock()
+worker_pid = None
+
+def init_worker():
+    """Start this process's pools, warm its upstream connections and resume orphaned jobs
+    
+    Runs once per process: from gunicorn's post_worker_init hook (gunicorn.conf.py),
+    or else on the first request, so importing app (tools, tests, bench.py) starts nothing.
+    """
+    global worker_pid
+    with worker_lock:
+        if worker_pid == os.getpid():
+            return
+        worker_pid = os.getpid()
+    
+    if LOOKUP_ENGINE == 'asyncio':
+        async_engine.ensure_started()
+    else:
+        get_lookup_executor()
+    
+    # HTTP/2 connections live on the asyncio engine's loop whichever engine runs the lookups
+    if LOOKUP_ENGINE == 'asyncio' or UPSTREAM_TRANSPORT == 'http2':
+        Thread(target=async_engine.warm_up, name="connection-warmup", daemon=True).start()
+    else:
+        Thread(target=upstream_connections.warm_up, name="connection-warmup", daemon=True).start()
+    
+    # Map the cache snapshot and start the worker's share of rebuilding it
+    if cache_snapshot is not None:
+        cache_snapshot.refresh()
+    
+    Thread(target=job_heartbeat_loop, name="job-heartbeat", daemon=True).start()
+    
+    if RESUME_JOBS_ON_STARTUP:
+        resume_incomplete_jobs()
+
+@app.before_request
+def ensure_worker_started():
+    if worker_pid != os.getpid():
+        init_worker()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     debug = os.environ.get("FLASK_ENV") == "development"
+    init_worker()
     app.run(host="0.0.0.0", port=port, debug=debug)
\ No newline at end of file
@@ -0,0 +1,296 @@
+"""Benchmarks for the lookup path, run against a local stand-in for the upstream
+
+    python bench.py transport [--requests 2000] [--concurrency 32] [--latency 0.05] [--connect-delay 0.05]
+
+transport: sends the same lookups through app.post_lookup() with the requests
+HTTPAdapter pool (UPSTREAM_TRANSPORT=http1) and the httpx HTTP/2 client
+(UPSTREAM_TRANSPORT=http2), and reports throughput, latency and how many
+connections each opened. The local server answers both HTTP/1.1 and h2c;
+--connect-delay stands in for the TCP+TLS handshake a real connection costs.
+
+    python bench.py cache [--entries 100000] [--requests 500000] [--capacity 20000]
+
+cache: compares app.PhoneCache with the unbounded dict + lock it replaced, for the
+cost of a hit, a miss and a store, and for hit rate and size under a skewed stream
+of lookups when PhoneCache is capped at --capacity entries.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import concurrent.futures
+
+# Keep app from warming connections to, or resuming jobs against, the real upstream,
+# and from reading or writing a deployment's checkpoints and caches
+STATE_DIR = tempfile.mkdtemp(prefix='bd_courier_bench_')
+os.environ.setdefault('RESUME_JOBS_ON_STARTUP', '0')
+os.environ.setdefault('CHECKPOINT_DB', os.path.join(STATE_DIR, 'checkpoints.db'))
+os.environ.setdefault('SHARED_CACHE_DB', os.path.join(STATE_DIR, 'cache.db'))
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(STATE_DIR, 'cache.snap'))
+os.environ.setdefault('WARMUP_CONNECTIONS', '0')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'memory')
+os.environ.setdefault('UPSTREAM_RATE_LIMIT', '0')
+os.environ.setdefault('HTTP2_PRIOR_KNOWLEDGE', '1')
+
+import app
+
+H2_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+RESPONSE_BODY = json.dumps({'courierData': {'summary': {'total_parcel': 3, 'success_parcel': 2, 'cancelled_parcel': 1}}}).encode()
+
+class BenchUpstream:
+    """Local upstream: HTTP/1.1 keep-alive, or h2c when the client sends the preface
+
+    It runs in a child process so its own framing work does not compete with the
+    client under test for the GIL.
+    """
+
+    def __init__(self, latency, connect_delay):
+        self.latency = latency
+        self.connect_delay = connect_delay
+        self.opened = multiprocessing.Value('i', 0)
+
+    @property
+    def connections(self):
+        return self.opened.value
+
+    @connections.setter
+    def connections(self, value):
+        self.opened.value = value
+
+    def start(self):
+        """Start the server process; returns the lookup URL to point app.API_URL at"""
+        ports = multiprocessing.Queue()
+        multiprocessing.Process(target=self.serve, args=(ports,), name="bench-upstream", daemon=True).start()
+        return f"http://127.0.0.1:{ports.get()}/api/pro/courier-check"
+
+    def serve(self, ports):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle, '127.0.0.1', 0, backlog=1024))
+        ports.put(server.sockets[0].getsockname()[1])
+        loop.run_forever()
+
+    async def respond_delay(self):
+        await asyncio.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+
+    async def handle(self, reader, writer):
+        with self.opened.get_lock():
+            self.opened.value += 1
+        await asyncio.sleep(self.connect_delay)
+        try:
+            # h2c starts with a preface whose first line looks like a request line
+            first_line = await reader.readuntil(b'\r\n')
+            if first_line == H2_PREFACE[:16]:
+                await reader.readexactly(len(H2_PREFACE) - 16)
+                await self.serve_h2(reader, writer)
+            else:
+                await self.serve_http1(first_line, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_http1(self, request_line, reader, writer):
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n'):
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+
+            await self.respond_delay()
+            body = b'' if request_line.startswith(b'HEAD ') else RESPONSE_BODY
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(RESPONSE_BODY)
+                + body
+            )
+            await writer.drain()
+
+            request_line = await reader.readuntil(b'\r\n')
+
+    async def serve_h2(self, reader, writer):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.exceptions
+
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        methods = {}
+        data = H2_PREFACE
+
+        async def answer(stream_id):
+            await self.respond_delay()
+            head_only = methods.pop(stream_id) == b'HEAD'
+            try:
+                conn.send_headers(stream_id, [
+                    (':status', '200'),
+                    ('content-type', 'application/json'),
+                    ('content-length', str(len(RESPONSE_BODY)))
+                ], end_stream=head_only)
+                if not head_only:
+                    conn.send_data(stream_id, RESPONSE_BODY, end_stream=True)
+            except h2.exceptions.ProtocolError:
+                return  # The client reset the stream or went away
+            writer.write(conn.data_to_send())
+            await writer.drain()
+
+        while data:
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    methods[event.stream_id] = dict(event.headers)[b':method']
+                elif isinstance(event, h2.events.DataReceived):
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    asyncio.ensure_future(answer(event.stream_id))
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            data = await reader.read(65536)
+
+def run_lookups(total, concurrency):
+    """Send total lookups through app.post_lookup() from concurrency threads; returns (seconds, latencies, errors)"""
+    key = app.api_keys.keys[0]
+    timeout = (app.CONNECT_TIMEOUT, app.API_TIMEOUT)
+    latencies = []
+    errors = 0
+
+    def one(index):
+        response, elapsed, _ = app.post_lookup(f"017{index:08d}", timeout, key)
+        response.json()
+        return elapsed
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in concurrent.futures.as_completed([pool.submit(one, index) for index in range(total)]):
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    return time.perf_counter() - start, latencies, errors
+
+def bench_transport(args):
+    if app.httpx is None:
+        sys.exit("The http2 transport needs httpx and h2: pip install 'httpx[http2]'")
+
+    upstream = BenchUpstream(args.latency, args.connect_delay)
+    app.API_URL = upstream.start()
+    print(f"{args.requests} lookups, {args.concurrency} threads, ~{args.latency * 1000:.0f}ms upstream latency, "
+          f"{args.connect_delay * 1000:.0f}ms per new connection\n")
+    print(f"{'transport':<10} {'seconds':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'conns':>6} {'errors':>7}")
+
+    for transport in ('http1', 'http2'):
+        app.UPSTREAM_TRANSPORT = transport
+        app.upstream_connections = app.UpstreamConnections()
+        upstream.connections = 0
+
+        seconds, latencies, errors = run_lookups(args.requests, args.concurrency)
+        latencies.sort()
+        p50 = statistics.median(latencies) if latencies else 0.0
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+        print(f"{transport:<10} {seconds:>8.2f} {len(latencies) / seconds:>8.0f} {p50 * 1000:>8.1f} "
+              f"{p99 * 1000:>8.1f} {upstream.connections:>6} {errors:>7}")
+
+class DictCache:
+    """phone_cache as it used to be: a module-level dict behind a lock, never trimmed"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, phone):
+        with self.lock:
+            if phone in self.entries:
+                return self.entries[phone]
+        return None
+
+    def set(self, phone, result):
+        with self.lock:
+            self.entries[phone] = result
+
+def ns_per_call(fn, phones):
+    start = time.perf_counter()
+    for phone in phones:
+        fn(phone)
+    return (time.perf_counter() - start) / len(phones) * 1e9
+
+def skewed_phones(count, keyspace):
+    """Lookups where a few numbers recur often and most are rare, like repeat customers"""
+    rng = random.Random(7)
+    return [f"017{int(rng.paretovariate(0.3)) % keyspace:08d}" for _ in range(count)]
+
+def bench_cache(args):
+    result = (json.loads(RESPONSE_BODY), None)
+    phones = [f"017{i:08d}" for i in range(args.entries)]
+    shuffled = random.Random(1).sample(phones, len(phones))
+    unknown = [f"019{i:08d}" for i in range(args.entries)]
+    workload = skewed_phones(args.requests, args.entries * 10)
+
+    print(f"{args.entries} entries; skewed workload of {args.requests} lookups, PhoneCache capped at {args.capacity}\n")
+    print(f"{'cache':<11} {'set ns':>7} {'hit ns':>7} {'miss ns':>8} {'MB':>6} {'hit rate':>9} {'held':>8}")
+
+    caches = (
+        ('dict', DictCache, DictCache),
+        ('PhoneCache', lambda: app.PhoneCache(max_entries=args.entries, max_bytes=0),
+         lambda: app.PhoneCache(max_entries=args.capacity, max_bytes=0))
+    )
+    for name, make_full, make_capped in caches:
+        cache = make_full()
+        set_ns = ns_per_call(lambda phone: cache.set(phone, result), phones)
+        hit_ns = ns_per_call(cache.get, shuffled)
+        miss_ns = ns_per_call(cache.get, unknown)
+
+        # Memory is measured on a second copy, as tracing allocations slows the timings down
+        tracemalloc.start()
+        cache = make_full()
+        for phone in phones:
+            cache.set(phone, result)
+        memory = tracemalloc.get_traced_memory()[0] / 1e6
+        tracemalloc.stop()
+
+        cache = make_capped()
+        hits = 0
+        for phone in workload:
+            if cache.get(phone) is not None:
+                hits += 1
+            else:
+                cache.set(phone, result)
+
+        print(f"{name:<11} {set_ns:>7.0f} {hit_ns:>7.0f} {miss_ns:>8.0f} {memory:>6.1f} "
+              f"{hits / len(workload):>9.1%} {len(cache):>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    transport = benchmarks.add_parser('transport', help='HTTP/1.1 connection pool vs HTTP/2 multiplexing')
+    transport.add_argument('--requests', type=int, default=2000)
+    transport.add_argument('--concurrency', type=int, default=32)
+    transport.add_argument('--latency', type=float, default=0.05, help='Mean upstream response time in seconds')
+    transport.add_argument('--connect-delay', type=float, default=0.05, help='Extra seconds each new connection costs')
+    transport.set_defaults(run=bench_transport)
+
+    cache = benchmarks.add_parser('cache', help='PhoneCache vs the unbounded dict it replaced')
+    cache.add_argument('--entries', type=int, default=100000, help='Numbers stored for the per-call timings')
+    cache.add_argument('--requests', type=int, default=500000, help='Lookups in the skewed workload')
+    cache.add_argument('--capacity', type=int, default=20000, help='PhoneCache entry cap for the skewed workload')
+    cache.set_defaults(run=bench_cache)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+"""gunicorn settings, read from the working directory by `gunicorn app:app` (render.yaml)"""
+
+def post_worker_init(worker):
+    # Start each worker's pools and background threads and resume orphaned jobs;
+    # app does not do this at import
+    import app
+    app.init_worker()
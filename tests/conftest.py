@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# Keep app's SQLite files and snapshot away from a real deployment's
+STATE_DIR = tempfile.mkdtemp(prefix='bd_courier_tests_')
+os.environ.setdefault('CHECKPOINT_DB', os.path.join(STATE_DIR, 'checkpoints.db'))
+os.environ.setdefault('SHARED_CACHE_DB', os.path.join(STATE_DIR, 'cache.db'))
+os.environ.setdefault('SNAPSHOT_PATH', os.path.join(STATE_DIR, 'cache.snap'))
+os.environ.setdefault('RATE_LIMIT_DB', os.path.join(STATE_DIR, 'ratelimit.db'))
+os.environ.setdefault('REPORT_DIR', os.path.join(STATE_DIR, 'reports'))
+os.environ.setdefault('RESUME_JOBS_ON_STARTUP', '0')
+os.environ.setdefault('WARMUP_CONNECTIONS', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
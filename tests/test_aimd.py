@@ -0,0 +1,74 @@
+import app
+
+
+def controller(limit=4, min_limit=2, max_limit=8):
+    governor = app.ConcurrencyGovernor(limit, limit)
+    return app.AimdController(governor, min_limit, max_limit), governor
+
+
+def after_cooldown(aimd):
+    aimd.last_decrease -= app.AIMD_COOLDOWN_SECONDS
+
+
+def test_limit_grows_by_one_per_round_of_successes():
+    aimd, governor = controller()
+    for _ in range(4):
+        aimd.on_success(0.1)
+    assert aimd.limit == 5
+    assert governor.limit == 5
+
+    for _ in range(5):
+        aimd.on_success(0.1)
+    assert aimd.limit == 6
+
+
+def test_limit_stops_at_max():
+    aimd, _ = controller(limit=8)
+    for _ in range(100):
+        aimd.on_success(0.1)
+    assert aimd.limit == 8
+
+
+def test_congestion_halves_limit_once_per_cooldown():
+    aimd, governor = controller(limit=8)
+    aimd.on_congestion("429 from upstream")
+    assert aimd.limit == 4
+    assert governor.limit == 4
+
+    # The rest of the same burst of 429s is ignored
+    aimd.on_congestion("429 from upstream")
+    assert aimd.limit == 4
+
+    after_cooldown(aimd)
+    aimd.on_congestion("429 from upstream")
+    assert aimd.limit == 2
+
+    after_cooldown(aimd)
+    aimd.on_congestion("429 from upstream")
+    assert aimd.limit == 2
+
+
+def test_latency_spike_counts_as_congestion_once_baseline_is_known():
+    aimd, _ = controller(limit=8)
+    aimd.on_success(5.0)
+    assert aimd.limit == 8
+
+    for _ in range(app.AIMD_BASELINE_MIN_SAMPLES):
+        aimd.on_success(0.1)
+    aimd.on_success(0.1 * app.AIMD_LATENCY_FACTOR * 2)
+    assert aimd.limit == 4
+
+
+def test_baseline_follows_a_lasting_slowdown():
+    aimd, _ = controller(limit=8)
+    for _ in range(app.AIMD_BASELINE_MIN_SAMPLES):
+        aimd.on_success(0.1)
+
+    # The upstream is now permanently ten times slower: the first responses are cut as
+    # spikes, then the median moves up to the new latency and the limit climbs back
+    for _ in range(app.AIMD_BASELINE_WINDOW):
+        after_cooldown(aimd)
+        aimd.on_success(1.0)
+    assert aimd.decreases >= 1
+    assert aimd.stats()['baseline_latency_ms'] == 1000.0
+    assert aimd.limit == 8
@@ -0,0 +1,90 @@
+import app
+
+
+def open_breaker():
+    breaker = app.CircuitBreaker()
+    for _ in range(app.BREAKER_MIN_CALLS):
+        breaker.record(False)
+    assert breaker.state == 'open'
+    return breaker
+
+
+def let_open_period_pass(breaker):
+    breaker.opened_at -= app.BREAKER_OPEN_SECONDS
+
+
+def test_opens_once_enough_calls_fail():
+    breaker = app.CircuitBreaker()
+    for _ in range(app.BREAKER_MIN_CALLS - 1):
+        breaker.record(False)
+    assert breaker.state == 'closed'
+
+    breaker.record(False)
+    assert breaker.state == 'open'
+    assert breaker.trips == 1
+
+
+def test_stays_closed_below_error_rate():
+    breaker = app.CircuitBreaker()
+    for index in range(app.BREAKER_WINDOW * 2):
+        breaker.record(index % 4 != 3)  # One failure in four
+    assert breaker.state == 'closed'
+
+
+def test_open_circuit_refuses_calls_until_it_half_opens():
+    breaker = open_breaker()
+
+    allowed, probe, wait = breaker.admit()
+    assert not allowed and not probe
+    assert 0 < wait <= app.BREAKER_OPEN_SECONDS
+    assert breaker.rejected == 1
+
+    # Peeking neither counts a rejection nor moves the state on
+    assert breaker.admit(peek=True)[0] is False
+    assert breaker.rejected == 1
+
+    let_open_period_pass(breaker)
+    assert breaker.admit(peek=True) == (True, False, 0)
+    assert breaker.state == 'open'
+
+
+def test_successful_probes_close_the_circuit():
+    breaker = open_breaker()
+    let_open_period_pass(breaker)
+
+    probes = [breaker.admit() for _ in range(app.BREAKER_PROBES)]
+    assert breaker.state == 'half_open'
+    assert all(allowed and probe for allowed, probe, _ in probes)
+
+    # No more calls until the probes report back
+    assert breaker.admit()[0] is False
+
+    for _ in probes:
+        breaker.record(True, probe=True)
+    assert breaker.state == 'closed'
+    assert breaker.admit() == (True, False, 0)
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = open_breaker()
+    let_open_period_pass(breaker)
+
+    allowed, probe, _ = breaker.admit()
+    assert allowed and probe
+    breaker.record(False, probe=True)
+
+    assert breaker.state == 'open'
+    assert breaker.trips == 2
+    assert breaker.admit()[0] is False
+
+
+def test_released_probe_frees_its_place():
+    breaker = open_breaker()
+    let_open_period_pass(breaker)
+
+    probes = [breaker.admit() for _ in range(app.BREAKER_PROBES)]
+    assert breaker.admit()[0] is False
+
+    breaker.release(probes[0][1])
+    allowed, probe, _ = breaker.admit()
+    assert allowed and probe
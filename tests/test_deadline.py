@@ -0,0 +1,65 @@
+import concurrent.futures
+import time
+
+import openpyxl
+import pytest
+
+import app
+
+LOOKUP_SECONDS = 0.1
+STRAGGLER_SECONDS = 1.5  # Every fifth lookup, so some are still in flight at the deadline
+
+
+@pytest.fixture
+def slow_lookups(monkeypatch):
+    """Lookups that succeed after a while and count themselves, like the real ones"""
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+    def lookup(phone, job):
+        elapsed = STRAGGLER_SECONDS if int(phone) % 5 == 0 else LOOKUP_SECONDS
+        time.sleep(elapsed)
+        return app.record_lookup_success(phone, {'courierData': {}}, job, elapsed, 0)
+
+    monkeypatch.setattr(app, 'submit_lookup', lambda phone, job=None: pool.submit(lookup, phone, job))
+    monkeypatch.setattr(app, 'PIPELINE_WINDOW', 8)
+    monkeypatch.setattr(app, 'DEADLINE_REPORT_RESERVE', 0.5)
+    yield
+    pool.shutdown(wait=True)
+
+
+def report_statuses(job):
+    wb = openpyxl.load_workbook(job.report_path)
+    statuses = [row[6] for row in wb['Summary'].iter_rows(min_row=2, values_only=True)]
+    wb.close()
+    return statuses
+
+
+def test_expired_job_stats_add_up_to_its_total(slow_lookups):
+    numbers = [f"0171{index:07d}" for index in range(60)]
+    job = app.Job(numbers, [], deadline=1.2)
+    app.run_job(job)
+
+    # Lookups abandoned at the deadline finish afterwards; they must not count
+    time.sleep(STRAGGLER_SECONDS)
+
+    assert job.status == 'done'
+    assert job.deadline_hit
+    stats = job.stats
+    assert 0 < stats['success'] < len(numbers)
+    assert stats['success'] + stats['failed'] + stats['not_checked'] == stats['total'] == len(numbers)
+
+    statuses = report_statuses(job)
+    assert len(statuses) == len(numbers)
+    assert statuses.count(f"Error: {app.NOT_CHECKED_DEADLINE}") == stats['not_checked']
+    assert sum(1 for status in statuses if not status.startswith('Error')) == stats['success']
+
+
+def test_job_without_deadline_checks_every_number(slow_lookups):
+    numbers = [f"0172{index:07d}" for index in range(10)]
+    job = app.Job(numbers, [])
+    app.run_job(job)
+
+    assert job.status == 'done'
+    assert not job.deadline_hit
+    assert job.stats['success'] == len(numbers)
+    assert job.stats['not_checked'] == 0
@@ -0,0 +1,67 @@
+import app
+
+RESULT = ({'courierData': {}}, None)
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = app.PhoneCache(max_entries=2, max_bytes=0, ttl=60, stale=0)
+    cache.set('01711111111', RESULT)
+    cache.set('01722222222', RESULT)
+    assert cache.get('01711111111') == RESULT
+
+    cache.set('01733333333', RESULT)
+    assert '01711111111' in cache
+    assert '01722222222' not in cache
+    assert '01733333333' in cache
+    assert cache.stats()['evictions'] == 1
+
+
+def test_byte_cap_evicts_and_replacing_keeps_the_count():
+    size = len(app.json.dumps(RESULT))
+    cache = app.PhoneCache(max_entries=100, max_bytes=size * 2, ttl=60, stale=0)
+    for phone in ('01711111111', '01722222222', '01711111111'):
+        cache.set(phone, RESULT)
+    assert len(cache) == 2
+    assert cache.bytes == size * 2
+
+    cache.set('01733333333', RESULT)
+    assert len(cache) == 2
+    assert '01722222222' not in cache
+
+
+def test_expired_entry_is_a_miss_but_served_stale_for_a_while():
+    cache = app.PhoneCache(max_entries=10, max_bytes=0, ttl=60, stale=30)
+    cache.set('01711111111', RESULT, ttl=-1)
+
+    assert '01711111111' not in cache
+    assert cache.get('01711111111') is None
+    assert cache.get_stale('01711111111') == RESULT
+
+    # A fresh entry is not stale
+    cache.set('01722222222', RESULT)
+    assert cache.get_stale('01722222222') is None
+
+
+def test_entry_past_its_stale_window_is_dropped():
+    cache = app.PhoneCache(max_entries=10, max_bytes=0, ttl=60, stale=30)
+    cache.set('01711111111', RESULT, ttl=-31)
+
+    assert cache.get_stale('01711111111') is None
+    assert cache.get('01711111111') is None
+    assert len(cache) == 0
+    assert cache.stats()['expired'] == 1
+
+
+def test_sweep_removes_dead_entries_oldest_first():
+    cache = app.PhoneCache(max_entries=10, max_bytes=0, ttl=60, stale=0)
+    cache.set('01711111111', RESULT, ttl=-1)
+    cache.set('01722222222', RESULT, ttl=-1)
+    cache.set('01733333333', RESULT)
+    cache.set('01744444444', RESULT, ttl=-1)
+
+    assert cache.sweep(limit=1) == 1
+    assert cache.sweep() == 1
+
+    # Stops at the first live entry; the dead one behind it is still never returned
+    assert len(cache) == 2
+    assert cache.get('01744444444') is None
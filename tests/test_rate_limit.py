@@ -0,0 +1,117 @@
+import pytest
+
+import app
+
+RATE = 2.0
+BURST = 3.0
+
+
+def fresh(now=1000.0):
+    return (BURST, now, RATE)
+
+
+def test_burst_is_granted_at_once_then_tokens_are_paced():
+    state, now = fresh(), 1000.0
+    waits = []
+    for _ in range(int(BURST)):
+        state, wait, granted = app.bucket_reserve(state, now, RATE, BURST)
+        assert granted
+        waits.append(wait)
+    assert waits == [0.0, 0.0, 0.0]
+
+    # Then the bucket goes into debt, one token every 1/RATE seconds
+    state, wait, granted = app.bucket_reserve(state, now, RATE, BURST)
+    assert granted and wait == pytest.approx(1 / RATE)
+    state, wait, granted = app.bucket_reserve(state, now, RATE, BURST)
+    assert granted and wait == pytest.approx(2 / RATE)
+
+
+def test_no_token_is_taken_beyond_the_reservation_horizon():
+    state, now = (0.0, 1000.0, RATE), 1000.0
+    while True:
+        state, wait, granted = app.bucket_reserve(state, now, RATE, BURST)
+        if not granted:
+            break
+        assert wait <= app.PACER_MAX_RESERVATION
+
+    tokens = state[0]
+    state, retry_in, granted = app.bucket_reserve(state, now, RATE, BURST)
+    assert not granted
+    assert state[0] == tokens
+    assert retry_in > 0
+
+
+def test_tokens_refill_up_to_burst():
+    state = (0.0, 1000.0, RATE)
+    assert app.bucket_refill(state, 1001.0, RATE, BURST)[0] == pytest.approx(RATE)
+    assert app.bucket_refill(state, 1100.0, RATE, BURST)[0] == BURST
+
+
+def test_pause_holds_every_token_until_it_ends():
+    now = 1000.0
+    state = app.bucket_adjust(fresh(now), now, RATE, BURST, pause=30)
+
+    state, retry_in, granted = app.bucket_reserve(state, now + 10, RATE, BURST)
+    assert not granted
+    assert retry_in >= 20 - app.PACER_MAX_RESERVATION
+
+    state, wait, granted = app.bucket_reserve(state, now + 30, RATE, BURST)
+    assert granted
+
+
+def test_rate_cut_is_bounded_and_recovers():
+    now = 1000.0
+    state = app.bucket_adjust(fresh(now), now, RATE, BURST, factor=0.5)
+    assert state[2] == pytest.approx(RATE * 0.5)
+
+    state = app.bucket_adjust(state, now, RATE, BURST, factor=0.0)
+    assert state[2] == app.PACER_MIN_RATE
+
+    recovered = app.bucket_refill(state, now + app.PACER_RECOVERY_SECONDS, RATE, BURST)
+    assert recovered[2] == RATE
+
+
+def test_sqlite_buckets_are_shared_between_backends(tmp_path):
+    path = str(tmp_path / 'ratelimit.db')
+    first = app.SqliteRateLimitBackend(path, RATE, BURST)
+    second = app.SqliteRateLimitBackend(path, RATE, BURST)
+
+    grants = [backend.reserve('bdcourier') for backend in (first, second, first)]
+    assert all(granted and wait == 0 for wait, granted, _ in grants)
+
+    # The burst is spent across both, so the next caller has to wait
+    wait, granted, _ = second.reserve('bdcourier')
+    assert granted and wait > 0
+
+
+def test_throttle_pauses_for_retry_after():
+    limiter = app.RateLimiter('test', RATE, BURST, app.MemoryRateLimitBackend(RATE, BURST))
+    limiter.on_throttle({'Retry-After': '20'})
+
+    wait, granted = limiter.reserve()
+    assert not granted
+    assert wait >= 20 - app.PACER_MAX_RESERVATION
+    assert limiter.stats()['throttles'] == 1
+
+
+class FailingBackend:
+    def reserve(self, name):
+        raise OSError("rate limit service unreachable")
+
+    def adjust(self, name, **changes):
+        raise OSError("rate limit service unreachable")
+
+
+def test_backend_failure_paces_at_a_share_of_the_rate(monkeypatch):
+    monkeypatch.setattr(app, 'RATE_LIMIT_INSTANCES', 4)
+    limiter = app.RateLimiter('test', 8.0, 4.0, FailingBackend())
+
+    wait, granted = limiter.reserve()
+    assert granted and wait == 0
+    wait, granted = limiter.reserve()
+    assert granted and wait == pytest.approx(1 / 2.0, abs=0.05)
+
+    stats = limiter.stats()
+    assert stats['using_fallback']
+    assert stats['fallback_rate'] == 2.0
+    assert stats['fallback_calls'] == 2
@@ -0,0 +1,68 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def closed_breaker(monkeypatch):
+    monkeypatch.setattr(app, 'circuit_breaker', app.CircuitBreaker())
+
+
+def failed_attempt(lookup, error="Request timeout"):
+    lookup.last_error = error
+    lookup.retryable = True
+    lookup.throttled = False
+
+
+def test_budget_denies_retries_past_minimum_plus_ratio():
+    budget = app.RetryBudget(ratio=0.5, minimum=2)
+    for _ in range(4):
+        budget.record_first_attempt()
+
+    assert [budget.try_spend() for _ in range(5)] == [True, True, True, True, False]
+    assert budget.stats() == {'first_attempts': 4, 'retries': 4, 'denied': 1, 'allowed': 4}
+
+    # More traffic earns more retries
+    budget.record_first_attempt()
+    assert budget.try_spend()
+
+
+def test_lookup_gives_up_once_its_jobs_budget_is_spent():
+    job = app.Job(['01711111111', '01722222222'], [])
+    job.retry_budget = app.RetryBudget(ratio=0, minimum=1)
+
+    first = app.LookupAttempts('01711111111', job)
+    failed_attempt(first)
+    assert first.next_retry() > 0
+    assert job.stats['retries'] == 1
+
+    second = app.LookupAttempts('01722222222', job)
+    failed_attempt(second)
+    assert second.next_retry() is None
+    assert second.last_error == "Request timeout" + app.BUDGET_GAVE_UP
+    assert job.stats['retries_denied'] == 1
+
+    # The job's limit, not the upstream's, so a coalesced caller looks the number up itself
+    assert app.stopped_by_job_limits(second.last_error)
+
+
+def test_non_retryable_failure_does_not_spend_budget():
+    job = app.Job(['01711111111'], [])
+    lookup = app.LookupAttempts('01711111111', job)
+    failed_attempt(lookup, "Invalid response: not JSON")
+    lookup.retryable = False
+
+    assert lookup.next_retry() is None
+    assert job.retry_budget.stats()['retries'] == 0
+    assert not app.stopped_by_job_limits(lookup.last_error)
+
+
+def test_lookup_stops_after_max_attempts():
+    lookup = app.LookupAttempts('01711111111', app.Job(['01711111111'], []), max_attempts=2)
+    delays = []
+    for _ in range(3):
+        failed_attempt(lookup)
+        delays.append(lookup.next_retry())
+
+    assert delays[0] > 0 and delays[1] > 0
+    assert delays[2] is None
@@ -0,0 +1,87 @@
+import concurrent.futures
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Lookups started by single_flight, as (job, future) pairs the test completes by hand"""
+    started = []
+
+    def start_lookup(phone, job=None, refresh=False):
+        future = concurrent.futures.Future()
+        started.append((job, future))
+        return future
+
+    monkeypatch.setattr(app, 'start_lookup', start_lookup)
+    return started
+
+
+def test_follower_shares_the_leaders_lookup(lookups):
+    flight = app.SingleFlight()
+    leader_job, follower_job = app.Job(['01711111111'], []), app.Job(['01711111111'], [])
+
+    leader = flight.submit('01711111111', leader_job)
+    follower = flight.submit('01711111111', follower_job)
+    assert len(lookups) == 1
+    assert follower is not leader
+
+    lookups[0][1].set_result(({'courierData': {}}, None))
+    assert follower.result(timeout=1) == ({'courierData': {}}, None)
+    assert follower_job.stats['success'] == 1
+    assert follower_job.stats['coalesced'] == 1
+    assert flight.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 1}
+
+
+def test_cancelling_the_follower_leaves_the_leader_running(lookups):
+    flight = app.SingleFlight()
+    leader = flight.submit('01711111111', app.Job(['01711111111'], []))
+    follower = flight.submit('01711111111', app.Job(['01711111111'], []))
+
+    assert follower.cancel()
+    assert not leader.cancelled()
+    lookups[0][1].set_result(({'courierData': {}}, None))
+    assert leader.result(timeout=1) == ({'courierData': {}}, None)
+
+
+def test_upstream_failure_is_shared(lookups):
+    flight = app.SingleFlight()
+    flight.submit('01711111111', app.Job(['01711111111'], []))
+    follower_job = app.Job(['01711111111'], [])
+    follower = flight.submit('01711111111', follower_job)
+
+    lookups[0][1].set_result((None, "API Error 500: down"))
+    assert follower.result(timeout=1) == (None, "API Error 500: down")
+    assert len(lookups) == 1
+    assert follower_job.stats['failed'] == 1
+
+
+@pytest.mark.parametrize('error', [
+    "Cancelled",
+    "Request timeout" + app.BUDGET_GAVE_UP,
+    "Request timeout" + app.DEADLINE_GAVE_UP,
+])
+def test_follower_looks_up_again_when_the_leaders_job_stopped_it(lookups, error):
+    flight = app.SingleFlight()
+    flight.submit('01711111111', app.Job(['01711111111'], []))
+    follower_job = app.Job(['01711111111'], [])
+    follower = flight.submit('01711111111', follower_job)
+
+    lookups[0][1].set_result((None, error))
+    assert len(lookups) == 2
+    assert lookups[1][0] is follower_job
+    assert not follower.done()
+
+    lookups[1][1].set_result(({'courierData': {}}, None))
+    assert follower.result(timeout=1) == ({'courierData': {}}, None)
+
+
+def test_finished_leader_is_not_followed(lookups):
+    flight = app.SingleFlight()
+    flight.submit('01711111111')
+    lookups[0][1].set_result(({'courierData': {}}, None))
+
+    flight.submit('01711111111')
+    assert len(lookups) == 2
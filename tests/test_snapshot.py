@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+import app
+
+
+def courier_data(**couriers):
+    return {'courierData': {
+        name: {'total_parcel': total, 'success_parcel': success, 'cancelled_parcel': cancelled}
+        for name, (total, success, cancelled) in couriers.items()
+    }}
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'cache.snap')
+    expires_at = int(time.time()) + 3600
+    rows = [
+        ('01711111111', courier_data(pathao=(5, 4, 1), steadfast=(2, 2, 0)), expires_at),
+        ('01822222222', courier_data(redx=(0, 0, 0)), expires_at + 1),
+        ('01933333333', {'message': 'not per-courier counts'}, expires_at),
+        ('not-a-phone', courier_data(pathao=(1, 1, 0)), expires_at),
+    ]
+    assert app.write_snapshot(path, rows) == 2
+
+    snapshot = app.CacheSnapshot(path)
+    snapshot.validate()
+    assert snapshot.numbers == 2
+    assert snapshot.get('01711111111') == ((rows[0][1], None), expires_at)
+    assert snapshot.get('01822222222') == ((rows[1][1], None), expires_at + 1)
+    assert snapshot.get('01933333333') is None
+    assert snapshot.get('01700000000') is None
+    assert sorted(phone for phone, _, _ in snapshot.items()) == ['01711111111', '01822222222']
+
+
+def test_colliding_keys_are_all_found(tmp_path):
+    # Numbers whose home slot is the same in a 16-slot table, probed linearly
+    home = app.snapshot_slot(1711000000, 4)
+    phones = [f"{key:011d}" for key in range(1711000000, 1712000000) if app.snapshot_slot(key, 4) == home][:6]
+    expires_at = int(time.time()) + 3600
+    path = str(tmp_path / 'cache.snap')
+    app.write_snapshot(path, [(phone, courier_data(pathao=(index, 0, 0)), expires_at) for index, phone in enumerate(phones)])
+
+    snapshot = app.CacheSnapshot(path)
+    assert snapshot.slots == 16
+    for index, phone in enumerate(phones):
+        assert snapshot.get(phone)[0][0]['courierData']['pathao']['total_parcel'] == index
+
+    missing = next(f"{key:011d}" for key in range(1712000000, 1713000000) if app.snapshot_slot(key, 4) == home)
+    assert snapshot.get(missing) is None
+
+
+def test_truncated_file_is_rejected(tmp_path):
+    path = tmp_path / 'cache.snap'
+    app.write_snapshot(str(path), [('01711111111', courier_data(pathao=(1, 1, 0)), time.time() + 60)])
+    path.write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        app.CacheSnapshot(str(path))
+
+
+def test_bad_magic_is_rejected(tmp_path):
+    path = tmp_path / 'cache.snap'
+    app.write_snapshot(str(path), [])
+    path.write_bytes(b'NOTASNAP' + path.read_bytes()[8:])
+    with pytest.raises(ValueError):
+        app.CacheSnapshot(str(path))
+
+
+def write_raw_snapshot(path, couriers, slots, records):
+    """A snapshot file with exactly the given slot and record tuples"""
+    names = '\n'.join(couriers).encode()
+    numbers = sum(1 for slot in slots if slot[0])
+    with open(path, 'wb') as f:
+        f.write(app.SNAPSHOT_HEADER.pack(app.SNAPSHOT_MAGIC, len(names), len(slots), len(records), numbers, time.time()))
+        f.write(names.ljust((len(names) + 7) // 8 * 8, b'\0'))
+        for slot in slots:
+            f.write(app.SNAPSHOT_SLOT.pack(*slot))
+        for record in records:
+            f.write(app.SNAPSHOT_RECORD.pack(*record))
+
+
+def test_full_table_fails_validation(tmp_path):
+    path = str(tmp_path / 'cache.snap')
+    write_raw_snapshot(path, ['pathao'], [(1700000000 + index, 0, 0, 1, 0) for index in range(16)], [(0, 1, 1, 0)])
+    with pytest.raises(ValueError, match='empty slot'):
+        app.CacheSnapshot(path).validate()
+
+
+def test_out_of_range_courier_fails_validation(tmp_path):
+    path = str(tmp_path / 'cache.snap')
+    write_raw_snapshot(path, ['pathao'], [(1711111111, 0, 0, 1, 0)] + [(0, 0, 0, 0, 0)] * 15, [(3, 1, 1, 0)])
+    with pytest.raises(ValueError, match='courier index'):
+        app.CacheSnapshot(path).validate()
+
+
+def test_out_of_range_records_fail_validation(tmp_path):
+    path = str(tmp_path / 'cache.snap')
+    write_raw_snapshot(path, ['pathao'], [(1711111111, 0, 0, 2, 0)] + [(0, 0, 0, 0, 0)] * 15, [(0, 1, 1, 0)])
+    with pytest.raises(ValueError, match='records'):
+        app.CacheSnapshot(path).validate()
+
+
+@pytest.mark.skipif(app.shared_cache is None, reason="the snapshot is built from the shared cache")
+def test_import_keeps_current_snapshot_when_invalid(tmp_path):
+    current = tmp_path / 'cache.snap'
+    app.write_snapshot(str(current), [('01711111111', courier_data(pathao=(1, 1, 0)), time.time() + 60)])
+    before = current.read_bytes()
+
+    bad = str(tmp_path / 'bad.snap')
+    write_raw_snapshot(bad, ['pathao'], [(1700000000 + index, 0, 0, 1, 0) for index in range(16)], [(0, 1, 1, 0)])
+    with pytest.raises(ValueError):
+        app.SnapshotCache(str(current)).import_snapshot(bad)
+    assert current.read_bytes() == before
+    assert not list(tmp_path.glob('*.import'))
+
+
+def test_export_needs_service_token(monkeypatch):
+    monkeypatch.setattr(app, 'SNAPSHOT_SERVICE_ENABLED', True)
+    monkeypatch.setattr(app, 'SERVICE_TOKEN', 's3cret')
+    monkeypatch.setattr(app, 'cache_snapshot', app.SnapshotCache(app.SNAPSHOT_PATH))
+    client = app.app.test_client()
+    assert client.get('/cache/snapshot').status_code == 401
+    assert client.get('/cache/snapshot', headers={'X-Service-Token': 'wrong'}).status_code == 401